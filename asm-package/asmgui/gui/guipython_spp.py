@@ -10,8 +10,12 @@ from ..window_manager.status_manager import LabelManagerPmButtons, LabelManagerL
 from ..image_window.main_image_window import ImageWindow, ImageWindowPmButtons
 from ..draw_and_export.drawing_tools import DrawingTools, ScrollTools, PaintToolsText
 from ..train_and_predict.prediction import ClassifierText, ClassifierButtons, FeatureSelector, TrainingSetManager, TrainingSetManagerText#, SaveLoadJSON
+from ..train_and_predict.prediction import TrainingSettings
 from ..train_and_predict.automation import AutomationManager, AutomationManagerText, AutomationImageSelector
 from ..train_and_predict.diagnostics import DiagnosticsText, PiechartClassifier
+from ..randomforest_classifier.feature_space import feature_names
+from ..randomforest_classifier.training_functions import DEFAULT_FOREST_PARAMS
+from ..randomforest_classifier.hyperparameter_search import DEFAULT_TUNING_GRID
 
 # Define class
 class ASM(tk.Tk):
@@ -74,12 +78,55 @@ class ASM(tk.Tk):
         self.lasso_mode = "deactivated"
         self.zoom_mode  = "deactivated"
         
-        self.features = [
-            'Original image',"r_ctr",#"x_rel","y_rel",, # "x_ctr","y_ctr"
-            'denoise', 'Laplacian', 'Canny Edge', 'Sobel','Scharr', 'Prewitt',
-            'Gaussian σ=3', 'Gaussian σ=7', 'Median size=3'
-        ]
+        # Selectable features, as registered in the feature registry
+        self.features = feature_names()
         
+        # Number of threads computing feature planes (-1 = all cores)
+        self.feature_n_jobs = -1
+        # Images larger than this are split into tiles (None = never)
+        self.feature_tile_size = 4096
+        # Number of equally sized images whose features are extracted as one stack
+        self.feature_stack_size = 8
+        # Treat the ordered images as slices of one volume (3D features)
+        self.feature_volume_mode = False
+        # Classify RGB images on the features of every colour channel
+        self.feature_channels_mode = False
+        # Random forest settings, see build_forest
+        self.forest_params = dict(DEFAULT_FOREST_PARAMS)
+        # Training pixels: maximum per class (None = all), one pixel per
+        # spacing x spacing cell (1 = all) and seed of the random selection
+        self.train_max_per_class = 100000
+        self.train_spacing = 1
+        self.train_seed = 0
+        # Accuracy reported after training: 'oob' (out-of-bag, learns from
+        # all labels), 'holdout' (40% of the labels kept for testing) or None
+        self.train_evaluation = 'oob'
+        # Refit only the trees of added, edited or removed masks on train
+        self.train_incremental = False
+        self.incremental_forest = None
+        # Keep the labeled feature rows in output/training_rows and extract
+        # only those of added or edited masks, float16 halves the file size
+        self.train_store = False
+        self.train_store_dtype = 'float32'
+        # Number of sub-forests fitted in separate processes on the rows of
+        # the store and merged into one forest (1 = a single forest)
+        self.train_shards = 1
+        # Training fingerprint of RFmodel, see model_store.py
+        self.model_fingerprint = None
+        # Accepted loss of validation accuracy when pruning features
+        self.prune_tolerance = 0.01
+        # Result of the last feature pruning, saved in the training set JSON
+        self.feature_pruning = {}
+        # Forest settings tried by tune, the fastest configuration within
+        # the accepted loss of cross-validated accuracy is applied
+        self.tuning_grid = dict(DEFAULT_TUNING_GRID)
+        self.tuning_tolerance = 0.01
+        # Result of the last tuning, saved in the training set JSON
+        self.forest_tuning = {}
+        # Compute the selected features of the loaded images in the background
+        self.feature_prefetch = False
+        self.feature_prefetcher = None
+
         self.filedirectory = ''
         self.predict_image_paths = []
         self.training_image_paths = []
@@ -116,6 +163,7 @@ class ASM(tk.Tk):
         self.classifier_text = ClassifierText(self)
         self.feature_selector = FeatureSelector(self)
         self.classifier_buttons = ClassifierButtons(self)
+        self.training_settings = TrainingSettings(self)
         self.training_set_manager_text = TrainingSetManagerText(self)
         self.training_set_manager = TrainingSetManager(self)
         self.save_load_json = JsonSaver(self)
@@ -465,6 +465,10 @@ class ImageWindowPmButtons(ttk.Frame):
         # Refresh image window
         parent.image_window.refresh_from_parent(parent)
     
+        # Prefetch features around the new current image if enabled
+        if hasattr(parent, 'feature_selector'):
+            parent.feature_selector.prefetch(parent)
+    
         # Refresh UI if Training Set Manager exists
         #if hasattr(parent, 'training_set_manager'):
         #    parent.training_set_manager.refresh()
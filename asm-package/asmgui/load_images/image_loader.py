@@ -122,6 +122,10 @@ class ImageLoader(ttk.Frame):
         if hasattr(parent, 'automation_image_selector'):
             parent.automation_image_selector.refresh(parent)
 
+        # 🔥 Prefetch features of the current image and its neighbours if enabled
+        if hasattr(parent, 'feature_selector'):
+            parent.feature_selector.prefetch(parent)
+
     def refresh(self, parent):
         """
         Update the entry box to display parent.filedirectory.
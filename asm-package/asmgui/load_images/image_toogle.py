@@ -135,6 +135,9 @@ class ImageToogle(ttk.Frame):
                 
                 parent.image_toogle_text.update_widget(parent)
                 
+                # Prefetch features around the new current image if enabled
+                parent.feature_selector.prefetch(parent)
+                
             else:
                 # Handle non-integer float input
                 self.entry_box.delete(0, 'end')
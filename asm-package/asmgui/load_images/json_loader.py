@@ -93,12 +93,23 @@ class JsonLoader(ttk.Frame):
         parent.training_mask_paths = data.get("training masks", [])
         parent.lab_name = data["labels"]
         selected_features = data.get("features", [])
+        parent.feature_pruning = data.get("feature pruning", {})
+        parent.forest_tuning = data.get("forest tuning", {})
+        parent.forest_params.update(data.get("forest", {}))
+        sampling = data.get("sampling", {})
+        parent.train_max_per_class = sampling.get("max per class", parent.train_max_per_class)
+        parent.train_spacing = sampling.get("spacing", parent.train_spacing)
+        parent.train_seed = sampling.get("seed", parent.train_seed)
         
         # Restore selected features in GUI
         print("Restoring selected features:", selected_features)
         for feature, var in parent.feature_selector.feature_vars.items():
             var.set(feature in selected_features)
 
+        # Restore the saved model if it matches the training set
+        if hasattr(parent, 'classifier_buttons'):
+            parent.classifier_buttons.restore_model(parent)
+
         # Refresh UI if Training Set Manager exists
         if hasattr(parent, 'training_set_manager'):
             parent.training_set_manager.refresh()
@@ -114,6 +125,10 @@ class JsonLoader(ttk.Frame):
         # 🔥 Refresh imageloader if it exists
         if hasattr(parent, 'image_loader'):
             parent.image_loader.refresh(parent)
+
+        # 🔥 Prefetch features of the current image and its neighbours if enabled
+        if hasattr(parent, 'feature_selector'):
+            parent.feature_selector.prefetch(parent)
         
         
 class JsonSaver(ttk.Frame):
@@ -175,7 +190,13 @@ class JsonSaver(ttk.Frame):
             "training images": parent.training_image_paths,
             "training masks": parent.training_mask_paths,
             "labels": parent.lab_name,
-            "features": parent.feature_selector.get_selected_features()
+            "features": parent.feature_selector.get_selected_features(),
+            "feature pruning": getattr(parent, "feature_pruning", {}),
+            "forest tuning": getattr(parent, "forest_tuning", {}),
+            "forest": parent.forest_params,
+            "sampling": {"max per class": parent.train_max_per_class,
+                         "spacing": parent.train_spacing,
+                         "seed": parent.train_seed}
         }
     
         # Save JSON
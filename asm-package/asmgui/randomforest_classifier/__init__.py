@@ -3,4 +3,14 @@
 Whatever is defined in the __init__ file is directly accessible once
 the package is imported.
 """
-from asmgui.randomforest_classifier.training_functions import train_random_forest, predict_features
+from asmgui.randomforest_classifier.training_functions import train_random_forest, predict_features, predict_features_stack
+from asmgui.randomforest_classifier.training_functions import build_forest, forest_summary, fit_forest
+from asmgui.randomforest_classifier.training_store import TrainingStore
+from asmgui.randomforest_classifier.sharded_training import train_sharded, merge_forests
+from asmgui.randomforest_classifier.incremental_training import IncrementalForest
+from asmgui.randomforest_classifier.model_store import save_model, load_model, training_fingerprint
+from asmgui.randomforest_classifier.hyperparameter_search import search_forest_params, pareto_front
+from asmgui.randomforest_classifier.feature_space import feature_extraction, feature_extraction_sparse, FeatureMatrix
+from asmgui.randomforest_classifier.feature_space import feature_extraction_stack, feature_extraction_volume
+from asmgui.randomforest_classifier.feature_space import feature_extraction_channels, channel_feature_names
+from asmgui.randomforest_classifier.feature_space import feature_extraction_labeled, fill_feature_cache
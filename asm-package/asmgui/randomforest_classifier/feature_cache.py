@@ -0,0 +1,196 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Persistent, content-addressed cache for feature planes. Each
+#              plane is stored as a .npy file under output/features/, keyed
+#              by the image content, the feature name and its filter
+#              parameters, and loaded back memory-mapped. The cache is kept
+#              under a size cap by evicting the least recently used planes.
+##############################################################################
+"""Content-addressed on-disk cache of feature planes"""
+# Import packages
+import hashlib
+import os
+import threading
+from pathlib import Path
+import numpy as np
+
+# Bump when the output of an existing filter changes, invalidates old planes
+CACHE_VERSION = 1
+
+class FeatureCache:
+    """
+    On-disk cache of feature planes with least-recently-used eviction.
+
+    Attributes:
+        cache_dir (Path): Folder holding the cached .npy planes
+        max_bytes (int): Size cap of the cache folder in bytes
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3):
+        """
+        Initialize FeatureCache and create the cache folder.
+
+        Args:
+            cache_dir: Folder holding the cached planes, e.g. output/features
+            max_bytes: Size cap of the cache folder in bytes (default=2 GiB)
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        for path in self.cache_dir.glob("*.npy"):
+            try:
+                self._total_bytes += path.stat().st_size
+            except OSError:
+                # Evicted by another instance or process meanwhile
+                continue
+
+    @staticmethod
+    def image_key(img_i):
+        """
+        Hash the content of an image.
+
+        Args:
+            img_i: Image as a NumPy array
+
+        Returns:
+            str: Hex digest of the image shape, dtype and pixel values
+        """
+        h = hashlib.sha1()
+        h.update(repr((img_i.shape, img_i.dtype.str)).encode())
+        h.update(np.ascontiguousarray(img_i).data)
+        return h.hexdigest()
+
+    @staticmethod
+    def plane_key(image_key, feature, params=None):
+        """
+        Combine image hash, feature name and filter parameters into a key.
+
+        Args:
+            image_key: Hash of the image content, see image_key
+            feature: Feature name
+            params: Filter parameters of the feature (dict or None)
+
+        Returns:
+            str: Hex digest used as file name of the cached plane
+        """
+        h = hashlib.sha1()
+        h.update(repr((CACHE_VERSION, image_key, feature,
+                       sorted((params or {}).items()))).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / f"{key}.npy"
+
+    def load(self, key):
+        """
+        Load a cached plane memory-mapped.
+
+        Args:
+            key: Plane key, see plane_key
+
+        Returns:
+            np.memmap or None: Read-only plane, or None on a cache miss
+        """
+        path = self._path(key)
+        try:
+            plane = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        # Mark as recently used for the LRU eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return plane
+
+    def store(self, key, plane):
+        """
+        Store a plane in the cache and evict old planes if over the size cap.
+
+        Args:
+            key: Plane key, see plane_key
+            plane: Feature plane as a NumPy array
+        """
+        path = self._path(key)
+        # The folder may have been deleted since, the instance is shared
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        # Write to a temporary file first so readers never see partial planes
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(plane))
+        with self._lock:
+            # An overwritten plane no longer counts towards the total
+            try:
+                old_bytes = path.stat().st_size
+            except OSError:
+                old_bytes = 0
+            try:
+                os.replace(tmp_path, path)
+            except OSError:
+                # Plane is memory-mapped by someone else (Windows), keep theirs
+                tmp_path.unlink(missing_ok=True)
+                return
+            self._total_bytes += path.stat().st_size - old_bytes
+            if self._total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used planes until the cache fits its size cap.
+        """
+        entries = []
+        for path in self.cache_dir.glob("*.npy"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        # Oldest first
+        for _, size, path in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                # Still memory-mapped somewhere (Windows), try again later
+                continue
+            total -= size
+        self._total_bytes = total
+
+    def clear(self):
+        """
+        Delete every cached plane.
+        """
+        with self._lock:
+            for path in self.cache_dir.glob("*.npy"):
+                try:
+                    path.unlink()
+                except OSError:
+                    continue
+            self._total_bytes = 0
+
+
+# One cache per folder, shared by the GUI and the prefetcher thread so that
+# they keep a single size total
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+def feature_cache_for(filedirectory):
+    """
+    Return the feature cache of an image directory.
+
+    Args:
+        filedirectory: Image directory, the cache lives in output/features
+
+    Returns:
+        FeatureCache: Cache for the directory, the same instance on every call
+    """
+    cache_dir = (Path(filedirectory) / "output" / "features").resolve()
+    with _CACHES_LOCK:
+        if cache_dir not in _CACHES:
+            _CACHES[cache_dir] = FeatureCache(cache_dir)
+        return _CACHES[cache_dir]
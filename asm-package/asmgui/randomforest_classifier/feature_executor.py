@@ -0,0 +1,109 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Bounded thread pool used to compute independent feature
+#              planes concurrently. The OpenCV, scikit-image and scipy
+#              filters release the GIL, so the planes of one image can be
+#              computed on several cores at once. Dependent computations
+#              are scheduled as a graph, a node starts as soon as all of
+#              its inputs are done.
+##############################################################################
+"""Parallel execution of feature computations"""
+# Import packages
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+def resolve_n_jobs(n_jobs):
+    '''
+    Translate an sklearn style n_jobs value into a number of workers.
+
+    Args:
+        n_jobs: None or 1 for a single thread, -1 for all cores, -2 for all
+                cores but one, etc.
+
+    Returns:
+        int: Number of workers, at least 1
+    '''
+    n_cpu = os.cpu_count() or 1
+    if n_jobs is None or n_jobs == 0:
+        return 1
+    if n_jobs < 0:
+        return max(1, n_cpu + 1 + n_jobs)
+    return int(n_jobs)
+
+def run_parallel(func, items, n_jobs=-1):
+    '''
+    Call func on every item, in a bounded thread pool.
+
+    With a single worker the items are processed one after another in the
+    calling thread, in order, which gives a deterministic fallback.
+
+    Args:
+        func: Function taking one item
+        items: Items to process
+        n_jobs: Number of workers, see resolve_n_jobs (default=-1)
+
+    Returns:
+        list: Results of func, in the order of items
+    '''
+    items = list(items)
+    n_workers = min(resolve_n_jobs(n_jobs), len(items))
+    if n_workers <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        # map re-raises the first exception of a worker in the caller
+        return list(pool.map(func, items))
+
+def run_graph(nodes, dependencies, func, n_jobs=-1, priority=None):
+    '''
+    Call func on every node once all nodes it depends on are finished.
+
+    With a single worker the nodes are processed in the given order in the
+    calling thread, which has to be a topological order.
+
+    Args:
+        nodes: Node keys, in topological order
+        dependencies: Dict mapping a node to the nodes it depends on, nodes
+                      outside of nodes are treated as finished
+        func: Function taking one node
+        n_jobs: Number of workers, see resolve_n_jobs (default=-1)
+        priority: Optional dict of node priorities, the ready node with the
+                  highest priority is started first
+    '''
+    nodes = list(nodes)
+    n_workers = min(resolve_n_jobs(n_jobs), len(nodes))
+    if n_workers <= 1:
+        for node in nodes:
+            func(node)
+        return
+
+    # Unfinished dependencies per node and reverse edges
+    node_set = set(nodes)
+    waiting = {n: {d for d in dependencies.get(n, ()) if d in node_set} for n in nodes}
+    dependents = {n: [] for n in nodes}
+    for n, deps in waiting.items():
+        for d in deps:
+            dependents[d].append(n)
+    order = {n: i for i, n in enumerate(nodes)}
+
+    def sort_key(n):
+        return (-(priority or {}).get(n, 0), order[n])
+
+    ready = sorted((n for n in nodes if not waiting[n]), key=sort_key)
+    running = {}
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        while ready or running:
+            # Keep every worker busy, most important nodes first
+            while ready and len(running) < n_workers:
+                node = ready.pop(0)
+                running[pool.submit(func, node)] = node
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                # Re-raise exceptions of the worker in the caller
+                future.result()
+                for n in dependents[node]:
+                    waiting[n].discard(node)
+                    if not waiting[n]:
+                        ready.append(n)
+            ready.sort(key=sort_key)
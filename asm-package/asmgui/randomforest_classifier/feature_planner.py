@@ -0,0 +1,351 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Execution planner for the registered features. A selected
+#              feature list is turned into a DAG of the features and the
+#              intermediate results they need, every node is computed
+#              once and its result is freed as soon as its last consumer
+#              has finished.
+##############################################################################
+"""Plan and execute feature computations as a DAG"""
+# Import packages
+import threading
+import time
+import numpy as np
+from asmgui.randomforest_classifier.feature_registry import FEATURE_REGISTRY, IMAGE
+from asmgui.randomforest_classifier.feature_executor import run_graph, run_parallel
+
+def _take(result, index):
+    # Image index of a stack result, which can also be a tuple or dict
+    if isinstance(result, dict):
+        return {k: _take(v, index) for k, v in result.items()}
+    if isinstance(result, (tuple, list)):
+        return type(result)(_take(v, index) for v in result)
+    if isinstance(result, np.ndarray):
+        return result[index]
+    return result
+
+def _nbytes(result):
+    # Size of a node result, which can also be a tuple or dict of arrays
+    if isinstance(result, dict):
+        return sum(_nbytes(v) for v in result.values())
+    if isinstance(result, (tuple, list)):
+        return sum(_nbytes(v) for v in result)
+    return getattr(result, 'nbytes', 0)
+
+class FeaturePlan:
+    """
+    Execution plan for a list of selected features.
+
+    Attributes:
+        features (list): Requested output features, in the requested order
+        specs (dict): Chosen FeatureSpec per node, including intermediates
+        steps (list): Node names in topological order
+        consumers (dict): Number of steps consuming each node
+        radius (int): Total support radius of the plan in pixels
+    """
+
+    def __init__(self, features, chosen=None):
+        """
+        Build the plan for a list of registered feature names.
+
+        Args:
+            features: Names of the features to compute
+            chosen: Optional dict of FeatureSpecs to use per node instead of
+                    searching for alternatives, see subplan
+        """
+        self.features = list(features)
+        for name in self.features:
+            if name not in FEATURE_REGISTRY:
+                raise KeyError(f"Unknown feature {name!r}")
+
+        # Collect every node with its default way of computing it, then
+        # switch to alternatives whose inputs are part of the plan anyway
+        search = chosen is None
+        self.specs = self._resolve(chosen or {})
+        while search:
+            alternatives = {}
+            for name in self.specs:
+                for alt in FEATURE_REGISTRY[name].alternatives:
+                    if all(i in self.specs for i in alt.inputs) and \
+                            name not in self._upstream(alt.inputs):
+                        alternatives[name] = alt
+                        break
+            specs = self._resolve(alternatives)
+            if specs.keys() == self.specs.keys() and \
+                    all(specs[n] is self.specs[n] for n in specs):
+                break
+            self.specs = specs
+
+        self.steps = self._toposort()
+        self.consumers = {name: 0 for name in self.steps}
+        for name in self.steps:
+            for i in self.specs[name].inputs:
+                if i != IMAGE:
+                    self.consumers[i] += 1
+
+        self.total_radius = {}
+        for name in self.steps:
+            spec = self.specs[name]
+            self.total_radius[name] = spec.radius + max(
+                (self.total_radius.get(i, 0) for i in spec.inputs), default=0)
+        self.radius = max((self.total_radius[f] for f in self.features), default=0)
+
+    def _resolve(self, chosen):
+        # Depth-first walk from the outputs over the inputs of each node
+        specs = {}
+        def visit(name):
+            if name == IMAGE or name in specs:
+                return
+            spec = chosen.get(name, FEATURE_REGISTRY[name])
+            specs[name] = spec
+            for i in spec.inputs:
+                visit(i)
+        for name in self.features:
+            visit(name)
+        return specs
+
+    def _upstream(self, names):
+        # All nodes the given nodes depend on in the current plan
+        seen = set()
+        stack = [n for n in names if n != IMAGE]
+        while stack:
+            name = stack.pop()
+            if name in seen or name not in self.specs:
+                continue
+            seen.add(name)
+            stack.extend(i for i in self.specs[name].inputs if i != IMAGE)
+        return seen
+
+    def _toposort(self):
+        # Inputs are placed right before their first consumer, which keeps
+        # intermediates alive for as short as possible in serial execution
+        order = []
+        done = set()
+        def visit(name):
+            if name == IMAGE or name in done:
+                return
+            for i in self.specs[name].inputs:
+                visit(i)
+            done.add(name)
+            order.append(name)
+        for name in self.features:
+            visit(name)
+        return order
+
+    def subplan(self, features):
+        '''
+        Plan a subset of the features, computing them the same way as here.
+
+        Args:
+            features: Names of features of this plan
+
+        Returns:
+            FeaturePlan: Plan for features with the node choices of self
+        '''
+        return FeaturePlan(features, chosen=self.specs)
+
+    @property
+    def cost(self):
+        """Relative cost of the whole plan."""
+        return sum(self.specs[name].cost for name in self.steps)
+
+    def signature(self, name):
+        '''
+        Describe how a node is computed, including all its inputs.
+
+        Args:
+            name: Node name
+
+        Returns:
+            tuple: Nested description, used as part of cache keys
+        '''
+        if name == IMAGE:
+            return IMAGE
+        spec = self.specs[name]
+        return (name, spec.func.__qualname__, sorted(spec.params.items()),
+                tuple(self.signature(i) for i in spec.inputs))
+
+    def feature_costs(self, profile):
+        '''
+        Attribute the measured cost of every node to the requested features.
+
+        The cost of a node shared by several features is split evenly
+        between the features depending on it.
+
+        Args:
+            profile: Measurements of execute, see its profile argument
+
+        Returns:
+            dict: {'seconds', 'bytes'} per requested feature, bytes being
+                  the largest result on the way to the feature
+        '''
+        costs = {f: {'seconds': 0.0, 'bytes': 0} for f in self.features}
+        for name in self.steps:
+            if name not in profile:
+                continue
+            users = [f for f in self.features if name in self._upstream([f])]
+            for f in users:
+                costs[f]['seconds'] += profile[name]['seconds'] / len(users)
+                costs[f]['bytes'] = max(costs[f]['bytes'], profile[name]['bytes'])
+        return costs
+
+    def peak_bytes(self, image_shape):
+        '''
+        Estimate the peak memory of the intermediate results in serial
+        execution, excluding the image and the output matrix.
+
+        Args:
+            image_shape: Shape of the image
+
+        Returns:
+            int: Estimated peak number of bytes
+        '''
+        n_pixels = int(np.prod(image_shape))
+        def nbytes(spec):
+            return int(n_pixels * spec.planes * spec.dtype.itemsize)
+        remaining = dict(self.consumers)
+        live, peak = 0, 0
+        for name in self.steps:
+            spec = self.specs[name]
+            live += nbytes(spec)
+            peak = max(peak, live)
+            if remaining[name] == 0:
+                live -= nbytes(spec)
+            for i in spec.inputs:
+                if i != IMAGE:
+                    remaining[i] -= 1
+                    if remaining[i] == 0:
+                        live -= nbytes(self.specs[i])
+        return peak
+
+    def _run(self, steps, sources, on_result, n_jobs, context, profile):
+        # Compute steps from the given source results, freeing every result
+        # as soon as its last consumer among the steps has finished
+        step_set = set(steps)
+        results = dict(sources)
+        remaining = {name: 0 for name in steps}
+        for name in steps:
+            for i in self.specs[name].inputs:
+                if i in step_set:
+                    remaining[i] += 1
+        lock = threading.Lock()
+
+        def run(name):
+            spec = self.specs[name]
+            with lock:
+                args = [results[i] for i in spec.inputs]
+            start = time.perf_counter()
+            plane = spec.compute(*args, context=context)
+            if profile is not None:
+                seconds = time.perf_counter() - start
+                with lock:
+                    entry = profile.setdefault(name, {'seconds': 0.0, 'bytes': 0})
+                    entry['seconds'] += seconds
+                    entry['bytes'] = max(entry['bytes'], _nbytes(plane))
+            on_result(name, plane)
+            with lock:
+                # Keep the result only while somebody still needs it
+                if remaining[name] > 0:
+                    results[name] = plane
+                for i in spec.inputs:
+                    if i in step_set:
+                        remaining[i] -= 1
+                        if remaining[i] == 0:
+                            del results[i]
+
+        # Expensive chains first so that they do not end up last
+        priority = {}
+        for name in reversed(steps):
+            downstream = [priority[n] for n in steps
+                          if name in self.specs[n].inputs]
+            priority[name] = self.specs[name].cost + max(downstream, default=0)
+
+        run_graph(steps, {n: self.specs[n].inputs for n in steps},
+                  run, n_jobs=n_jobs, priority=priority)
+
+    def execute(self, img_i, on_output, n_jobs=-1, context=None, profile=None):
+        '''
+        Compute every node of the plan on an image.
+
+        Args:
+            img_i: Image (2D NumPy array)
+            on_output: Callback on_output(name, plane) for every requested
+                       feature, called from worker threads when n_jobs != 1
+            n_jobs: Number of threads, see resolve_n_jobs (default=-1)
+            context: Position context for features depending on the pixel
+                     position, defaults to the whole image
+            profile: Optional dict, receives {'seconds', 'bytes'} per node.
+                     Seconds add up and bytes keep their maximum over
+                     repeated calls, e.g. for the tiles of an image
+        '''
+        if context is None:
+            context = {'origin': (0, 0), 'full_shape': img_i.shape[-2:]}
+
+        outputs = set(self.features)
+        def on_result(name, plane):
+            if name in outputs:
+                on_output(name, plane)
+
+        self._run(self.steps, {IMAGE: img_i}, on_result, n_jobs, context, profile)
+
+    def execute_stack(self, stack_i, on_output, n_jobs=-1, context=None, profile=None):
+        '''
+        Compute every node of the plan on a stack of equally sized images.
+
+        Nodes registered with stack=True (and fed only by such nodes) are
+        called once for the whole (N, H, W) stack. The remaining nodes are
+        computed image by image, with the images spread over the threads.
+
+        Args:
+            stack_i: Stack of images (3D NumPy array, N x H x W)
+            on_output: Callback on_output(name, planes) for every requested
+                       feature with its (N, H, W) planes
+            n_jobs: Number of threads, see resolve_n_jobs (default=-1)
+            context: Position context, see execute
+            profile: Optional dict receiving the time and memory per node,
+                     see execute
+        '''
+        if context is None:
+            context = {'origin': (0, 0), 'full_shape': stack_i.shape[-2:]}
+        outputs = set(self.features)
+
+        # Nodes that can be computed on the whole stack at once
+        stackwise = set()
+        for name in self.steps:
+            spec = self.specs[name]
+            if spec.stack and all(i == IMAGE or i in stackwise for i in spec.inputs):
+                stackwise.add(name)
+        slicewise = [name for name in self.steps if name not in stackwise]
+        needed = {i for name in slicewise for i in self.specs[name].inputs}
+
+        # Whole-stack part, keeping what the image by image part consumes
+        shared = {IMAGE: stack_i}
+        def on_stack_result(name, planes):
+            if name in outputs:
+                on_output(name, planes)
+            if name in needed:
+                shared[name] = planes
+        self._run([n for n in self.steps if n in stackwise], {IMAGE: stack_i},
+                  on_stack_result, n_jobs, context, profile)
+        if not slicewise:
+            return
+
+        # Image by image part, the outputs are collected into stacks
+        stacked = {}
+        lock = threading.Lock()
+        def process_image(index):
+            sources = {name: _take(result, index) for name, result in shared.items()
+                       if name in needed}
+            def on_image_result(name, plane):
+                if name not in outputs:
+                    return
+                with lock:
+                    if name not in stacked:
+                        stacked[name] = np.empty((len(stack_i),) + plane.shape, plane.dtype)
+                stacked[name][index] = plane
+            self._run(slicewise, sources, on_image_result, 1, context, profile)
+        run_parallel(process_image, range(len(stack_i)), n_jobs=n_jobs)
+        for name in self.features:
+            if name in stacked:
+                on_output(name, stacked.pop(name))
@@ -0,0 +1,145 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Background precomputation of feature planes. While the user
+#              annotates, a low priority worker thread extracts the selected
+#              features of the loaded images into the feature cache, the
+#              current image and its neighbours first, so that train,
+#              predict and the Automation Manager mostly read cached planes.
+#              Only the missing planes are computed and written to the cache,
+#              no feature matrix is built.
+#              A new selection or current image reorders the remaining work.
+##############################################################################
+"""Speculative background feature precomputation"""
+# Import packages
+import os
+import threading
+from pathlib import Path
+from asmgui.randomforest_classifier.feature_space import fill_feature_cache
+
+def neighbour_order(n_items, current):
+    '''
+    Order item indices by their distance to the current one.
+
+    Args:
+        n_items: Number of items
+        current: Index of the current item
+
+    Returns:
+        list: current, current+1, current-1, current+2, ...
+    '''
+    current = min(max(int(current), 0), max(n_items - 1, 0))
+    return sorted(range(n_items), key=lambda i: (abs(i - current), i < current))
+
+def _lower_thread_priority():
+    # Linux schedules threads individually, and threads started from here
+    # (the feature executor's workers) inherit the priority
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError):
+        pass
+
+class FeaturePrefetcher:
+    """
+    Low priority worker filling the feature cache ahead of time.
+
+    Attributes:
+        load_image (callable): Loads the classifier input of an image path
+        n_jobs (int): Threads used per image, see resolve_n_jobs
+        tile_size (int): Images with more pixels than one tile are skipped,
+                         as tiled extraction does not use the cache
+    """
+
+    def __init__(self, load_image, n_jobs=-2, tile_size=None):
+        """
+        Initialize FeaturePrefetcher, the worker starts on the first schedule.
+
+        Args:
+            load_image: Function returning the 2D image of a path
+            n_jobs: Threads used per image (default=-2, all cores but one)
+            tile_size: Tile edge length of the foreground extraction
+                       (default=None)
+        """
+        self.load_image = load_image
+        self.n_jobs = n_jobs
+        self.tile_size = tile_size
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._queue = []
+        self._features = []
+        self._cache = None
+        self._key = None
+        self._paused = False
+        self._done = set()
+        self._thread = None
+
+    def schedule(self, paths, features, cache, current=0):
+        '''
+        Replace the pending work, starting with the current image.
+
+        Images already prefetched with the same features and cache are
+        not queued again. An image in progress is finished first.
+
+        Args:
+            paths: Image paths, in display order
+            features: List of selected feature names
+            cache: FeatureCache receiving the planes
+            current: Index of the current image (default=0)
+        '''
+        paths = [str(p) for p in paths]
+        key = (tuple(features), str(cache.cache_dir))
+        with self._lock:
+            # Images are done for one selection and cache folder only
+            if key != self._key:
+                self._done = set()
+            self._features, self._cache, self._key = list(features), cache, key
+            self._queue = [paths[i] for i in neighbour_order(len(paths), current)
+                           if paths[i] not in self._done]
+            self._paused = False
+            self._wake.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True,
+                                                name='feature prefetch')
+                self._thread.start()
+
+    def pause(self):
+        '''Stop after the image in progress until the next schedule or resume.'''
+        with self._lock:
+            self._paused = True
+
+    def resume(self):
+        '''Continue with the pending images.'''
+        with self._lock:
+            self._paused = False
+            self._wake.notify()
+
+    @property
+    def pending(self):
+        """Number of images still to prefetch."""
+        with self._lock:
+            return len(self._queue)
+
+    def _next(self):
+        # Block until there is work and the worker is not paused
+        with self._lock:
+            while self._paused or not self._queue or not self._features:
+                self._wake.wait()
+            return self._queue.pop(0), list(self._features), self._cache, self._key
+
+    def _run(self):
+        _lower_thread_priority()
+        while True:
+            path, features, cache, key = self._next()
+            try:
+                img = self.load_image(path)
+                if self.tile_size is None or img.size <= self.tile_size**2:
+                    fill_feature_cache(img, features, cache, n_jobs=self.n_jobs)
+            except Exception as error:  # A broken image must not stop the worker
+                print(f"Feature prefetch of {Path(path).name} failed: {error}")
+                continue
+            with self._lock:
+                # Only counts if the selection did not change meanwhile
+                if key == self._key:
+                    self._done.add(path)
+                remaining = len(self._queue)
+            print(f"Prefetched features of {Path(path).name}, {remaining} images left")
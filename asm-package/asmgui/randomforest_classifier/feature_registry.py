@@ -0,0 +1,157 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Registry of the features (and the intermediate results they
+#              are computed from). Every entry declares its inputs, filter
+#              parameters, kernel radius, output dtype and relative cost so
+#              that the planner in feature_planner.py can share work
+#              between features. New filters only have to be registered
+#              here to show up in the GUI.
+##############################################################################
+"""Registry of image features and intermediate results"""
+# Import packages
+import numpy as np
+
+# Name of the source node, i.e. the image the features are extracted from
+IMAGE = 'image'
+
+class FeatureSpec:
+    """
+    Declaration of a feature or of an intermediate result.
+
+    Attributes:
+        name (str): Unique name, shown in the GUI for selectable features
+        func (callable): func(*inputs, **params) returning a plane with the
+                         shape of the image
+        inputs (tuple): Names of the nodes func consumes, IMAGE for the image
+        params (dict): Filter parameters passed to func, part of cache keys
+        radius (int): Kernel radius of func in pixels relative to its inputs
+        dtype (np.dtype): Data type of the output
+        cost (float): Relative cost, a Gaussian σ=3 pass is 1.0
+        selectable (bool): Shown in the FeatureSelector, False for
+                           intermediate results
+        default (bool): Selected by default in the FeatureSelector
+        context (bool): func also receives context=dict(origin, full_shape),
+                        for features depending on the pixel position
+        cache (bool): Worth storing in the FeatureCache
+        planes (float): Number of image-sized planes the output holds, for
+                        nodes returning several planes at once, a fraction
+                        for downsampled outputs
+        stack (bool): func also accepts a stack of images (N, H, W) and
+                      filters every image separately, in one call. Other
+                      nodes are called image by image for stacks
+        volume (bool): Volumetric feature, func filters a (Z, H, W) block
+                       of a volume in all three dimensions and radius also
+                       holds along z. Only used by feature_extraction_volume
+        alternatives (list): Other ways to compute the same output, used by
+                             the planner when their inputs are computed anyway
+    """
+
+    def __init__(self, name, func, inputs=(IMAGE,), params=None, radius=0,
+                 dtype=np.float32, cost=1.0, selectable=True, default=True,
+                 context=False, cache=True, planes=1, stack=False, volume=False):
+        """
+        Initialize FeatureSpec, see the class attributes for the arguments.
+        """
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.params = dict(params or {})
+        self.radius = int(radius)
+        self.dtype = np.dtype(dtype)
+        self.cost = float(cost)
+        self.selectable = selectable
+        self.default = default
+        self.context = context
+        self.cache = cache
+        self.planes = planes
+        self.stack = stack
+        self.volume = volume
+        self.alternatives = []
+
+    def __repr__(self):
+        return f"FeatureSpec({self.name!r}, inputs={self.inputs})"
+
+    def compute(self, *inputs, context=None):
+        """
+        Compute the output of the node from its input arrays.
+
+        Args:
+            inputs: Input arrays, in the order of self.inputs
+            context: Position context, passed on if self.context is set
+
+        Returns:
+            np.ndarray: Output plane
+        """
+        if self.context:
+            return self.func(*inputs, context=context, **self.params)
+        return self.func(*inputs, **self.params)
+
+# Registered features by name, in registration (= GUI) order
+FEATURE_REGISTRY = {}
+
+def register_feature(name, inputs=(IMAGE,), params=None, radius=0,
+                     dtype=np.float32, cost=1.0, selectable=True, default=True,
+                     context=False, cache=True, planes=1, stack=False, volume=False):
+    '''
+    Decorator registering a function as a feature or intermediate result.
+
+    Args:
+        name: Unique name of the node
+        See FeatureSpec for the remaining arguments
+
+    Returns:
+        decorator: Registers and returns the decorated function unchanged
+    '''
+    def decorator(func):
+        if name in FEATURE_REGISTRY:
+            raise ValueError(f"Feature {name!r} is already registered")
+        FEATURE_REGISTRY[name] = FeatureSpec(
+            name, func, inputs=inputs, params=params, radius=radius,
+            dtype=dtype, cost=cost, selectable=selectable, default=default,
+            context=context, cache=cache, planes=planes, stack=stack,
+            volume=volume)
+        return func
+    return decorator
+
+def register_alternative(name, inputs, params=None, radius=0, cost=1.0, stack=False):
+    '''
+    Decorator registering another way to compute an existing node.
+
+    The planner uses the alternative instead of the registered function
+    whenever all of its inputs are part of the plan anyway, e.g. to derive
+    a wide Gaussian from a narrower one that is already computed.
+
+    Args:
+        name: Name of the registered node
+        inputs: Names of the nodes the alternative consumes
+        params: Filter parameters of the alternative
+        radius: Kernel radius of the alternative relative to its inputs
+        cost: Relative cost of the alternative
+        stack: The alternative accepts stacks of images, see FeatureSpec
+
+    Returns:
+        decorator: Registers and returns the decorated function unchanged
+    '''
+    def decorator(func):
+        spec = FEATURE_REGISTRY[name]
+        spec.alternatives.append(FeatureSpec(
+            name, func, inputs=inputs, params=params, radius=radius,
+            dtype=spec.dtype, cost=cost, selectable=spec.selectable,
+            default=spec.default, context=spec.context, cache=spec.cache,
+            planes=spec.planes, stack=stack, volume=spec.volume))
+        return func
+    return decorator
+
+def feature_names():
+    '''
+    Return the names of all selectable features, in GUI order.
+    '''
+    return [name for name, spec in FEATURE_REGISTRY.items() if spec.selectable]
+
+def default_features():
+    '''
+    Return the names of the features selected by default.
+    '''
+    return [name for name, spec in FEATURE_REGISTRY.items()
+            if spec.selectable and spec.default]
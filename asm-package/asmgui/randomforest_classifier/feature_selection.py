@@ -0,0 +1,109 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Cost-aware feature pruning. The features are ranked by their
+#              random forest importance per millisecond of extraction time
+#              and the shortest prefix of that ranking whose validation
+#              accuracy stays within a tolerance of the full feature set is
+#              kept, so that expensive features adding little are dropped.
+#              A feature with several columns, one per channel in channel
+#              mode, is ranked and kept as a whole. The validation rows come
+#              from other images than the training rows when the images of
+#              the rows are known.
+#
+# References:  https://scikit-learn.org/stable/modules/generated/sklearn.ensemble.
+# RandomForestClassifier.html
+##############################################################################
+"""Cost-aware automatic feature selection"""
+# Import packages
+from sklearn.model_selection import GroupShuffleSplit, train_test_split
+from sklearn import metrics
+import numpy as np
+from asmgui.randomforest_classifier.training_functions import build_forest
+
+def prune_features(x_i, y_i, names_i, costs_i, owners_i=None, groups_i=None,
+                   tolerance=0.01, nest=10, forest_params=None):
+    '''
+    Find the cheapest subset of features that is about as accurate as all.
+
+    The features are ranked by importance per millisecond and prefixes of
+    the ranking are searched by bisection for the shortest one within the
+    tolerance, which assumes accuracy does not drop when features are added.
+
+    Args:
+        x_i: Feature matrix of the labeled pixels, (n_rows, n_columns)
+        y_i: Labels of the rows
+        names_i: Column names of x_i
+        costs_i: {'seconds', 'bytes'} per feature, see FeaturePlan.feature_costs
+        owners_i: Optional feature name per column name, e.g. 'Sobel' for
+                  'Sobel (G)' in channel mode. None if every column is a
+                  feature of its own
+        groups_i: Optional image index of every row. The validation rows
+                  are then taken from other images than the training rows
+        tolerance: Accepted loss of validation accuracy (default=0.01)
+        nest: Number of decision trees (default=10)
+        forest_params: Optional dict of random forest settings, see build_forest
+
+    Returns:
+        selected: Kept feature names, in the order of the columns
+        report: Accuracies and the measured cost of every feature
+    '''
+    # Same test size and forest as train_random_forest, split by image if
+    # there is more than one
+    if groups_i is not None and len(np.unique(groups_i)) > 1:
+        split = GroupShuffleSplit(n_splits=1, test_size=0.4, random_state=20)
+        train, test = next(split.split(x_i, y_i, groups_i))
+        x_train, x_test, y_train, y_test = x_i[train], x_i[test], y_i[train], y_i[test]
+    else:
+        x_train, x_test, y_train, y_test = train_test_split(x_i, y_i, test_size=0.4,
+                                                            random_state=20)
+    def score(columns):
+        model = build_forest(dict({'n_estimators': nest}, **(forest_params or {})))
+        model.fit(x_train[:, columns], y_train)
+        accuracy = metrics.accuracy_score(y_test, model.predict(x_test[:, columns]))
+        return model, accuracy
+
+    # Columns of every feature, in the order of the columns
+    owners_i = owners_i or {name: name for name in names_i}
+    features, columns = [], {}
+    for j, name in enumerate(names_i):
+        feature = owners_i[name]
+        if feature not in columns:
+            features.append(feature)
+            columns[feature] = []
+        columns[feature].append(j)
+    def feature_columns(kept):
+        return sorted(j for f in kept for j in columns[f])
+
+    # Reference accuracy and importances of the full feature set, the
+    # importance of a feature is the sum over its columns
+    model, baseline = score(list(range(len(names_i))))
+    importance = {f: float(model.feature_importances_[columns[f]].sum()) for f in features}
+    milliseconds = {f: max(1000.0 * costs_i[f]['seconds'], 1e-3) for f in features}
+    ranking = sorted(features, key=lambda f: -importance[f] / milliseconds[f])
+
+    # Shortest prefix of the ranking within the tolerance
+    n_features = len(features)
+    low, high, accuracy = 1, n_features, baseline
+    while low < high:
+        middle = (low + high) // 2
+        _, middle_accuracy = score(feature_columns(ranking[:middle]))
+        if middle_accuracy >= baseline - tolerance:
+            high, accuracy = middle, middle_accuracy
+        else:
+            low = middle + 1
+
+    kept = set(ranking[:high])
+    selected = [f for f in features if f in kept]
+    report = {'tolerance': float(tolerance),
+              'baseline accuracy': float(baseline),
+              'accuracy': float(accuracy),
+              'selected': selected,
+              'milliseconds': {f: float(milliseconds[f]) for f in features},
+              'bytes': {f: int(costs_i[f]['bytes']) for f in features},
+              'importance': importance}
+    print(f"Kept {len(selected)} of {n_features} features, accuracy "
+          f"{accuracy:.3f} (all features {baseline:.3f}), extraction "
+          f"{sum(milliseconds[f] for f in selected):.0f} of "
+          f"{sum(milliseconds.values()):.0f} ms")
+    return selected, report
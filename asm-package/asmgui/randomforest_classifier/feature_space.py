@@ -1,7 +1,9 @@
 ##############################################################################
 # Author:      Jamie, Germano & Nikhil
 
-# Description: The script extracts a set of features from an image.
+# Description: The script extracts a set of features from an image. The
+#              features are declared in the registry (feature_registry.py)
+#              and computed through a FeaturePlan (feature_planner.py).
 #
 # References:  The code is heavily influenced by:
 #              https://github.com/bnsreenu/python_for_microscopists/blob/
@@ -13,79 +15,958 @@
 # Import packages
 import cv2
 import numpy as np
-import pandas as pd
 from scipy import ndimage as nd
-from skimage.filters import sobel, scharr, prewitt
+from skimage.util import img_as_float
+from asmgui.randomforest_classifier.feature_executor import run_parallel
+from asmgui.randomforest_classifier.feature_registry import FEATURE_REGISTRY
+from asmgui.randomforest_classifier.feature_registry import feature_names, default_features
+from asmgui.randomforest_classifier.feature_registry import register_feature, register_alternative
+from asmgui.randomforest_classifier.feature_planner import FeaturePlan
 
-def feature_extraction(img_i, features_i):
+class FeatureMatrix:
+    """
+    Feature matrix with one row per pixel and one named column per feature.
+
+    The values are stored in a single preallocated, C-contiguous array so
+    that sklearn can consume them without any further conversion.
+
+    Attributes:
+        values (np.ndarray): (n_pixels, n_features) array of feature values
+        names (list): Column names, in the same order as the columns
+        image_shape (tuple): Shape of the image the rows were extracted from
+    """
+
+    def __init__(self, values, names, image_shape):
+        """
+        Initialize FeatureMatrix.
+
+        Args:
+            values: (n_pixels, n_features) array of feature values
+            names: Column names, in the same order as the columns
+            image_shape: Shape of the image the rows were extracted from
+        """
+        self.values = values
+        self.names = list(names)
+        self.image_shape = tuple(image_shape)
+
+    @classmethod
+    def empty(cls, image_shape, names, dtype=np.float32):
+        """
+        Preallocate an uninitialised feature matrix for an image.
+
+        Args:
+            image_shape: Shape of the image
+            names: Column names
+            dtype: Data type of the values (default=np.float32)
+
+        Returns:
+            FeatureMatrix: Matrix with n_pixels rows and len(names) columns
+        """
+        n_pixels = int(np.prod(image_shape))
+        values = np.empty((n_pixels, len(names)), dtype=dtype, order='C')
+        return cls(values, names, image_shape)
+
+    @property
+    def shape(self):
+        """Shape of the underlying (n_pixels, n_features) array."""
+        return self.values.shape
+
+    @property
+    def dtype(self):
+        """Data type of the underlying array."""
+        return self.values.dtype
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None or np.dtype(dtype) == self.values.dtype:
+            return self.values.copy() if copy else self.values
+        return self.values.astype(dtype)
+
+    def column(self, name):
+        """
+        Return a feature column as an image-shaped view.
+
+        Args:
+            name: Feature name
+
+        Returns:
+            np.ndarray: View of the column reshaped to the image shape
+        """
+        return self.values[:, self.names.index(name)].reshape(self.image_shape)
+
+
+# --- Built-in features, see feature_registry.py for the declarations ---
+
+@register_feature('uint8 image', selectable=False, dtype=np.uint8, cost=0.1,
+                  cache=False, stack=True)
+def _uint8_image(img_i):
+    # 8-bit copy shared by the OpenCV filters, no copy for 8-bit images
+    return np.asarray(img_i, dtype=np.uint8)
+
+@register_feature('float32 image', selectable=False, cost=0.1, cache=False,
+                  stack=True)
+def _float32_image(img_i):
+    # Floating point copy shared by the Gaussian filters
+    return np.asarray(img_i, dtype=np.float32)
+
+@register_feature('Original image', dtype=np.uint8, cost=0.0, cache=False,
+                  stack=True)
+def _original_image(img_i):
+    return img_i
+
+@register_feature('r_ctr', cost=0.2, context=True, cache=False, stack=True)
+def _r_ctr(img_i, context):
+    # Same map for every image of a stack, computed once and broadcast
+    img2d = img_i[(0,) * (img_i.ndim - 2)]
+    r_ctr = compute_position_maps(img2d, context['origin'], context['full_shape'])[4]
+    return np.broadcast_to(r_ctr, img_i.shape)
+
+@register_feature('denoise', inputs=('uint8 image',),
+                  params={'h': 5, 'templateWindowSize': 7, 'searchWindowSize': 21},
+                  radius=21 // 2 + 7 // 2, dtype=np.uint8, cost=20.0)
+def _denoise(img_u8, h, templateWindowSize, searchWindowSize):
+    return cv2.fastNlMeansDenoising(img_u8, None, h, templateWindowSize,
+                                    searchWindowSize)
+
+@register_feature('Laplacian', params={'ddepth': cv2.CV_32F}, radius=1, cost=0.3)
+def _laplacian(img_i, ddepth):
+    # Integer input gives integer results, which are exact in float32
+    return cv2.Laplacian(img_i, ddepth)
+
+@register_feature('Canny Edge', inputs=('uint8 image',),
+                  params={'threshold1': 100, 'threshold2': 200},
+                  radius=2, dtype=np.uint8, cost=0.5)
+def _canny(img_u8, threshold1, threshold2):
+    return cv2.Canny(img_u8, threshold1, threshold2)
+
+def _edge_magnitude(img_i, smooth):
+    # skimage.filters.sobel/scharr/prewitt of every image of a stack, in one
+    # call: the 3x3 kernels get a leading axis of length 1, so that nothing
+    # is mixed across images. Same operations as skimage, same values
+    image = img_as_float(img_i)
+    lead = (1,) * (image.ndim - 2)
+    edge = np.array([1, 0, -1])
+    magnitude = np.zeros(image.shape, dtype=image.dtype)
+    for kernel in (np.reshape(edge, lead + (3, 1)) * np.reshape(smooth, lead + (1, 3)),
+                   np.reshape(edge, lead + (1, 3)) * np.reshape(smooth, lead + (3, 1))):
+        derivative = nd.convolve(image, kernel, mode='reflect')
+        derivative *= derivative
+        magnitude += derivative
+    return np.sqrt(magnitude) / np.sqrt(2, dtype=magnitude.dtype)
+
+@register_feature('Sobel', params={'smooth': (0.25, 0.5, 0.25)}, radius=1,
+                  dtype=np.float64, cost=1.0, stack=True)
+def _sobel(img_i, smooth):
+    return _edge_magnitude(img_i, smooth)
+
+@register_feature('Scharr', params={'smooth': (0.1875, 0.625, 0.1875)}, radius=1,
+                  dtype=np.float64, cost=1.0, stack=True)
+def _scharr(img_i, smooth):
+    return _edge_magnitude(img_i, smooth)
+
+@register_feature('Prewitt', params={'smooth': (1 / 3, 1 / 3, 1 / 3)}, radius=1,
+                  dtype=np.float64, cost=1.0, stack=True)
+def _prewitt(img_i, smooth):
+    return _edge_magnitude(img_i, smooth)
+
+def _gaussian(img_f, sigma):
+    # No smoothing across the images of a stack
+    sigmas = (0,) * (img_f.ndim - 2) + (sigma, sigma)
+    return nd.gaussian_filter(img_f, sigma=sigmas)
+
+register_feature('Gaussian σ=3', inputs=('float32 image',), params={'sigma': 3},
+                 radius=int(4.0 * 3 + 0.5), cost=1.0, stack=True)(_gaussian)
+register_feature('Gaussian σ=7', inputs=('float32 image',), params={'sigma': 7},
+                 radius=int(4.0 * 7 + 0.5), cost=2.2, stack=True)(_gaussian)
+# Gaussians compose, σ=7 is σ=3 followed by σ=sqrt(7²-3²)
+register_alternative('Gaussian σ=7', inputs=('Gaussian σ=3',),
+                     params={'sigma': np.sqrt(7**2 - 3**2)},
+                     radius=int(4.0 * np.sqrt(7**2 - 3**2) + 0.5), cost=2.0,
+                     stack=True)(_gaussian)
+
+@register_feature('Median size=3', params={'size': 3}, radius=1, dtype=np.uint8,
+                  cost=0.5, stack=True)
+def _median(img_i, size):
+    # No filtering across the images of a stack
+    return nd.median_filter(img_i, size=(1,) * (img_i.ndim - 2) + (size, size))
+
+# --- Additional feature families, registered after the built-ins ---
+from asmgui.randomforest_classifier import scale_space  # noqa: E402,F401
+from asmgui.randomforest_classifier import filter_bank  # noqa: E402,F401
+from asmgui.randomforest_classifier import local_statistics  # noqa: E402,F401
+from asmgui.randomforest_classifier import local_binary_patterns  # noqa: E402,F401
+from asmgui.randomforest_classifier import volume_features  # noqa: E402,F401
+# Last, the pyramid offers some of the features above at coarse levels
+from asmgui.randomforest_classifier import pyramid  # noqa: E402,F401
+
+
+# Skip messages already shown, the selection is checked on every
+# fingerprint and extraction
+_REPORTED_SKIPS = set()
+
+def _report_skipped(message):
+    if message not in _REPORTED_SKIPS:
+        _REPORTED_SKIPS.add(message)
+        print(message)
+
+def select_features(features_i, volume=False):
+    '''
+    Keep the registered, selectable features of a list.
+
+    Args:
+        features_i: List of feature names
+        volume: Also keep volumetric features, which need a whole volume
+                and are skipped for 2D images (default=False)
+
+    Returns:
+        list: Known features, in the order of features_i
+    '''
+    features = []
+    for feature in features_i:
+        spec = FEATURE_REGISTRY.get(feature)
+        if spec is None or not spec.selectable:
+            _report_skipped(f" Unknown feature skipped: {feature}")
+        elif spec.volume and not volume:
+            _report_skipped(f" Volume feature skipped for 2D image: {feature}")
+        else:
+            features.append(feature)
+    return features
+
+
+def feature_extraction(img_i, features_i, dtype=np.float32, cache=None, n_jobs=-1,
+                       tile_size=None, profile=None):
     '''
     Extract selected features from an image.
 
+    The features are computed through a FeaturePlan, which computes shared
+    intermediate results once and frees them after their last use. Every
+    feature plane is written straight into its column of one preallocated
+    (n_pixels, n_features) array, so no per-feature copies are kept around
+    and sklearn does not need to convert the result again.
+
     Args:
         img_i: Original image (2D NumPy array)
         features_i: List of selected feature names
+        dtype: Data type of the feature matrix, np.float32 (default) matches
+               what RandomForestClassifier uses internally, np.float64 can
+               be used for verification
+        cache: Optional FeatureCache, cached planes are read memory-mapped
+               straight into their column and only missing planes are
+               computed (and then stored)
+        n_jobs: Number of threads computing feature planes concurrently,
+                -1 (default) uses all cores and 1 computes the planes one
+                after another in the calling thread
+        tile_size: If set and the image has more pixels than one tile, extract
+                   tile by tile with feature_extraction_tiled instead. The
+                   cache is not used in that case
+        profile: Optional dict receiving the time and memory of every
+                 computed node, see FeaturePlan.execute
 
     Returns:
-        df: DataFrame containing selected features
+        x: FeatureMatrix containing the selected features, in the order
+           of features_i
     '''
 
+    # Large images are processed in tiles to bound the peak memory
+    if tile_size is not None and img_i.size > tile_size * tile_size:
+        return feature_extraction_tiled(img_i, features_i, tile_size=tile_size,
+                                        dtype=dtype, n_jobs=n_jobs, profile=profile)
+
     print('inside feature_extraction')
 
-    # Always include Original image
-    #data = {'Original image': img_i.reshape(-1)}
-    data = {}
-    
-    # --- relative position features (computed once, reused if requested) ---
-    need_pos = any(f in features_i for f in ("x_rel","y_rel","x_ctr","y_ctr","r_ctr"))
-    if need_pos:
-        x_rel, y_rel, x_ctr, y_ctr, r_ctr = compute_position_maps(img_i)
+    # Keep only known features, in the requested order
+    features = select_features(features_i)
 
-    # Add only selected features
-    for feature in features_i:
-        if feature == 'Original image':
-            processed = np.copy(img_i)
-        #elif feature == "x_rel":
-        #    processed = x_rel
-        #elif feature == "y_rel":
-        #    processed = y_rel
-        #elif feature == "x_ctr":
-        #    processed = x_ctr
-        #elif feature == "y_ctr":
-        #    processed = y_ctr
-        elif feature == "r_ctr":
-            processed = r_ctr
-        elif feature == 'denoise':
-            processed = cv2.fastNlMeansDenoising(np.uint8(img_i), None, 5, 7, 21)
-        elif feature == 'Laplacian':
-            processed = cv2.Laplacian(img_i, cv2.CV_64F)
-        elif feature == 'Canny Edge':
-            processed = cv2.Canny(np.uint8(img_i), 100, 200)
-        elif feature == 'Sobel':
-            processed = sobel(img_i)
-        elif feature == 'Scharr':
-            processed = scharr(img_i)
-        elif feature == 'Prewitt':
-            processed = prewitt(img_i)
-        elif feature == 'Gaussian σ=3':
-            processed = nd.gaussian_filter(img_i, sigma=3)
-        elif feature == 'Gaussian σ=7':
-            processed = nd.gaussian_filter(img_i, sigma=7)
-        elif feature == 'Median size=3':
-            processed = nd.median_filter(img_i, size=3)
+    # Preallocate the output matrix
+    x = FeatureMatrix.empty(img_i.shape, features, dtype=dtype)
+    column = {feature: j for j, feature in enumerate(features)}
+
+    # Read cached planes straight into their columns, plan the rest
+    plan = FeaturePlan(features)
+    keys = {}
+    missing = features
+    if cache is not None:
+        image_key = cache.image_key(img_i)
+        for feature in features:
+            if not FEATURE_REGISTRY[feature].cache:
+                continue
+            keys[feature] = cache.plane_key(image_key, feature,
+                                            {'plan': plan.signature(feature)})
+            plane = cache.load(keys[feature])
+            if plane is not None:
+                x.values[:, column[feature]] = plane.reshape(-1)
+                del keys[feature]
+        missing = [f for f in features if f in keys or not FEATURE_REGISTRY[f].cache]
+
+    def on_output(feature, plane):
+        x.values[:, column[feature]] = plane.reshape(-1)
+        if feature in keys:
+            cache.store(keys[feature], plane)
+
+    # Independent nodes of the plan run concurrently
+    plan.subplan(missing).execute(img_i, on_output, n_jobs=n_jobs, profile=profile)
+
+    return x
+
+def fill_feature_cache(img_i, features_i, cache, n_jobs=-1):
+    '''
+    Compute the missing cached planes of an image without building a
+    feature matrix, e.g. to fill the cache ahead of feature_extraction.
+
+    Args:
+        img_i: Input 2D image
+        features_i: List of selected feature names
+        cache: FeatureCache receiving the planes
+        n_jobs: Number of threads, see feature_extraction (default=-1)
+
+    Returns:
+        int: Number of planes stored
+    '''
+    # Same plan and keys as feature_extraction, features that are not
+    # cached are not computed at all
+    features = select_features(features_i)
+    plan = FeaturePlan(features)
+    image_key = cache.image_key(img_i)
+    keys = {}
+    for feature in features:
+        if not FEATURE_REGISTRY[feature].cache:
+            continue
+        key = cache.plane_key(image_key, feature, {'plan': plan.signature(feature)})
+        if cache.load(key) is None:
+            keys[feature] = key
+    if not keys:
+        return 0
+
+    def on_output(feature, plane):
+        cache.store(keys[feature], plane)
+
+    plan.subplan(list(keys)).execute(img_i, on_output, n_jobs=n_jobs)
+    return len(keys)
+
+
+def feature_extraction_stack(stack_i, features_i, dtype=np.float32, cache=None,
+                             n_jobs=-1, batch_size=16, out=None, profile=None):
+    '''
+    Extract selected features from a stack of equally sized images.
+
+    The stack is processed in batches of images. Filters that support it
+    run once per batch on the (n, H, W) block, the others image by image,
+    see FeaturePlan.execute_stack. Rows are ordered image by image, the
+    result equals the feature matrices of feature_extraction on every
+    image, stacked on top of each other.
+
+    Args:
+        stack_i: Images (3D NumPy array N x H x W, or np.memmap of one)
+        features_i: List of selected feature names
+        dtype: Data type of the feature matrix (default=np.float32)
+        cache: Optional FeatureCache, shared with feature_extraction since
+               planes are cached per image
+        n_jobs: Number of threads (default=-1)
+        batch_size: Number of images read and filtered at once, bounds the
+                    memory of the intermediate results (default=16)
+        out: Optional preallocated C-contiguous (N*H*W, n_features) array
+             to write into, e.g. from np.lib.format.open_memmap
+        profile: Optional dict receiving the time and memory of every
+                 computed node, see FeaturePlan.execute
+
+    Returns:
+        x: FeatureMatrix containing the selected features of all images
+    '''
+
+    print('inside feature_extraction_stack')
+
+    # Keep only known features, in the requested order
+    features = select_features(features_i)
+    column = {feature: j for j, feature in enumerate(features)}
+
+    # Preallocate the output matrix, or wrap the one we were given
+    if out is None:
+        x = FeatureMatrix.empty(stack_i.shape, features, dtype=dtype)
+    else:
+        x = FeatureMatrix(out, features, stack_i.shape)
+    x_stack = x.values.reshape(stack_i.shape + (len(features),))
+
+    plan = FeaturePlan(features)
+    for start in range(0, len(stack_i), batch_size):
+        batch = np.asarray(stack_i[start:start + batch_size])
+        x_batch = x_stack[start:start + len(batch)]
+
+        # Read cached planes, a feature is computed for the whole batch if
+        # any of its images misses it
+        keys = {}
+        missing = features
+        if cache is not None:
+            image_keys = [cache.image_key(img) for img in batch]
+            for feature in features:
+                if not FEATURE_REGISTRY[feature].cache:
+                    continue
+                signature = {'plan': plan.signature(feature)}
+                planes = [cache.load(cache.plane_key(k, feature, signature))
+                          for k in image_keys]
+                if all(p is not None for p in planes):
+                    for i, plane in enumerate(planes):
+                        x_batch[i, ..., column[feature]] = plane
+                else:
+                    keys[feature] = {i: cache.plane_key(k, feature, signature)
+                                     for i, (k, p) in enumerate(zip(image_keys, planes))
+                                     if p is None}
+            missing = [f for f in features if f in keys or not FEATURE_REGISTRY[f].cache]
+
+        def on_output(feature, planes):
+            x_batch[..., column[feature]] = planes
+            for i, key in keys.get(feature, {}).items():
+                cache.store(key, planes[i])
+
+        plan.subplan(missing).execute_stack(batch, on_output, n_jobs=n_jobs,
+                                            profile=profile)
+
+    return x
+
+
+# Default names of the channels of colour images
+RGB_CHANNELS = ('R', 'G', 'B')
+
+def _channel_names(img_i, channel_names):
+    # Given names, or R, G, B for colour images and ch0, ch1, ... otherwise
+    n_channels = img_i.shape[0]
+    if channel_names is not None:
+        return list(channel_names)
+    if n_channels == len(RGB_CHANNELS):
+        return list(RGB_CHANNELS)
+    return [f'ch{c}' for c in range(n_channels)]
+
+def _channel_columns(features, channel_names):
+    # One column per feature and channel, position features only once as
+    # they do not depend on the pixel values
+    names, columns = [], {}
+    for feature in features:
+        if FEATURE_REGISTRY[feature].context:
+            columns[feature] = [len(names)]
+            names.append(feature)
         else:
-            print(f" Unknown feature skipped: {feature}")
+            columns[feature] = list(range(len(names), len(names) + len(channel_names)))
+            names.extend(f'{feature} ({c})' for c in channel_names)
+    return names, columns
+
+def channel_feature_names(features_i, channel_names):
+    '''
+    Column names of a multi-channel feature matrix.
+
+    Args:
+        features_i: List of selected feature names
+        channel_names: Names of the channels
+
+    Returns:
+        list: '<feature> (<channel>)' per feature and channel
+    '''
+    return _channel_columns(select_features(features_i), list(channel_names))[0]
+
+def _unique_channels(img_i):
+    # Identical channels, e.g. a grey image stored as RGB, are computed once.
+    # Returns the distinct channels and the index of each channel among them
+    unique, source = [], []
+    for channel in img_i:
+        for j, other in enumerate(unique):
+            if np.array_equal(channel, other):
+                source.append(j)
+                break
+        else:
+            source.append(len(unique))
+            unique.append(channel)
+    return np.stack(unique), source
+
+
+def feature_extraction_channels(img_i, features_i, channel_names=None,
+                                dtype=np.float32, n_jobs=-1, profile=None):
+    '''
+    Extract selected features from every channel of a multi-channel image.
+
+    The channels are an extra leading axis: filters registered with
+    stack=True process all channels in one call, the others channel by
+    channel, see FeaturePlan.execute_stack. Position features are computed
+    once and identical channels only once. Batching saves calls, not pixel
+    work: C distinct channels cost about C times one channel.
+
+    Args:
+        img_i: Channels (3D NumPy array C x H W), e.g. RGB or SE+BSE
+        features_i: List of selected feature names
+        channel_names: Names of the channels used as column suffixes,
+                       defaults to R, G, B for three channels and ch0,
+                       ch1, ... otherwise
+        dtype: Data type of the feature matrix (default=np.float32)
+        n_jobs: Number of threads (default=-1)
+        profile: Optional dict receiving the time and memory of every
+                 computed node, see FeaturePlan.execute
+
+    Returns:
+        x: FeatureMatrix with one row per pixel and one column per feature
+           and channel, named '<feature> (<channel>)'
+    '''
+
+    print('inside feature_extraction_channels')
+
+    # Keep only known features, in the requested order
+    features = select_features(features_i)
+    names, columns = _channel_columns(features, _channel_names(img_i, channel_names))
+
+    # Preallocate the output matrix
+    x = FeatureMatrix.empty(img_i.shape[1:], names, dtype=dtype)
+    x_image = x.values.reshape(img_i.shape[1:] + (len(names),))
+    unique, source = _unique_channels(np.asarray(img_i))
+
+    def on_output(feature, planes):
+        cols = columns[feature]
+        if len(cols) == 1:
+            x_image[..., cols[0]] = planes[0]
+            return
+        # All channels of a feature at once, channels last
+        x_image[..., cols[0]:cols[-1] + 1] = np.moveaxis(planes[source], 0, -1)
+
+    FeaturePlan(features).execute_stack(unique, on_output, n_jobs=n_jobs,
+                                        profile=profile)
+    return x
+
+
+def volume_from_images(paths_i, load_i, filename):
+    '''
+    Write a series of equally sized 2D images into a memory-mapped volume.
+
+    The images are loaded and written one at a time, so the volume never
+    has to fit in RAM.
+
+    Args:
+        paths_i: Image paths, in slice order
+        load_i: Function returning the 2D NumPy array of an image path
+        filename: Path of the .npy file holding the volume
+
+    Returns:
+        np.memmap: (Z, H, W) volume, opened read-only
+    '''
+    volume = None
+    for z, path in enumerate(paths_i):
+        img = load_i(path)
+        if volume is None:
+            volume = np.lib.format.open_memmap(filename, mode='w+', dtype=img.dtype,
+                                               shape=(len(paths_i),) + img.shape)
+        volume[z] = img
+    volume.flush()
+    del volume
+    return np.load(filename, mmap_mode='r')
+
+
+def feature_extraction_volume(volume_i, features_i, slices=None, z_block=16,
+                              dtype=np.float32, out=None, n_jobs=-1):
+    '''
+    Extract selected features from slices of a volume.
+
+    The volume is read in blocks of z_block slices. Volumetric features
+    (see volume_features.py) are computed on each block padded with as
+    many halo slices as their support radius along z, which makes the
+    result the same as on the whole volume up to float rounding. 2D
+    features are computed slice by slice, see feature_extraction_stack.
+
+    Args:
+        volume_i: Volume (3D NumPy array Z x H x W, typically an np.memmap)
+        features_i: List of selected feature names, 2D and volumetric
+        slices: Indices of the slices to extract, in increasing order
+                (default=None, all slices)
+        z_block: Number of slices computed at once (default=16)
+        dtype: Data type of the feature matrix (default=np.float32)
+        out: Optional preallocated C-contiguous (n_slices*H*W, n_features)
+             array to write into, e.g. from np.lib.format.open_memmap
+        n_jobs: Number of threads (default=-1)
+
+    Returns:
+        x: FeatureMatrix with the rows of the selected slices, slice by slice
+    '''
+
+    print('inside feature_extraction_volume')
+
+    # Keep only known features, in the requested order
+    features = select_features(features_i, volume=True)
+    column = {feature: j for j, feature in enumerate(features)}
+    features_3d = [f for f in features if FEATURE_REGISTRY[f].volume]
+    features_2d = [f for f in features if not FEATURE_REGISTRY[f].volume]
+
+    n_slices = volume_i.shape[0]
+    slices = np.arange(n_slices) if slices is None else np.asarray(slices)
+    shape = (len(slices),) + volume_i.shape[1:]
+
+    # Preallocate the output matrix, or wrap the one we were given
+    if out is None:
+        x = FeatureMatrix.empty(shape, features, dtype=dtype)
+    else:
+        x = FeatureMatrix(out, features, shape)
+    x_volume = x.values.reshape(shape + (len(features),))
+
+    plan_3d = FeaturePlan(features_3d)
+    plan_2d = FeaturePlan(features_2d)
+    halo = plan_3d.radius if features_3d else 0
+
+    for z0 in range(0, n_slices, z_block):
+        z1 = min(z0 + z_block, n_slices)
+        # Requested slices inside the block, as rows of x and as block slices
+        rows = np.flatnonzero((slices >= z0) & (slices < z1))
+        if len(rows) == 0:
+            continue
+        inner = slices[rows] - z0
+
+        # Volumetric features on the block plus halo slices
+        if features_3d:
+            p0, p1 = max(z0 - halo, 0), min(z1 + halo, n_slices)
+            block = np.asarray(volume_i[p0:p1])
+            def on_output(feature, planes):
+                x_volume[rows, ..., column[feature]] = planes[inner + z0 - p0]
+            plan_3d.execute(block, on_output, n_jobs=n_jobs)
+
+        # 2D features on the requested slices only
+        if features_2d:
+            block = np.asarray(volume_i[slices[rows]])
+            def on_output(feature, planes):
+                x_volume[rows, ..., column[feature]] = planes
+            plan_2d.execute_stack(block, on_output, n_jobs=n_jobs)
+
+    return x
+
+
+def tile_slices(image_shape, tile_size, halo):
+    '''
+    Split an image into tiles padded with a halo.
+
+    Args:
+        image_shape: (H, W) shape of the image
+        tile_size: Edge length of the tiles in pixels
+        halo: Number of pixels added on each side of a tile, clipped at the
+              image borders
+
+    Returns:
+        list: (inner, padded, crop) tuples of slice pairs. inner is the tile
+              in image coordinates, padded the tile plus halo in image
+              coordinates and crop the tile within the padded region
+    '''
+    h, w = image_shape
+    tiles = []
+    for y0 in range(0, h, tile_size):
+        for x0 in range(0, w, tile_size):
+            y1, x1 = min(y0 + tile_size, h), min(x0 + tile_size, w)
+            py0, px0 = max(y0 - halo, 0), max(x0 - halo, 0)
+            py1, px1 = min(y1 + halo, h), min(x1 + halo, w)
+            inner = (slice(y0, y1), slice(x0, x1))
+            padded = (slice(py0, py1), slice(px0, px1))
+            crop = (slice(y0 - py0, y1 - py0), slice(x0 - px0, x1 - px0))
+            tiles.append((inner, padded, crop))
+    return tiles
+
+
+def feature_extraction_tiled(img_i, features_i, tile_size=1024,
+                             dtype=np.float32, out=None, n_jobs=-1, profile=None):
+    '''
+    Extract selected features tile by tile, for images larger than RAM.
+
+    Every tile is padded with a halo equal to the largest support radius of
+    the selected filters, the features are computed on the padded tile and
+    the halo is cropped away again. Halos are clipped at the image borders,
+    so the filters see the real borders and the result of the built-in
+    features is bit-identical to feature_extraction. The exception is
+    'Canny Edge', whose hysteresis step follows edges across arbitrary
+    distances; it can differ where an edge chain crosses a tile boundary.
+    Filters with vectorised or running-sum implementations, such as the
+    scale-space family, agree up to float rounding. So do the pyramid
+    features, tile_size is rounded up to a multiple of PYRAMID_ALIGNMENT
+    for them.
+
+    Args:
+        img_i: Original image (2D NumPy array or np.memmap)
+        features_i: List of selected feature names
+        tile_size: Edge length of the tiles in pixels (default=1024)
+        dtype: Data type of the feature matrix (default=np.float32)
+        out: Optional preallocated C-contiguous (n_pixels, n_features)
+             array to write into, e.g. from np.lib.format.open_memmap, so
+             that the feature matrix itself does not need to fit in RAM
+        n_jobs: Number of tiles processed concurrently (default=-1)
+        profile: Optional dict receiving the time and memory of every
+                 computed node, summed over the tiles
+
+    Returns:
+        x: FeatureMatrix containing the selected features, in the order
+           of features_i
+    '''
+
+    print('inside feature_extraction_tiled')
+
+    # Keep only known features, in the requested order
+    features = select_features(features_i)
+    column = {feature: j for j, feature in enumerate(features)}
+
+    # Preallocate the output matrix, or wrap the one we were given
+    if out is None:
+        x = FeatureMatrix.empty(img_i.shape, features, dtype=dtype)
+    else:
+        x = FeatureMatrix(out, features, img_i.shape)
+
+    # Image-shaped view on the rows, a tile is then a plain 2D slice
+    x_image = x.values.reshape(img_i.shape + (len(features),))
+
+    # The halo has to cover the widest chain of filters in the plan. Tiles
+    # and halos are aligned to the pyramid grid so that downsampled
+    # features see the same pixels as on the whole image
+    plan = FeaturePlan(features)
+    align = pyramid.PYRAMID_ALIGNMENT
+    halo = -(-plan.radius // align) * align
+    tile_size = -(-tile_size // align) * align
+
+    def process_tile(tile):
+        inner, padded, crop = tile
+        img_t = np.asarray(img_i[padded])
+        # Position features must refer to the whole image, not the tile
+        context = {'origin': (padded[0].start, padded[1].start),
+                   'full_shape': img_i.shape}
+        def on_output(feature, plane):
+            x_image[inner + (column[feature],)] = plane[crop]
+        plan.execute(img_t, on_output, n_jobs=1, context=context, profile=profile)
+
+    # Tiles are independent, peak memory scales with tile size and n_jobs
+    run_parallel(process_tile, tile_slices(img_i.shape, tile_size, halo),
+                 n_jobs=n_jobs)
+
+    return x
+
+
+def label_boxes(mask_i, margin, align=1):
+    '''
+    Bounding boxes of the labeled regions of a mask, padded by a margin.
+
+    Regions whose padded boxes overlap are merged, a merged box never costs
+    more filter work than the overlapping boxes did separately.
+
+    Args:
+        mask_i: Label image, 0 for unlabeled pixels
+        margin: Number of pixels added on each side of every box, clipped
+                at the image borders
+        align: Box origins are rounded down to multiples of align
+
+    Returns:
+        list: (y0, y1, x0, x1) padded boxes in image coordinates
+    '''
+    h, w = mask_i.shape
+    boxes = []
+    # Every connected labeled region gives one box
+    regions, _ = nd.label(mask_i != 0)
+    for region in nd.find_objects(regions):
+        y0 = max(region[0].start - margin, 0) // align * align
+        x0 = max(region[1].start - margin, 0) // align * align
+        boxes.append([y0, min(region[0].stop + margin, h),
+                      x0, min(region[1].stop + margin, w)])
+
+    # Merge overlapping boxes until none overlap anymore
+    merged = True
+    while merged:
+        merged = False
+        boxes.sort()
+        result = []
+        for box in boxes:
+            for other in result:
+                if box[0] < other[1] and other[0] < box[1] and \
+                        box[2] < other[3] and other[2] < box[3]:
+                    other[:] = [min(box[0], other[0]), max(box[1], other[1]),
+                                min(box[2], other[2]), max(box[3], other[3])]
+                    merged = True
+                    break
+            else:
+                result.append(box)
+        boxes = result
+    return [tuple(box) for box in boxes]
+
+
+def feature_extraction_sparse(img_i, mask_i, features_i, dtype=np.float32, n_jobs=-1,
+                              profile=None, channel_names=None, keep=None, cache=None):
+    '''
+    Extract selected features only at the labeled pixels of a mask.
+
+    The features are computed on the bounding boxes of the labeled regions,
+    padded by the largest support radius of the plan, and only the labeled
+    rows are kept. The work scales with the annotated area instead of the
+    image area, and the rows are the same (and in the same order) as those
+    of feature_extraction at np.flatnonzero(mask_i), like for tiles.
+    Planes that feature_extraction or the prefetcher already cached for
+    the whole image are read at the labeled pixels instead of filtered.
+
+    Args:
+        img_i: Original image (2D NumPy array), or (C, H, W) channels with
+               the columns of feature_extraction_channels
+        mask_i: Label image of shape (H, W), 0 for unlabeled pixels
+        features_i: List of selected feature names
+        dtype: Data type of the feature matrix (default=np.float32)
+        n_jobs: Number of boxes processed concurrently (default=-1)
+        profile: Optional dict receiving the time and memory of every
+                 computed node, summed over the boxes
+        channel_names: Names of the channels of a (C, H, W) image, see
+                       channel_feature_names
+        keep: Sorted flat indices of the labeled pixels to extract, e.g.
+              from sample_labeled_pixels (default=None, all labeled pixels)
+        cache: Optional FeatureCache of 2D images, only read since the
+               planes of the boxes are not whole planes
+
+    Returns:
+        x: FeatureMatrix with one row per labeled (kept) pixel
+        y: Labels of the rows
+    '''
+
+    print('inside feature_extraction_sparse')
+
+    # Keep only known features, in the requested order
+    features = select_features(features_i)
+    channels = img_i.ndim == 3
+    if channels:
+        names, columns = _channel_columns(features, _channel_names(img_i, channel_names))
+        img_i, source = _unique_channels(np.asarray(img_i))
+    else:
+        names, columns = features, {feature: j for j, feature in enumerate(features)}
+
+    # Labeled pixels in row-major order, as with np.flatnonzero
+    if keep is None:
+        labeled, selected = np.flatnonzero(mask_i), mask_i
+    else:
+        labeled = np.asarray(keep)
+        selected = np.zeros(mask_i.shape, dtype=bool)
+        selected.flat[labeled] = True
+    y = mask_i.reshape(-1)[labeled]
+    x = FeatureMatrix.empty((len(labeled),), names, dtype=dtype)
+
+    # Cached planes are read at the labeled pixels, the boxes only need
+    # the support radius of the other features
+    plan = FeaturePlan(features)
+    if cache is not None and not channels:
+        image_key = cache.image_key(img_i)
+        missing = []
+        for feature in features:
+            plane = None
+            if FEATURE_REGISTRY[feature].cache:
+                plane = cache.load(cache.plane_key(image_key, feature,
+                                                   {'plan': plan.signature(feature)}))
+            if plane is None:
+                missing.append(feature)
+            else:
+                x.values[:, columns[feature]] = plane.reshape(-1)[labeled]
+        if not missing:
+            return x, y
+        plan = plan.subplan(missing)
+
+    # Boxes of the labeled regions aligned to the pyramid grid, like tiles.
+    # The regions stay whole when keep thins them out, fewer larger boxes
+    # are cheaper to merge and to filter
+    boxes = label_boxes(mask_i, plan.radius, align=pyramid.PYRAMID_ALIGNMENT)
+
+    def process_box(box):
+        y0, y1, x0, x1 = box
+        img_b = np.asarray(img_i[..., y0:y1, x0:x1])
+        # Labeled pixels inside the box, both within the box and as rows of x
+        inside = np.nonzero(selected[y0:y1, x0:x1])
+        if len(inside[0]) == 0:
+            return
+        rows = np.searchsorted(labeled, (inside[0] + y0) * mask_i.shape[1] + inside[1] + x0)
+        context = {'origin': (y0, x0), 'full_shape': mask_i.shape}
+        # A single box gets all threads, several boxes one thread each
+        box_jobs = n_jobs if len(boxes) == 1 else 1
+        if channels:
+            def on_output(feature, planes):
+                cols = columns[feature]
+                values = planes[:, inside[0], inside[1]]
+                if len(cols) == 1:
+                    x.values[rows, cols[0]] = values[0]
+                else:
+                    x.values[rows[:, None], cols] = values[source].T
+            plan.execute_stack(img_b, on_output, n_jobs=box_jobs, context=context,
+                               profile=profile)
+        else:
+            def on_output(feature, plane):
+                x.values[rows, columns[feature]] = plane[inside]
+            plan.execute(img_b, on_output, n_jobs=box_jobs, context=context,
+                         profile=profile)
+
+    run_parallel(process_box, boxes, n_jobs=n_jobs)
+
+    return x, y
+
+
+def feature_extraction_labeled(images_i, masks_i, features_i, keeps_i=None, sparse=True,
+                               dtype=np.float32, cache=None, n_jobs=-1, tile_size=None,
+                               profile=None):
+    '''
+    Extract selected features at the labeled pixels of several images.
+
+    The images are processed one after another, each with all threads, and
+    only their labeled rows are copied into one preallocated row matrix.
+    Unlike merging the images into one, the images can differ in size, the
+    filters never see across image borders and the peak memory is one
+    image plus the rows.
+
+    Args:
+        images_i: List of images, 2D or (C, H, W) channels
+        masks_i: List of label images of shape (H, W), 0 for unlabeled pixels
+        features_i: List of selected feature names
+        keeps_i: Sorted flat indices of the pixels to extract per image,
+                 e.g. from sample_labeled_images (default=None, all labeled
+                 pixels)
+        sparse: Filter only around the labeled pixels, see
+                feature_extraction_sparse. Otherwise the whole images are
+                filtered, using tile_size for 2D images (default=True)
+        dtype: Data type of the feature matrix (default=np.float32)
+        cache: Optional FeatureCache of 2D images. The sparse extraction
+               reads cached planes, the dense one also stores them
+        n_jobs: Number of threads per image (default=-1)
+        tile_size: Tile edge length of the dense extraction (default=None)
+        profile: Optional dict receiving the time and memory of every
+                 computed node, summed over the images
+
+    Returns:
+        x: FeatureMatrix with one row per labeled (kept) pixel, image by image
+        y: Labels of the rows
+    '''
+    if keeps_i is None:
+        keeps_i = [np.flatnonzero(mask) for mask in masks_i]
+    offsets = np.cumsum([0] + [len(keep) for keep in keeps_i])
+    y = np.concatenate([mask.reshape(-1)[keep] for mask, keep in zip(masks_i, keeps_i)])
+    x = None
+    for img, mask, keep, start, stop in zip(images_i, masks_i, keeps_i,
+                                            offsets[:-1], offsets[1:]):
+        if len(keep) == 0:
             continue
+        if sparse:
+            rows, _ = feature_extraction_sparse(img, mask, features_i, dtype=dtype,
+                                                n_jobs=n_jobs, profile=profile, keep=keep,
+                                                cache=cache)
+        elif img.ndim == 3:
+            rows = feature_extraction_channels(img, features_i, dtype=dtype,
+                                               n_jobs=n_jobs, profile=profile)
+        else:
+            rows = feature_extraction(img, features_i, dtype=dtype, cache=cache,
+                                      n_jobs=n_jobs, tile_size=tile_size, profile=profile)
+        values = rows.values if sparse else rows.values[keep]
+        # The row matrix is allocated once the column names are known
+        if x is None:
+            x = FeatureMatrix.empty((int(offsets[-1]),), rows.names, dtype=dtype)
+        x.values[start:stop] = values
+    if x is None:
+        x = FeatureMatrix.empty((0,), select_features(features_i), dtype=dtype)
+    return x, y
 
-        data[feature] = processed.reshape(-1)
 
-    df = pd.DataFrame(data)
-    return df
-    
+def compute_position_maps(img2d: np.ndarray, origin=(0, 0), full_shape=None):
+    """
+    Return position maps for a HxW image.
 
-def compute_position_maps(img2d: np.ndarray):
-    """Return position maps for a HxW image."""
-    h, w = img2d.shape
-    yy, xx = np.mgrid[0:h, 0:w]  # row-major (y first), x second
+    Args:
+        img2d: Image, or a tile of a larger image
+        origin: (row, col) of img2d within the full image (default=(0, 0))
+        full_shape: Shape of the full image, defaults to img2d.shape
+    """
+    th, tw = img2d.shape
+    oy, ox = origin
+    h, w = full_shape if full_shape is not None else img2d.shape
+    yy, xx = np.mgrid[oy:oy + th, ox:ox + tw]  # row-major (y first), x second
 
     # [0,1] normalized (use +0.5 to place pixel centers)
     x_rel = (xx + 0.5) / w
@@ -0,0 +1,167 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Oriented Gabor filter bank features computed in the
+#              frequency domain. The image is transformed once, multiplied
+#              against all kernels of a frequency as one batched array
+#              operation and transformed back in bulk, so a bank of 16-32
+#              kernels costs little more than a handful of FFTs.
+#
+# References:  https://en.wikipedia.org/wiki/Gabor_filter
+#              https://docs.scipy.org/doc/scipy/reference/fft.html
+##############################################################################
+"""FFT-batched Gabor filter bank features"""
+# Import packages
+from functools import lru_cache
+import numpy as np
+import scipy.fft
+from asmgui.randomforest_classifier.feature_registry import register_feature
+
+# Default bank, frequencies in cycles per pixel and number of orientations
+GABOR_FREQUENCIES = (0.0625, 0.125, 0.25)
+GABOR_ORIENTATIONS = 6
+
+def gabor_sigma(frequency):
+    '''Width of the Gaussian envelope for a bandwidth of one octave.'''
+    return 0.56 / frequency
+
+def gabor_radius(frequency):
+    '''Radius at which the Gabor envelope is truncated (3σ).'''
+    return int(np.ceil(3.0 * gabor_sigma(frequency)))
+
+def _orientations(n_orientations):
+    return [np.pi * k / n_orientations for k in range(n_orientations)]
+
+@lru_cache(maxsize=32)
+def _kernel_spectra(frequency, n_orientations, shape):
+    '''
+    Spectra of the even (cosine) and odd (sine) Gabor kernels.
+
+    Args:
+        frequency: Frequency of the kernels in cycles per pixel
+        n_orientations: Number of orientations in [0, π)
+        shape: Shape of the padded image the spectra are multiplied with
+
+    Returns:
+        tuple: even and odd spectra, each (n_orientations, H, W//2+1) complex64
+    '''
+    sigma = gabor_sigma(frequency)
+    r = gabor_radius(frequency)
+    yy, xx = np.mgrid[-r:r + 1, -r:r + 1].astype(np.float32)
+    envelope = np.exp(-(xx**2 + yy**2) / (2.0 * sigma**2))
+    envelope /= envelope.sum()
+    even, odd = [], []
+    for theta in _orientations(n_orientations):
+        phase = 2.0 * np.pi * frequency * (xx * np.cos(theta) + yy * np.sin(theta))
+        k_even = envelope * np.cos(phase)
+        # Zero mean, the even kernel should not respond to brightness
+        k_even -= envelope * (k_even.sum() / envelope.sum())
+        even.append(k_even)
+        odd.append(envelope * np.sin(phase))
+
+    def spectra(kernels):
+        # Embed the kernels in the padded shape with their centre at (0, 0)
+        padded = np.zeros((len(kernels),) + tuple(shape), dtype=np.float32)
+        padded[:, :2 * r + 1, :2 * r + 1] = kernels
+        padded = np.roll(padded, (-r, -r), axis=(-2, -1))
+        return scipy.fft.rfft2(padded, axes=(-2, -1)).astype(np.complex64)
+
+    return spectra(np.array(even)), spectra(np.array(odd))
+
+def _spectrum(img_f, pad):
+    '''
+    Real FFT of the image, padded by mirroring against wrap-around.
+
+    Args:
+        img_f: Image (float32), the last two axes are transformed
+        pad: Number of pixels to pad on each side, at least the largest
+             kernel radius of the bank
+
+    Returns:
+        dict: spectrum, padded shape, pad and image shape
+    '''
+    h, w = img_f.shape[-2:]
+    shape = (scipy.fft.next_fast_len(h + 2 * pad, real=True),
+             scipy.fft.next_fast_len(w + 2 * pad, real=True))
+    pad_width = [(0, 0)] * (img_f.ndim - 2) + \
+        [(pad, shape[0] - h - pad), (pad, shape[1] - w - pad)]
+    padded = np.pad(img_f, pad_width, mode='symmetric')
+    return {'spectrum': scipy.fft.rfft2(padded, axes=(-2, -1), workers=-1),
+            'shape': shape, 'pad': pad, 'image_shape': (h, w)}
+
+def _bank_response(spectrum, frequency, n_orientations, part):
+    '''
+    Even or odd responses of all orientations of one frequency at once.
+
+    Args:
+        spectrum: Output of _spectrum
+        frequency: Frequency of the kernels in cycles per pixel
+        n_orientations: Number of orientations
+        part: 0 for the even (real) and 1 for the odd (imaginary) part
+
+    Returns:
+        np.ndarray: (..., n_orientations, H, W) float32 responses
+    '''
+    spec = spectrum['spectrum']
+    kernels = _kernel_spectra(frequency, n_orientations, spectrum['shape'])[part]
+    # One batched multiplication, broadcast over any leading axes of the
+    # image, and one bulk inverse transform
+    response = scipy.fft.irfft2(spec[..., None, :, :] * kernels, s=spectrum['shape'],
+                                axes=(-2, -1), workers=-1)
+    pad = spectrum['pad']
+    h, w = spectrum['image_shape']
+    return np.ascontiguousarray(response[..., pad:pad + h, pad:pad + w],
+                                dtype=np.float32)
+
+def _magnitude(even, odd):
+    return np.hypot(even, odd)
+
+def _orientation(responses, index):
+    return responses[..., index, :, :]
+
+
+def register_gabor_bank(frequencies=GABOR_FREQUENCIES,
+                        n_orientations=GABOR_ORIENTATIONS, default=False):
+    '''
+    Register the features of a Gabor filter bank.
+
+    For every frequency and orientation two features are registered, the
+    magnitude of the complex response ('Gabor f=... θ=...') and its real
+    part ('Gabor real f=... θ=...'). Selecting only one of the two keeps
+    half of the responses out of memory.
+
+    Args:
+        frequencies: Frequencies in cycles per pixel
+        n_orientations: Number of orientations evenly spaced in [0, 180°)
+        default: Select the features by default in the GUI (default=False)
+    '''
+    pad = max(gabor_radius(f) for f in frequencies)
+    register_feature('Gabor spectrum', inputs=('float32 image',),
+                     params={'pad': pad}, cost=2.0, selectable=False,
+                     cache=False, dtype=np.complex64, stack=True)(_spectrum)
+    for frequency in frequencies:
+        bank = f'Gabor f={frequency:g}'
+        params = {'frequency': frequency, 'n_orientations': n_orientations}
+        # Even and odd responses of all orientations, one node each
+        register_feature(f'{bank} even', inputs=('Gabor spectrum',),
+                         params=dict(params, part=0), radius=gabor_radius(frequency),
+                         cost=1.0 + 0.3 * n_orientations, selectable=False,
+                         cache=False, planes=n_orientations, stack=True)(_bank_response)
+        register_feature(f'{bank} odd', inputs=('Gabor spectrum',),
+                         params=dict(params, part=1), radius=gabor_radius(frequency),
+                         cost=1.0 + 0.3 * n_orientations, selectable=False,
+                         cache=False, planes=n_orientations, stack=True)(_bank_response)
+        register_feature(f'{bank} magnitude', inputs=(f'{bank} even', f'{bank} odd'),
+                         cost=0.1 * n_orientations, selectable=False,
+                         cache=False, planes=n_orientations, stack=True)(_magnitude)
+        for index, theta in enumerate(_orientations(n_orientations)):
+            degrees = f'{np.degrees(theta):g}°'
+            register_feature(f'Gabor f={frequency:g} θ={degrees}',
+                             inputs=(f'{bank} magnitude',), params={'index': index},
+                             cost=0.0, default=default, stack=True)(_orientation)
+            register_feature(f'Gabor real f={frequency:g} θ={degrees}',
+                             inputs=(f'{bank} even',), params={'index': index},
+                             cost=0.0, default=default, stack=True)(_orientation)
+
+# Register the default bank
+register_gabor_bank()
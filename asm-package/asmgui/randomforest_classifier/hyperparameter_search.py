@@ -0,0 +1,159 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Search of random forest settings that trades accuracy against
+#              prediction speed. Neighbouring pixels of one image are
+#              strongly correlated, so every candidate is scored by grouped
+#              cross-validation with the training images as groups, which
+#              measures how well the forest does on an image it has not
+#              seen. The cross-validation of the candidates runs in a
+#              process pool. Their prediction time per megapixel is then
+#              measured one candidate after another on a reference image,
+#              so that the candidates do not compete for the CPU while
+#              they are timed. The Pareto front of accuracy and speed is
+#              reported.
+#
+# References:  https://scikit-learn.org/stable/modules/cross_validation.html
+#              #group-k-fold
+##############################################################################
+"""Grouped cross-validated search of fast and accurate forests"""
+# Import packages
+import itertools
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from sklearn import metrics
+from sklearn.model_selection import GroupKFold
+from asmgui.randomforest_classifier.feature_executor import resolve_n_jobs
+from asmgui.randomforest_classifier.training_functions import build_forest
+
+# Forest settings tried by default, every combination is a candidate
+DEFAULT_TUNING_GRID = {'n_estimators': (5, 10, 25),
+                       'max_depth': (None, 20, 12),
+                       'min_samples_leaf': (1, 5)}
+
+# Data of the worker processes, sent once per process
+_DATA = {}
+
+def _init_worker(x_i, y_i, groups_i, reference_i, n_splits):
+    _DATA.update(x=x_i, y=y_i, groups=groups_i, reference=reference_i, n_splits=n_splits)
+
+def _evaluate(candidate):
+    # Grouped cross-validated accuracy of one candidate. Forests use one
+    # core, the candidates run in parallel instead
+    params = dict(candidate['params'], n_jobs=1)
+    columns = candidate['columns']
+    x, y, groups = _DATA['x'][:, columns], _DATA['y'], _DATA['groups']
+    accuracies = []
+    for train, test in GroupKFold(n_splits=_DATA['n_splits']).split(x, y, groups):
+        model = build_forest(params)
+        model.fit(x[train], y[train])
+        accuracies.append(metrics.accuracy_score(y[test], model.predict(x[test])))
+    return {'params': candidate['params'],
+            'features': candidate['features'],
+            'accuracy': float(np.mean(accuracies)),
+            'accuracy std': float(np.std(accuracies))}
+
+def _prediction_time(candidate, x_i, y_i, reference_i):
+    # Single core prediction seconds per megapixel of a forest of the
+    # candidate fitted on all rows, run alone
+    columns = candidate['columns']
+    model = build_forest(dict(candidate['params'], n_jobs=1))
+    model.fit(x_i[:, columns], y_i)
+    reference = np.ascontiguousarray(reference_i[:, columns])
+    start = time.perf_counter()
+    model.predict(reference)
+    seconds = time.perf_counter() - start
+    return seconds / (len(reference) / 1e6)
+
+def search_forest_params(x_i, y_i, groups_i, names_i, reference_i, grid=None,
+                         feature_subsets=None, n_splits=5, n_jobs=-1):
+    '''
+    Score every combination of forest settings and feature subset.
+
+    Args:
+        x_i: Feature rows of the labeled pixels, (n_rows, n_columns)
+        y_i: Labels of the rows
+        groups_i: Training image of every row, the folds never split an image
+        names_i: Column names of x_i
+        reference_i: Feature rows of a whole reference image, with the
+                     columns of x_i, to time the prediction on
+        grid: Dict of lists of RandomForestClassifier settings, see
+              DEFAULT_TUNING_GRID (default=None, DEFAULT_TUNING_GRID)
+        feature_subsets: Optional list of lists of column names to try,
+                         default all columns
+        n_splits: Maximum number of folds, at most one per image (default=5)
+        n_jobs: Number of worker processes, see resolve_n_jobs (default=-1)
+
+    Returns:
+        list: One dict per candidate with its params, features, mean and
+              standard deviation of the accuracy over the folds and
+              prediction seconds per megapixel on a single core, timed
+              after the cross-validation, one candidate at a time
+    '''
+    n_splits = min(n_splits, len(np.unique(groups_i)))
+    if n_splits < 2:
+        raise ValueError("Grouped cross-validation needs at least two training images")
+    grid = DEFAULT_TUNING_GRID if grid is None else grid
+    names_i = list(names_i)
+    subsets = feature_subsets or [names_i]
+    keys = list(grid)
+    candidates = [{'params': dict(zip(keys, values)),
+                   'features': list(subset),
+                   'columns': [names_i.index(name) for name in subset]}
+                  for subset in subsets
+                  for values in itertools.product(*(grid[k] for k in keys))]
+    print(f"Evaluating {len(candidates)} candidates with {n_splits}-fold grouped "
+          f"cross-validation")
+
+    n_workers = min(resolve_n_jobs(n_jobs), len(candidates))
+    initargs = (x_i, y_i, groups_i, reference_i, n_splits)
+    if n_workers <= 1:
+        # Same code path in the calling process
+        _init_worker(*initargs)
+        try:
+            results = [_evaluate(candidate) for candidate in candidates]
+        finally:
+            _DATA.clear()
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=initargs) as pool:
+            results = list(pool.map(_evaluate, candidates))
+    # Timed once the pool is done, one candidate at a time
+    for candidate, result in zip(candidates, results):
+        result['seconds per megapixel'] = _prediction_time(candidate, x_i, y_i, reference_i)
+    return results
+
+def pareto_front(results_i):
+    '''
+    Candidates no other candidate beats in both accuracy and speed.
+
+    Args:
+        results_i: Results of search_forest_params
+
+    Returns:
+        list: Non-dominated results, fastest first
+    '''
+    front = []
+    for result in sorted(results_i, key=lambda r: (r['seconds per megapixel'],
+                                                   -r['accuracy'])):
+        # Sorted by time, a result is on the front if it is more accurate
+        # than every faster one
+        if not front or result['accuracy'] > front[-1]['accuracy']:
+            front.append(result)
+    return front
+
+def choose_configuration(results_i, tolerance=0.01):
+    '''
+    Fastest candidate that is about as accurate as the best one.
+
+    Args:
+        results_i: Results of search_forest_params
+        tolerance: Accepted loss of accuracy (default=0.01)
+
+    Returns:
+        dict: The chosen result, on the Pareto front
+    '''
+    front = pareto_front(results_i)
+    best = max(r['accuracy'] for r in front)
+    return next(r for r in front if r['accuracy'] >= best - tolerance)
@@ -0,0 +1,270 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Incremental random forest training. The training images are
+#              split into small groups and every group gets its own trees,
+#              fitted on the sampled pixels of its images only. When masks
+#              are added, edited or removed, only the trees of the affected
+#              groups are refitted, with the new labels weighted up, and
+#              the sampled feature rows of unchanged images are kept in
+#              memory, so a small edit costs one image's features and a few
+#              trees instead of a complete retraining.
+##############################################################################
+"""Incremental random forest training as masks change"""
+# Import packages
+import copy
+import hashlib
+import numpy as np
+from asmgui.randomforest_classifier.feature_space import feature_extraction_sparse
+from asmgui.randomforest_classifier.sampling import sample_labeled_pixels
+from asmgui.randomforest_classifier.training_functions import build_forest, name_columns
+from asmgui.randomforest_classifier.training_functions import DEFAULT_FOREST_PARAMS
+
+def mask_fingerprint(mask_i):
+    '''
+    Hash the labels of a mask, to detect edited masks.
+
+    Args:
+        mask_i: Label image
+
+    Returns:
+        str: Hex digest of the mask shape and labels
+    '''
+    h = hashlib.sha1(repr((mask_i.shape, mask_i.dtype.str)).encode())
+    h.update(np.ascontiguousarray(mask_i).data)
+    return h.hexdigest()
+
+class IncrementalForest:
+    """
+    Random forest grown and pruned group by group as masks change.
+
+    Every training image belongs to one group of at most images_per_group
+    images. The trees of a group are fitted on the rows of its images,
+    plus borrowed rows of classes the group lacks, so that all trees know
+    every class. A group's trees are retired when one of the images they
+    saw is removed or edited.
+
+    Attributes:
+        features (list): Selected feature names of the forest
+        forest_params (dict): Random forest settings, see build_forest
+        images_per_group (int): Maximum number of images per group
+        trees_per_group (int): Number of trees fitted per group, None
+                               splits n_estimators over the groups
+        recent_weight (float): Sample weight of the rows of added or
+                               edited masks, the other rows weigh 1
+        model: Combined RandomForestClassifier, None before the first update
+    """
+
+    def __init__(self, load_image, features, forest_params=None, images_per_group=8,
+                 trees_per_group=None, recent_weight=2.0, max_per_class=None, spacing=1,
+                 seed=0, settings=None, n_jobs=-1, cache=None):
+        """
+        Initialize an empty IncrementalForest.
+
+        Args:
+            load_image: Function returning the classifier input of an image key
+            features: List of selected feature names
+            forest_params: Optional dict of random forest settings, its
+                           n_estimators is the size of the whole forest
+            images_per_group: Maximum number of images per group (default=8)
+            trees_per_group: Number of trees fitted per group (default=None,
+                             n_estimators split evenly over the groups)
+            recent_weight: Weight of the rows of added or edited masks (default=2.0)
+            max_per_class: Maximum number of training pixels per class and
+                           group, see sample_labeled_pixels (default=None)
+            spacing: Sampling grid spacing, see sample_labeled_pixels (default=1)
+            seed: Seed of the sampling and of the trees (default=0)
+            settings: Optional dict of further settings the rows depend on,
+                      e.g. the channel mode (default=None)
+            n_jobs: Number of threads of the feature extraction (default=-1)
+            cache: Optional FeatureCache read by the extraction, see
+                   feature_extraction_sparse
+        """
+        self.load_image = load_image
+        self.features = list(features)
+        self.forest_params = dict(DEFAULT_FOREST_PARAMS, **(forest_params or {}))
+        self.images_per_group = int(images_per_group)
+        self.trees_per_group = None if trees_per_group is None else int(trees_per_group)
+        self.recent_weight = float(recent_weight)
+        self.max_per_class = max_per_class
+        self.spacing = spacing
+        self.seed = seed
+        self.settings = dict(settings or {})
+        self.n_jobs = n_jobs
+        self.cache = cache
+        self.model = None
+        # Feature matrix column names, known after the first extraction
+        self.columns = None
+        # Sampled rows and fingerprint per image key
+        self._rows = {}
+        self._fingerprints = {}
+        # Groups: member images, images the trees saw and the trees
+        self._groups = []
+        self._classes = None
+        self._next_seed = seed
+
+    def settings_match(self, features, forest_params=None, max_per_class=None, spacing=1,
+                       seed=0, settings=None):
+        '''
+        Check if the forest was built for these features and settings.
+
+        Args:
+            features: List of selected feature names
+            forest_params: Optional dict of random forest settings
+            max_per_class, spacing, seed: Sampling settings, see __init__
+            settings: Optional dict of further settings the rows depend on
+
+        Returns:
+            bool: True if update can reuse the existing trees and rows
+        '''
+        return list(features) == self.features and \
+            dict(DEFAULT_FOREST_PARAMS, **(forest_params or {})) == self.forest_params and \
+            [max_per_class, spacing, seed] == [self.max_per_class, self.spacing, self.seed] and \
+            dict(settings or {}) == self.settings
+
+    def _extract(self, key, mask_i):
+        # Sampled labeled rows of one image, the cap is shared by a group
+        cap = None if self.max_per_class is None else \
+            max(self.max_per_class // self.images_per_group, 1)
+        keep = sample_labeled_pixels(mask_i, max_per_class=cap, spacing=self.spacing,
+                                     seed=self.seed)
+        x, y = feature_extraction_sparse(self.load_image(key), mask_i, self.features,
+                                         n_jobs=self.n_jobs, keep=keep, cache=self.cache)
+        self.columns = x.names
+        return x.values, y
+
+    def remove(self, key):
+        '''
+        Forget an image and retire the trees that saw it.
+
+        The remaining images of the affected groups are refitted on the
+        next update.
+
+        Args:
+            key: Image key, e.g. the path of the training image
+        '''
+        self._rows.pop(key, None)
+        self._fingerprints.pop(key, None)
+        retired = 0
+        for group in self._groups:
+            if key in group['sources']:
+                group['images'].discard(key)
+                retired += len(group['trees'])
+                group['trees'] = []
+        print(f"Retired {retired} trees that were trained on {key}")
+        self._assemble()
+
+    def update(self, masks):
+        '''
+        Bring the forest up to date with the current training masks.
+
+        Args:
+            masks: Dict of label image per image key, all training images
+
+        Returns:
+            model: Combined RandomForestClassifier, None without labels
+        '''
+        # Removed and edited images retire their trees
+        fingerprints = {key: mask_fingerprint(mask) for key, mask in masks.items()}
+        for key in list(self._fingerprints):
+            if fingerprints.get(key) != self._fingerprints[key]:
+                self.remove(key)
+        new = [key for key in masks if key not in self._fingerprints]
+        for key in new:
+            self._rows[key] = self._extract(key, masks[key])
+            self._fingerprints[key] = fingerprints[key]
+
+        # Trees only know the classes seen when they were fitted
+        classes = np.unique(np.concatenate([y for _, y in self._rows.values()])) \
+            if self._rows else np.array([])
+        if self._classes is None or not np.array_equal(classes, self._classes):
+            self._classes = classes
+            for group in self._groups:
+                group['trees'] = []
+        if len(classes) < 2:
+            print("At least two labeled classes are needed to train")
+            self._groups = []
+            self.model = None
+            return None
+
+        # New images join groups with room, retired groups first
+        self._groups = [g for g in self._groups if g['images']]
+        for key in new:
+            open_groups = [g for g in self._groups if len(g['images']) < self.images_per_group]
+            if open_groups:
+                group = min(open_groups, key=lambda g: (len(g['trees']) > 0, len(g['images'])))
+                group['images'].add(key)
+                group['trees'] = []
+            else:
+                self._groups.append({'images': {key}, 'sources': set(), 'trees': []})
+
+        # Refit the groups without trees
+        refitted = 0
+        for k, group in enumerate(self._groups):
+            if not group['trees']:
+                self._fit_group(group, self._group_size(k), recent=set(new))
+                refitted += len(group['trees'])
+        print(f"Fitted {refitted} new trees, forest has "
+              f"{sum(len(g['trees']) for g in self._groups)} trees in "
+              f"{len(self._groups)} groups")
+        self._assemble()
+        return self.model
+
+    def _group_size(self, k):
+        # Trees of the k-th group, the forest keeps about n_estimators trees
+        if self.trees_per_group is not None:
+            return self.trees_per_group
+        n_trees, n_groups = int(self.forest_params['n_estimators']), len(self._groups)
+        return max(n_trees // n_groups + (k < n_trees % n_groups), 1)
+
+    def _fit_group(self, group, n_trees, recent):
+        images = sorted(group['images'])
+        x = [self._rows[key][0] for key in images]
+        y = [self._rows[key][1] for key in images]
+        w = [np.full(len(self._rows[key][1]),
+                     self.recent_weight if key in recent else 1.0) for key in images]
+        sources = set(images)
+        # Borrow rows of the classes the group has no labels of
+        rng = np.random.default_rng(self._next_seed)
+        missing = set(self._classes) - set(np.unique(np.concatenate(y)))
+        for label in sorted(missing):
+            donors = [key for key in sorted(self._rows) if key not in sources
+                      and np.any(self._rows[key][1] == label)]
+            donor = donors[rng.integers(len(donors))]
+            rows = self._rows[donor][1] == label
+            x.append(self._rows[donor][0][rows])
+            y.append(self._rows[donor][1][rows])
+            w.append(np.ones(int(rows.sum())))
+            sources.add(donor)
+        forest = build_forest(dict(self.forest_params, n_estimators=n_trees,
+                                   random_state=self._next_seed))
+        forest.fit(np.concatenate(x), np.concatenate(y), sample_weight=np.concatenate(w))
+        self._next_seed += 1
+        group['sources'] = sources
+        group['trees'] = forest.estimators_
+        group['forest'] = forest
+
+    def _assemble(self):
+        # One classifier over the trees of all groups. All trees were fitted
+        # on the same classes, encoded the same way
+        fitted = [g for g in self._groups if g['trees']]
+        if not fitted:
+            self.model = None
+            return
+        model = copy.copy(fitted[0]['forest'])
+        model.estimators_ = [tree for g in fitted for tree in g['trees']]
+        model.n_estimators = len(model.estimators_)
+        self.model = name_columns(model, self.columns)
+
+    def image_trees(self):
+        '''
+        Training images seen by the trees of the forest.
+
+        Returns:
+            dict: Number of trees per image key
+        '''
+        counts = {}
+        for group in self._groups:
+            for key in group['sources']:
+                counts[key] = counts.get(key, 0) + len(group['trees'])
+        return counts
@@ -0,0 +1,134 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Local binary pattern (LBP) texture features. The 8 neighbours
+#              on a circle are compared with the centre pixel as whole
+#              shifted arrays, the comparisons are packed into one 8-bit
+#              code per pixel and a 256 entry table maps the code to its
+#              rotation invariant uniform class. Histograms of the classes
+#              over a window are counted with running-sum box filters, so
+#              the cost does not depend on the window size.
+#
+# References:  T. Ojala, M. Pietikäinen, T. Mäenpää, Multiresolution gray-scale
+#              and rotation invariant texture classification with local binary
+#              patterns, IEEE TPAMI 24(7), 2002
+##############################################################################
+"""Rotation invariant local binary pattern features"""
+# Import packages
+import cv2
+import numpy as np
+from asmgui.randomforest_classifier.feature_registry import register_feature
+
+# Radii (in pixels) of the neighbour circles
+LBP_RADII = (1, 2, 3)
+
+# Window sizes (odd, in pixels) of the histogram summaries
+LBP_WINDOWS = (9, 17, 33)
+
+# Number of neighbours on a circle, the codes fit in one byte
+LBP_POINTS = 8
+
+def _uniform_classes(n_points):
+    '''
+    Rotation invariant uniform class of every packed code.
+
+    Codes with at most two 0/1 transitions around the circle (spots, flat
+    areas, edges, corners) are classified by their number of ones, all
+    other codes share the class n_points + 1.
+
+    Returns:
+        np.ndarray: (2**n_points,) uint8 lookup table
+    '''
+    codes = np.arange(2**n_points)
+    bits = (codes[:, None] >> np.arange(n_points)) & 1
+    ones = bits.sum(axis=1)
+    transitions = (bits != np.roll(bits, 1, axis=1)).sum(axis=1)
+    return np.where(transitions <= 2, ones, n_points + 1).astype(np.uint8)
+
+UNIFORM_CLASSES = _uniform_classes(LBP_POINTS)
+
+def _neighbour(padded, pad, dy, dx, shape):
+    # Image shifted by (dy, dx), bilinear interpolation between the four
+    # surrounding whole-pixel shifts for off-grid neighbours
+    y0, x0 = int(np.floor(dy)), int(np.floor(dx))
+    fy, fx = np.float32(dy - y0), np.float32(dx - x0)
+    h, w = shape
+    def shifted(oy, ox):
+        return padded[..., pad + y0 + oy:pad + y0 + oy + h, pad + x0 + ox:pad + x0 + ox + w]
+    if fy == 0 and fx == 0:
+        return shifted(0, 0)
+    return ((1 - fy) * ((1 - fx) * shifted(0, 0) + fx * shifted(0, 1))
+            + fy * ((1 - fx) * shifted(1, 0) + fx * shifted(1, 1)))
+
+def _lbp(img_f, radius):
+    '''
+    Rotation invariant uniform local binary pattern.
+
+    Args:
+        img_f: Image (float32), the last two axes are filtered
+        radius: Radius of the neighbour circle in pixels
+
+    Returns:
+        np.ndarray: Classes 0 to LBP_POINTS + 1 (uint8)
+    '''
+    pad = radius + 1
+    pad_width = [(0, 0)] * (img_f.ndim - 2) + [(pad, pad), (pad, pad)]
+    padded = np.pad(img_f, pad_width, mode='symmetric')
+    code = np.zeros(img_f.shape, dtype=np.uint8)
+    for k in range(LBP_POINTS):
+        angle = 2.0 * np.pi * k / LBP_POINTS
+        # Round away the sin/cos error of the axis-aligned neighbours
+        dy = round(-radius * np.sin(angle), 6)
+        dx = round(radius * np.cos(angle), 6)
+        neighbour = _neighbour(padded, pad, dy, dx, img_f.shape[-2:])
+        # Pack the comparison as bit k of the code
+        code |= (neighbour >= img_f).view(np.uint8) << k
+    return UNIFORM_CLASSES[code]
+
+def _lbp_histogram(classes, window):
+    '''
+    Summaries of the class histogram in the window around every pixel.
+
+    Args:
+        classes: Output of _lbp (uint8)
+        window: Odd window size
+
+    Returns:
+        tuple: Entropy (bits) of the histogram and fraction of non-uniform
+               codes, both float32
+    '''
+    n = window * window
+    terms = np.zeros(classes.shape, dtype=np.float32)
+    # One class at a time, the counts are exact integers in float32
+    for label in range(LBP_POINTS + 2):
+        counts = cv2.boxFilter((classes == label).view(np.uint8), cv2.CV_32F,
+                               (window, window), normalize=False,
+                               borderType=cv2.BORDER_REFLECT)
+        if label == LBP_POINTS + 1:
+            non_uniform = counts / np.float32(n)
+        # c ln c, zero for empty classes
+        terms += counts * np.log(np.maximum(counts, 1.0))
+    # H = log2(n) - sum(c log2 c) / n
+    entropy = np.maximum(np.float32(np.log2(n)) - terms / np.float32(n * np.log(2.0)), 0.0)
+    return entropy, non_uniform
+
+def _plane(stats, index):
+    return stats[index]
+
+
+# --- Register the patterns and histogram summaries of every radius ---
+
+for radius in LBP_RADII:
+    register_feature(f'LBP R={radius}', inputs=('float32 image',),
+                     params={'radius': radius}, radius=radius + 1, dtype=np.uint8,
+                     cost=1.0, default=False, stack=True)(_lbp)
+    for window in LBP_WINDOWS:
+        histogram = f'LBP histogram R={radius} w={window}'
+        register_feature(histogram, inputs=(f'LBP R={radius}',),
+                         params={'window': window}, radius=window // 2,
+                         cost=0.4 * (LBP_POINTS + 2), selectable=False, cache=False,
+                         planes=2)(_lbp_histogram)
+        register_feature(f'LBP entropy R={radius} w={window}', inputs=(histogram,),
+                         params={'index': 0}, cost=0.0, default=False)(_plane)
+        register_feature(f'LBP non-uniform R={radius} w={window}', inputs=(histogram,),
+                         params={'index': 1}, cost=0.0, default=False)(_plane)
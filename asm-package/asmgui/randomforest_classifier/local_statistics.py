@@ -0,0 +1,137 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Local statistics features (mean, variance, range and entropy)
+#              over square windows of 3 to 65 pixels. Sums come from
+#              summed-area tables, four lookups per pixel whatever the
+#              window size, and extrema from separable running max/min
+#              filters. The summed-area tables are computed once per image
+#              and shared by all selected windows.
+#
+# References:  https://en.wikipedia.org/wiki/Summed-area_table
+##############################################################################
+"""Local statistics features in constant time per pixel"""
+# Import packages
+import cv2
+import numpy as np
+from asmgui.randomforest_classifier.feature_registry import register_feature
+
+# Window sizes (odd, in pixels) of the local statistics
+WINDOWS = (3, 9, 17, 33, 65)
+
+# Number of grey level bins of the local entropy
+ENTROPY_BINS = 8
+
+def _integral_images(img_f, pad):
+    '''
+    Summed-area tables of the image and of its square.
+
+    Args:
+        img_f: Image (float32)
+        pad: Number of mirrored pixels added on each side, at least the
+             radius of the largest window
+
+    Returns:
+        dict: sum and squared sum tables (float64) and pad
+    '''
+    padded = cv2.copyMakeBorder(img_f, pad, pad, pad, pad, cv2.BORDER_REFLECT)
+    # One pass for both tables, float64 keeps the sums exact for 8-bit data
+    s, sq = cv2.integral2(padded, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+    return {'sum': s, 'sqsum': sq, 'pad': pad}
+
+def _integral_histogram(img_u8, pad, n_bins):
+    '''
+    Summed-area tables of the indicator images of n_bins grey level bins.
+
+    Args:
+        img_u8: Image (uint8)
+        pad: Number of mirrored pixels added on each side
+        n_bins: Number of bins, a power of two up to 256
+
+    Returns:
+        dict: (n_bins, H+2*pad+1, W+2*pad+1) int32 tables and pad
+    '''
+    padded = cv2.copyMakeBorder(img_u8, pad, pad, pad, pad, cv2.BORDER_REFLECT)
+    bins = padded >> (8 - int(np.log2(n_bins)))
+    tables = np.stack([cv2.integral((bins == b).view(np.uint8), sdepth=cv2.CV_32S)
+                       for b in range(n_bins)])
+    return {'tables': tables, 'pad': pad}
+
+def box_sum(table, pad, window):
+    '''
+    Sum over the window centred on every pixel, four lookups per pixel.
+
+    Args:
+        table: Summed-area table(s) of an image padded by pad pixels,
+               (..., H+2*pad+1, W+2*pad+1)
+        pad: Number of pixels the image was padded with
+        window: Odd window size, at most 2*pad+1
+
+    Returns:
+        np.ndarray: (..., H, W) window sums
+    '''
+    o = pad - window // 2
+    h = table.shape[-2] - 2 * pad - 1
+    w = table.shape[-1] - 2 * pad - 1
+    return (table[..., o + window:o + window + h, o + window:o + window + w]
+            - table[..., o:o + h, o + window:o + window + w]
+            - table[..., o + window:o + window + h, o:o + w]
+            + table[..., o:o + h, o:o + w])
+
+def _local_mean(integrals, window):
+    s = box_sum(integrals['sum'], integrals['pad'], window)
+    return (s / (window * window)).astype(np.float32)
+
+def _local_variance(integrals, window):
+    n = window * window
+    mean = box_sum(integrals['sum'], integrals['pad'], window) / n
+    mean_sq = box_sum(integrals['sqsum'], integrals['pad'], window) / n
+    # E[x²] - E[x]² can drop slightly below zero by rounding
+    return np.maximum(mean_sq - mean * mean, 0.0).astype(np.float32)
+
+def _local_entropy(histogram, window):
+    '''
+    Shannon entropy (bits) of the grey level histogram in the window, high
+    for textured and low for flat regions.
+    '''
+    n = window * window
+    counts = box_sum(histogram['tables'], histogram['pad'], window)
+    # H = log2(n) - sum(c log2 c) / n, with c log2 c looked up per count
+    table = np.zeros(n + 1, dtype=np.float32)
+    table[1:] = np.arange(1, n + 1) * np.log2(np.arange(1, n + 1))
+    terms = table[counts].sum(axis=0)
+    return np.maximum(np.log2(n) - terms / n, 0.0).astype(np.float32)
+
+def _local_range(img_f, window):
+    # Rectangular morphology is separable in OpenCV, a running max/min along
+    # the rows and then the columns
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (window, window))
+    high = cv2.dilate(img_f, kernel, borderType=cv2.BORDER_REFLECT)
+    low = cv2.erode(img_f, kernel, borderType=cv2.BORDER_REFLECT)
+    return high - low
+
+
+# --- Register the shared tables and the features of every window ---
+
+pad = max(WINDOWS) // 2
+register_feature('integral images', inputs=('float32 image',), params={'pad': pad},
+                 dtype=np.float64, cost=0.3, selectable=False, cache=False,
+                 planes=2)(_integral_images)
+register_feature('integral histogram', inputs=('uint8 image',),
+                 params={'pad': pad, 'n_bins': ENTROPY_BINS}, dtype=np.int32,
+                 cost=0.2 * ENTROPY_BINS, selectable=False, cache=False,
+                 planes=ENTROPY_BINS)(_integral_histogram)
+
+for window in WINDOWS:
+    register_feature(f'Local mean w={window}', inputs=('integral images',),
+                     params={'window': window}, radius=window // 2, cost=0.1,
+                     default=False)(_local_mean)
+    register_feature(f'Local variance w={window}', inputs=('integral images',),
+                     params={'window': window}, radius=window // 2, cost=0.2,
+                     default=False)(_local_variance)
+    register_feature(f'Local range w={window}', inputs=('float32 image',),
+                     params={'window': window}, radius=window // 2, cost=0.6,
+                     default=False)(_local_range)
+    register_feature(f'Local entropy w={window}', inputs=('integral histogram',),
+                     params={'window': window}, radius=window // 2, cost=0.6,
+                     default=False)(_local_entropy)
@@ -0,0 +1,122 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Persistence of the trained random forest. The model is saved
+#              uncompressed with joblib next to training_set.json, which
+#              loads faster than a compressed file, together with a small
+#              JSON file describing it: features, labels, sklearn version
+#              and a fingerprint of the masks and training settings. A
+#              model whose fingerprint matches can be used without training
+#              again. Loading reads the whole forest into memory, sklearn
+#              copies the node arrays of every tree when unpickling it.
+#
+# References:  https://scikit-learn.org/stable/model_persistence.html
+##############################################################################
+"""Saving and loading of trained models"""
+# Import packages
+import hashlib
+import json
+import os
+from pathlib import Path
+import joblib
+import sklearn
+from asmgui.randomforest_classifier.feature_planner import FeaturePlan
+from asmgui.randomforest_classifier.feature_space import select_features
+
+# File names of the model and its description in the output folder
+MODEL_FILENAME = "random_forest.joblib"
+METADATA_FILENAME = "random_forest.json"
+
+def training_fingerprint(mask_paths, features, settings=None):
+    '''
+    Hash everything a trained model depends on apart from the images.
+
+    Args:
+        mask_paths: Paths of the training masks (.npy), in training order
+        features: List of selected feature names
+        settings: Optional dict of training settings, e.g. forest and
+                  sampling parameters (JSON serializable)
+
+    Returns:
+        str: Hex digest of the mask files, the feature parameters and the
+             settings
+    '''
+    h = hashlib.sha1()
+    # Mask contents, the paths also identify the images they belong to
+    for path in mask_paths:
+        h.update(str(Path(path).name).encode())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    # Feature names with their filter parameters and inputs
+    plan = FeaturePlan(select_features(features))
+    h.update(repr([plan.signature(f) for f in plan.features]).encode())
+    h.update(json.dumps(settings or {}, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+def save_model(model_i, folder, features, fingerprint):
+    '''
+    Save a fitted model and its description.
+
+    Args:
+        model_i: Fitted RandomForestClassifier
+        folder: Output folder, e.g. the one holding training_set.json
+        features: List of feature names the model was trained on
+        fingerprint: Training fingerprint, see training_fingerprint
+
+    Returns:
+        Path: Path of the saved model
+    '''
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    path = folder / MODEL_FILENAME
+    # The old description goes first, it must never vouch for another model
+    (folder / METADATA_FILENAME).unlink(missing_ok=True)
+    # Uncompressed, it loads faster. Written under a temporary name, a
+    # crash must not leave a partial file
+    tmp = path.with_suffix('.tmp')
+    joblib.dump(model_i, tmp)
+    os.replace(tmp, path)
+    # Described after the model is in place
+    metadata = {"features": list(features),
+                "labels": model_i.classes_.tolist(),
+                "sklearn version": sklearn.__version__,
+                "fingerprint": fingerprint}
+    tmp = folder / (METADATA_FILENAME + ".tmp")
+    with open(tmp, 'w') as f:
+        json.dump(metadata, f, indent=4)
+    os.replace(tmp, folder / METADATA_FILENAME)
+    print(f"Model saved to {path}")
+    return path
+
+def load_model(folder, fingerprint=None):
+    '''
+    Load a saved model if it is still valid.
+
+    Args:
+        folder: Output folder of save_model
+        fingerprint: Expected training fingerprint, None accepts any
+
+    Returns:
+        model: RandomForestClassifier, read into memory, None if there
+               is no saved model, it was saved by another sklearn
+               version or its fingerprint differs
+    '''
+    folder = Path(folder)
+    try:
+        with open(folder / METADATA_FILENAME, 'r') as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if metadata.get("sklearn version") != sklearn.__version__:
+        print(f"Saved model is from sklearn {metadata.get('sklearn version')}, "
+              f"not {sklearn.__version__}, it has to be trained again")
+        return None
+    if fingerprint is not None and metadata.get("fingerprint") != fingerprint:
+        return None
+    path = folder / MODEL_FILENAME
+    if not path.exists():
+        return None
+    model = joblib.load(path)
+    print(f"Model loaded from {path}")
+    return model
@@ -0,0 +1,110 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Multi-resolution context features. Wide filters are
+#              evaluated on a 1/2, 1/4 or 1/8 downsampled copy of the image
+#              and bilinearly upsampled back to full resolution, which costs
+#              a fraction of the native-resolution price. The pyramid and
+#              the coarse copies of the feature graph are ordinary planner
+#              nodes, so they are computed only for the selected features
+#              and shared between them.
+#
+# References:  https://docs.opencv.org/4.x/d4/d1f/tutorial_pyramids.html
+##############################################################################
+"""Image pyramid context features"""
+# Import packages
+import cv2
+import numpy as np
+from asmgui.randomforest_classifier.feature_registry import FEATURE_REGISTRY, IMAGE
+from asmgui.randomforest_classifier.feature_registry import register_feature, register_alternative
+
+# Pyramid levels, level k is downsampled by 2**k
+PYRAMID_LEVELS = (1, 2, 3)
+
+# Tiles starting at multiples of this see the same pyramid grid as the image
+PYRAMID_ALIGNMENT = 2 ** max(PYRAMID_LEVELS)
+
+# Features offered at the coarse levels, those with wide receptive fields
+PYRAMID_FEATURES = ('Gaussian σ=7', 'Gradient magnitude σ=4', 'Hessian λ1 σ=4',
+                    'Hessian λ2 σ=4', 'Coherence σ=4', 'Local variance w=17',
+                    'Local entropy w=17')
+
+def pyramid_name(level):
+    '''Name of the image downsampled to pyramid level level.'''
+    return f'pyramid 1/{2**level}'
+
+def _pyr_down(img_i):
+    # Gaussian 5x5 smoothing followed by dropping every other row and column
+    return cv2.pyrDown(img_i, borderType=cv2.BORDER_REFLECT)
+
+def _upsample(coarse, img_i, factor):
+    # Bilinear interpolation back to the size of the full resolution image.
+    # pyrDown keeps every factor-th pixel, so pixel (y, x) of the image
+    # lies at (y, x) / factor on the coarse grid
+    h, w = img_i.shape[-2:]
+    matrix = np.array([[1.0 / factor, 0.0, 0.0], [0.0, 1.0 / factor, 0.0]])
+    return cv2.warpAffine(coarse, matrix, (w, h),
+                          flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                          borderMode=cv2.BORDER_REPLICATE)
+
+for level in PYRAMID_LEVELS:
+    # Every level is reduced from the one above, radius 2 at that level
+    register_feature(pyramid_name(level),
+                     inputs=(IMAGE,) if level == 1 else (pyramid_name(level - 1),),
+                     radius=2 ** level, cost=0.3 / 4 ** (level - 1),
+                     selectable=False, cache=False, planes=1 / 4 ** level)(_pyr_down)
+
+def _coarse_node(name, level):
+    '''
+    Register the copy of a node (and of everything it depends on) that is
+    computed from the pyramid level instead of the image.
+
+    Args:
+        name: Name of a registered node
+        level: Pyramid level
+
+    Returns:
+        str: Name of the coarse copy
+    '''
+    if name == IMAGE:
+        return pyramid_name(level)
+    coarse = f'{name} [1/{2**level}]'
+    if coarse in FEATURE_REGISTRY:
+        return coarse
+    spec = FEATURE_REGISTRY[name]
+    if spec.context:
+        raise ValueError(f"Feature {name!r} depends on the pixel position "
+                         "and cannot be computed on the pyramid")
+    # Kernel radii grow and costs shrink with the downsampling factor
+    factor = 2 ** level
+    register_feature(coarse, inputs=[_coarse_node(i, level) for i in spec.inputs],
+                     params=spec.params, radius=spec.radius * factor,
+                     dtype=spec.dtype, cost=spec.cost / factor**2,
+                     selectable=False, cache=False,
+                     planes=spec.planes / factor**2, stack=spec.stack)(spec.func)
+    for alt in spec.alternatives:
+        register_alternative(coarse, inputs=[_coarse_node(i, level) for i in alt.inputs],
+                             params=alt.params, radius=alt.radius * factor,
+                             cost=alt.cost / factor**2, stack=alt.stack)(alt.func)
+    return coarse
+
+def register_pyramid_feature(name, levels=PYRAMID_LEVELS, default=False):
+    '''
+    Offer a registered feature at coarse pyramid levels, as the features
+    '<name> @1/2', '<name> @1/4', ...
+
+    Args:
+        name: Name of a registered feature
+        levels: Pyramid levels (default=PYRAMID_LEVELS)
+        default: Select the features by default in the GUI (default=False)
+    '''
+    spec = FEATURE_REGISTRY[name]
+    for level in levels:
+        factor = 2 ** level
+        register_feature(f'{name} @1/{factor}', inputs=(_coarse_node(name, level), IMAGE),
+                         params={'factor': factor}, radius=factor,
+                         dtype=spec.dtype, cost=0.1,
+                         default=default, cache=spec.cache)(_upsample)
+
+for name in PYRAMID_FEATURES:
+    register_pyramid_feature(name)
@@ -0,0 +1,129 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Selection of the labeled pixels a random forest is trained
+#              on. Broad brush strokes label millions of nearly identical
+#              pixels of one class, so the pixels can be thinned to one per
+#              cell of a grid and every class capped to a number of pixels,
+#              spread evenly over the source images. The selection is seeded
+#              and bounds the training time whatever the painted area.
+##############################################################################
+"""Class-balanced, capped sampling of labeled pixels"""
+# Import packages
+import numpy as np
+
+def _share(available, total):
+    '''
+    Split total evenly over groups with limited supply.
+
+    Groups with fewer items than their share give the remainder to the
+    others.
+
+    Args:
+        available: Number of items per group
+        total: Number of items to take over all groups
+
+    Returns:
+        np.ndarray: Number of items taken per group
+    '''
+    available = np.asarray(available, dtype=np.int64)
+    taken = np.zeros_like(available)
+    remaining = min(int(total), int(available.sum()))
+    while remaining > 0:
+        open_groups = np.flatnonzero(taken < available)
+        share = max(remaining // len(open_groups), 1)
+        for g in open_groups:
+            step = min(share, available[g] - taken[g], remaining)
+            taken[g] += step
+            remaining -= step
+            if remaining == 0:
+                break
+    return taken
+
+def sample_labeled_pixels(mask_i, max_per_class=None, spacing=1, groups=None, seed=0):
+    '''
+    Choose the labeled pixels to train on.
+
+    Args:
+        mask_i: Label image, 0 for unlabeled pixels (any shape)
+        max_per_class: Maximum number of pixels per class, None keeps all
+                       (default=None)
+        spacing: Keep one random pixel per class in every spacing x spacing
+                 cell of the last two axes, 1 keeps all (default=1)
+        groups: Optional array of the shape of mask_i with the source image
+                of every pixel, the cap is spread evenly over the sources
+        seed: Seed of the random selection (default=0)
+
+    Returns:
+        np.ndarray: Sorted flat indices of the chosen pixels, a subset of
+                    np.flatnonzero(mask_i)
+    '''
+    rng = np.random.default_rng(seed)
+    labels = mask_i.reshape(-1)
+    index = np.flatnonzero(labels)
+
+    if spacing > 1:
+        # Visit the pixels in random order and keep the first of every
+        # cell and class
+        index = index[rng.permutation(len(index))]
+        h, w = mask_i.shape[-2:]
+        rows = (index // w) % h // spacing
+        cols = index % w // spacing
+        planes = index // (h * w)
+        n_rows, n_cols = -(-h // spacing), -(-w // spacing)
+        n_cells = (mask_i.size // (h * w)) * n_rows * n_cols
+        cell = (planes * n_rows + rows) * n_cols + cols
+        _, first = np.unique(labels[index].astype(np.int64) * n_cells + cell,
+                             return_index=True)
+        index = np.sort(index[first])
+
+    if max_per_class is None:
+        return index
+
+    source = groups.reshape(-1)[index] if groups is not None else np.zeros(len(index), int)
+    keep = []
+    for label in np.unique(labels[index]):
+        members = index[labels[index] == label]
+        member_source = source[labels[index] == label]
+        if len(members) <= max_per_class:
+            keep.append(members)
+            continue
+        # Same number of pixels from every source image where possible
+        sources, counts = np.unique(member_source, return_counts=True)
+        for s, n in zip(sources, _share(counts, max_per_class)):
+            candidates = members[member_source == s]
+            keep.append(rng.choice(candidates, size=n, replace=False))
+    return np.sort(np.concatenate(keep)) if keep else index
+
+def sample_labeled_images(masks_i, max_per_class=None, spacing=1, seed=0):
+    '''
+    Choose the labeled pixels to train on over several label images.
+
+    Same selection as sample_labeled_pixels on the merged masks with every
+    image as its own source, for masks of any, also differing, shapes.
+
+    Args:
+        masks_i: List of label images, 0 for unlabeled pixels
+        max_per_class: Maximum number of pixels per class over all images,
+                       None keeps all (default=None)
+        spacing: Keep one random pixel per class in every spacing x spacing
+                 cell of every image, 1 keeps all (default=1)
+        seed: Seed of the random selection (default=0)
+
+    Returns:
+        list: Sorted flat indices of the chosen pixels of every image
+    '''
+    # Grid thinning within every image, different seeds per image
+    thinned = [sample_labeled_pixels(mask, spacing=spacing, seed=seed + i)
+               for i, mask in enumerate(masks_i)]
+    if max_per_class is None:
+        return thinned
+    # Cap the classes over the thinned pixels of all images, listed one
+    # image after the other
+    labels = np.concatenate([mask.reshape(-1)[index] for mask, index in zip(masks_i, thinned)])
+    sources = np.concatenate([np.full(len(index), i) for i, index in enumerate(thinned)])
+    chosen = sample_labeled_pixels(labels, max_per_class=max_per_class,
+                                   groups=sources, seed=seed)
+    offsets = np.cumsum([0] + [len(index) for index in thinned])
+    return [index[chosen[(chosen >= start) & (chosen < stop)] - start]
+            for index, start, stop in zip(thinned, offsets[:-1], offsets[1:])]
@@ -0,0 +1,130 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Gaussian scale-space features: gradient magnitude, Hessian
+#              eigenvalues, structure tensor coherence and Difference of
+#              Gaussians at several scales. All scales come from a single
+#              incremental Gaussian cascade, every scale is smoothed from
+#              the previous one, and the derivatives of a scale are
+#              computed once and shared by all features at that scale.
+#
+# References:  T. Lindeberg, Scale-Space Theory in Computer Vision, 1994
+#              https://en.wikipedia.org/wiki/Structure_tensor
+##############################################################################
+"""Gaussian scale-space feature family"""
+# Import packages
+import cv2
+import numpy as np
+from asmgui.randomforest_classifier.feature_registry import register_feature, register_alternative
+
+# Scales (σ in pixels) of the cascade
+SCALES = (1.0, 2.0, 4.0, 8.0)
+
+def scale_name(sigma):
+    '''Name of the smoothed image at scale sigma.'''
+    return f'scale σ={sigma:g}'
+
+def _smooth(img_f, sigma):
+    # One step of the cascade, smooths the previous scale further. The
+    # kernel is truncated at 4σ like scipy's gaussian_filter
+    ksize = 2 * int(4.0 * sigma + 0.5) + 1
+    return cv2.GaussianBlur(img_f, (ksize, ksize), sigma,
+                            borderType=cv2.BORDER_REFLECT)
+
+def _derivatives(img_s, sigma):
+    '''
+    Scale-normalised first and second derivatives of a smoothed image.
+
+    Args:
+        img_s: Image smoothed at scale sigma
+        sigma: Scale, first derivatives are multiplied by sigma and second
+               derivatives by sigma² so that scales are comparable
+
+    Returns:
+        tuple: (Lx, Ly, Lxx, Lxy, Lyy)
+    '''
+    # Central differences without extra smoothing, the image is smooth already
+    s1, s2 = 0.5 * sigma, sigma * sigma
+    lx = cv2.Sobel(img_s, cv2.CV_32F, 1, 0, ksize=1, scale=s1)
+    ly = cv2.Sobel(img_s, cv2.CV_32F, 0, 1, ksize=1, scale=s1)
+    lxx = cv2.Sobel(img_s, cv2.CV_32F, 2, 0, ksize=1, scale=s2)
+    lyy = cv2.Sobel(img_s, cv2.CV_32F, 0, 2, ksize=1, scale=s2)
+    lxy = cv2.Sobel(lx, cv2.CV_32F, 0, 1, ksize=1, scale=0.5 * sigma)
+    return lx, ly, lxx, lxy, lyy
+
+def _gradient_magnitude(derivs):
+    lx, ly = derivs[0], derivs[1]
+    return np.sqrt(lx * lx + ly * ly)
+
+def _hessian_eigenvalues(derivs):
+    # Closed form eigenvalues of the symmetric 2x2 Hessian, largest first
+    lxx, lxy, lyy = derivs[2], derivs[3], derivs[4]
+    half_trace = 0.5 * (lxx + lyy)
+    disc = np.sqrt((0.5 * (lxx - lyy))**2 + lxy * lxy)
+    return half_trace + disc, half_trace - disc
+
+def _eigenvalue(eigenvalues, index):
+    return eigenvalues[index]
+
+def _coherence(derivs, window):
+    '''
+    Coherence of the structure tensor, 0 for isotropic and 1 for perfectly
+    oriented structure. The tensor is integrated with a running-sum box
+    filter, which costs the same for every window size.
+    '''
+    lx, ly = derivs[0], derivs[1]
+    box = (window, window)
+    jxx = cv2.boxFilter(lx * lx, -1, box, borderType=cv2.BORDER_REFLECT)
+    jyy = cv2.boxFilter(ly * ly, -1, box, borderType=cv2.BORDER_REFLECT)
+    jxy = cv2.boxFilter(lx * ly, -1, box, borderType=cv2.BORDER_REFLECT)
+    diff = np.sqrt((jxx - jyy)**2 + 4.0 * jxy * jxy)
+    return diff / (jxx + jyy + np.finfo(np.float32).eps)
+
+def _difference(img_fine, img_coarse):
+    return img_coarse - img_fine
+
+
+# --- Register the cascade and the features of every scale ---
+
+previous = None
+for sigma in SCALES:
+    # Smooth from the previous scale, Gaussians compose as σ² = σa² + σb²
+    step = sigma if previous is None else float(np.sqrt(sigma**2 - previous**2))
+    register_feature(scale_name(sigma),
+                     inputs=('float32 image',) if previous is None else (scale_name(previous),),
+                     params={'sigma': step}, radius=int(4.0 * step + 0.5),
+                     cost=step / 3.0, selectable=False, cache=False)(_smooth)
+
+    register_feature(f'derivatives σ={sigma:g}', inputs=(scale_name(sigma),),
+                     params={'sigma': sigma}, radius=2, cost=0.5,
+                     selectable=False, cache=False, planes=5)(_derivatives)
+    register_feature(f'Hessian eigenvalues σ={sigma:g}',
+                     inputs=(f'derivatives σ={sigma:g}',), cost=0.2,
+                     selectable=False, cache=False, planes=2)(_hessian_eigenvalues)
+
+    register_feature(f'Gradient magnitude σ={sigma:g}',
+                     inputs=(f'derivatives σ={sigma:g}',), cost=0.1,
+                     default=False)(_gradient_magnitude)
+    register_feature(f'Hessian λ1 σ={sigma:g}',
+                     inputs=(f'Hessian eigenvalues σ={sigma:g}',), params={'index': 0},
+                     cost=0.0, default=False)(_eigenvalue)
+    register_feature(f'Hessian λ2 σ={sigma:g}',
+                     inputs=(f'Hessian eigenvalues σ={sigma:g}',), params={'index': 1},
+                     cost=0.0, default=False)(_eigenvalue)
+    window = 2 * int(round(sigma)) + 1
+    register_feature(f'Coherence σ={sigma:g}',
+                     inputs=(f'derivatives σ={sigma:g}',), params={'window': window},
+                     radius=window // 2, cost=0.3, default=False)(_coherence)
+    if previous is not None:
+        register_feature(f'DoG σ={previous:g}-{sigma:g}',
+                         inputs=(scale_name(previous), scale_name(sigma)),
+                         cost=0.05, default=False)(_difference)
+    previous = sigma
+
+# The plain Gaussian features can be taken from the cascade when it is used
+register_alternative('Gaussian σ=3', inputs=(scale_name(2.0),),
+                     params={'sigma': float(np.sqrt(3**2 - 2**2))},
+                     radius=int(4.0 * np.sqrt(3**2 - 2**2) + 0.5), cost=0.75)(_smooth)
+register_alternative('Gaussian σ=7', inputs=(scale_name(4.0),),
+                     params={'sigma': float(np.sqrt(7**2 - 4**2))},
+                     radius=int(4.0 * np.sqrt(7**2 - 4**2) + 0.5), cost=1.9)(_smooth)
@@ -0,0 +1,279 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Sharded random forest training. The rows of a TrainingStore
+#              are split into shards, by training image or at random, and
+#              every shard gets an independent sub-forest, fitted in its own
+#              process or on another machine that sees the store through a
+#              shared file system (see write_manifest). A random forest is
+#              the average of its trees, so the sub-forests are merged into
+#              one estimator that predicts exactly like a forest of all
+#              their trees. No process needs more than its shard in memory.
+##############################################################################
+"""Sharded random forest training with merged sub-forests"""
+# Import packages
+import copy
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import joblib
+import numpy as np
+from asmgui.randomforest_classifier.feature_executor import resolve_n_jobs
+from asmgui.randomforest_classifier.training_functions import build_forest, forest_summary, name_columns
+from asmgui.randomforest_classifier.training_functions import DEFAULT_FOREST_PARAMS
+from asmgui.randomforest_classifier.training_functions import oob_confusion, print_oob_accuracy
+from asmgui.randomforest_classifier.training_store import TrainingStore
+
+def plan_shards(store, n_shards, partition='images', max_per_class=None, seed=0):
+    '''
+    Split the training rows of a store into shards.
+
+    Every shard gets rows of every class: classes a shard has no rows of
+    are borrowed from the other shards, as many rows as an even share.
+
+    Args:
+        store: TrainingStore holding the rows
+        n_shards: Number of shards, at most one per image with 'images'
+        partition: 'images' keeps the rows of an image together, shards
+                   being balanced by number of rows, 'rows' deals the rows
+                   out at random (default='images')
+        max_per_class: Maximum number of rows per class over all shards,
+                       see TrainingStore.training_index (default=None)
+        seed: Seed of the row selection and dealing (default=0)
+
+    Returns:
+        list: Sorted store row indices of every shard
+    '''
+    keep = store.training_index(max_per_class=max_per_class, seed=seed)
+    _, rows = store.arrays()
+    if keep is None:
+        keep = np.arange(store.n_rows)
+    labels = np.asarray(rows['label'][keep])
+    sources = np.asarray(rows['source'][keep])
+    rng = np.random.default_rng(seed)
+
+    if partition == 'images':
+        # Largest images first, each to the shard with the fewest rows
+        images, counts = np.unique(sources, return_counts=True)
+        n_shards = max(min(int(n_shards), len(images)), 1)
+        shard_of_image, sizes = {}, np.zeros(n_shards, dtype=np.int64)
+        for image, count in sorted(zip(images, counts), key=lambda ic: -ic[1]):
+            shard = int(np.argmin(sizes))
+            shard_of_image[image] = shard
+            sizes[shard] += count
+        shard = np.array([shard_of_image[s] for s in sources], dtype=np.int64)
+    elif partition == 'rows':
+        n_shards = max(int(n_shards), 1)
+        shard = np.empty(len(keep), dtype=np.int64)
+        shard[rng.permutation(len(keep))] = np.arange(len(keep)) % n_shards
+    else:
+        raise ValueError(f"Unknown partition {partition!r}, use 'images' or 'rows'")
+
+    shards = []
+    classes = np.unique(labels)
+    for k in range(n_shards):
+        members = [np.flatnonzero(shard == k)]
+        # Borrow rows of missing classes, the trees must know all classes
+        for label in np.setdiff1d(classes, labels[members[0]]):
+            candidates = np.flatnonzero(labels == label)
+            n = max(len(candidates) // n_shards, 1)
+            members.append(rng.choice(candidates, size=n, replace=False))
+        shards.append(np.sort(keep[np.unique(np.concatenate(members))]))
+    return shards
+
+def shard_params(forest_params, n_shards):
+    '''
+    Forest settings of every shard, the trees split evenly over the shards.
+
+    Args:
+        forest_params: Optional dict of random forest settings, see build_forest
+        n_shards: Number of shards
+
+    Returns:
+        list: Settings per shard, each with its own random state and one core
+    '''
+    params = dict(DEFAULT_FOREST_PARAMS, random_state=42)
+    params.update(forest_params or {})
+    n_trees = int(params['n_estimators'])
+    return [dict(params, n_estimators=max(n_trees // n_shards + (k < n_trees % n_shards), 1),
+                 random_state=params['random_state'] + k, n_jobs=1)
+            for k in range(n_shards)]
+
+def _fit_shard(store_folder, index, params, evaluation=None):
+    # Reads only the rows of the shard from the memory-mapped store. With
+    # evaluation='oob' the confusion matrix of the out-of-bag votes of the
+    # shard is returned too, the per-row votes are dropped
+    x, rows = TrainingStore.load(store_folder).arrays()
+    y = np.asarray(rows['label'][index])
+    model = build_forest(dict(params, oob_score=evaluation == 'oob'))
+    model.fit(np.asarray(x[index], dtype=np.float32), y)
+    if evaluation != 'oob':
+        return model, None
+    confusion = oob_confusion(model, y)
+    del model.oob_decision_function_, model.oob_score_
+    model.oob_score = False
+    return model, confusion
+
+def merge_forests(forests_i, n_jobs=None):
+    '''
+    Merge fitted forests into one forest of all their trees.
+
+    The merged forest averages the class probabilities of all trees, like
+    a single forest fitted with that many trees.
+
+    Args:
+        forests_i: Fitted RandomForestClassifiers with the same classes
+        n_jobs: Prediction cores of the merged forest (default=None, as the
+                first forest)
+
+    Returns:
+        model: Merged RandomForestClassifier
+    '''
+    classes = forests_i[0].classes_
+    for forest in forests_i[1:]:
+        if not np.array_equal(forest.classes_, classes):
+            raise ValueError("Forests with different classes cannot be merged")
+    model = copy.copy(forests_i[0])
+    model.estimators_ = [tree for forest in forests_i for tree in forest.estimators_]
+    model.n_estimators = len(model.estimators_)
+    if n_jobs is not None:
+        model.n_jobs = n_jobs
+    return model
+
+def train_sharded(store, n_shards, forest_params=None, partition='images',
+                  max_per_class=None, seed=0, n_jobs=-1, evaluation='oob'):
+    '''
+    Fit one sub-forest per shard in a process pool and merge them.
+
+    With evaluation='oob' every sub-forest votes on the rows of its shard
+    left out of its trees' bootstrap samples, and the summed confusion
+    matrix is reported. It estimates the accuracy of forests of one shard's
+    size, a slightly pessimistic estimate for the merged forest.
+
+    Args:
+        store: TrainingStore holding the rows
+        n_shards: Number of shards, see plan_shards
+        forest_params: Optional dict of random forest settings, n_estimators
+                       is the number of trees of the merged forest
+        partition: 'images' or 'rows', see plan_shards (default='images')
+        max_per_class: Maximum number of rows per class, see plan_shards
+        seed: Seed of the row selection (default=0)
+        n_jobs: Number of worker processes, see resolve_n_jobs (default=-1)
+        evaluation: 'oob' or None, see above. 'holdout' is not available
+                    with shards, the out-of-bag accuracy is reported
+                    instead (default='oob')
+
+    Returns:
+        model: Merged RandomForestClassifier
+    '''
+    if evaluation == 'holdout':
+        print("Holdout evaluation is not available with shards, "
+              "reporting the out-of-bag accuracy instead")
+        evaluation = 'oob'
+    elif evaluation not in ('oob', None):
+        raise ValueError(f"Unknown evaluation {evaluation!r}, use 'oob', 'holdout' or None")
+    shards = plan_shards(store, n_shards, partition=partition,
+                         max_per_class=max_per_class, seed=seed)
+    params = shard_params(forest_params, len(shards))
+    tasks = [(str(store.folder), index, p, evaluation) for index, p in zip(shards, params)]
+    print(f"Training {len(shards)} shards of {[len(index) for index in shards]} rows")
+    n_workers = min(resolve_n_jobs(n_jobs), len(tasks))
+    if n_workers <= 1:
+        results = [_fit_shard(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(_fit_shard, *zip(*tasks)))
+    forests, confusions = zip(*results)
+    model = merge_forests(forests, n_jobs=(forest_params or {}).get(
+        'n_jobs', DEFAULT_FOREST_PARAMS['n_jobs']))
+    if evaluation == 'oob':
+        # All shards know all classes, their matrices line up
+        print_oob_accuracy(model, None, confusion=sum(confusions))
+    print("Forest size:", forest_summary(model))
+    return name_columns(model, store.columns)
+
+
+# --- Shards fitted on other machines, through a shared file system ---
+
+def write_manifest(store, folder, n_shards, forest_params=None, partition='images',
+                   max_per_class=None, seed=0):
+    '''
+    Plan the shards and describe them for other machines.
+
+    Every shard is then fitted with run_manifest_shard, e.g. on a cluster
+    node with access to the store folder:
+        python -m asmgui.randomforest_classifier.sharded_training manifest.json 3
+    and the results are merged with merge_manifest.
+
+    Args:
+        store: TrainingStore holding the rows, on a shared file system
+        folder: Folder receiving the manifest, shard rows and sub-forests
+        n_shards, forest_params, partition, max_per_class, seed: See
+            train_sharded
+
+    Returns:
+        Path: Path of manifest.json
+    '''
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    shards = plan_shards(store, n_shards, partition=partition,
+                         max_per_class=max_per_class, seed=seed)
+    entries = []
+    for k, (index, params) in enumerate(zip(shards, shard_params(forest_params, len(shards)))):
+        np.save(folder / f"shard_{k:03d}_rows.npy", index)
+        entries.append({'rows': f"shard_{k:03d}_rows.npy",
+                        'params': params,
+                        'output': f"shard_{k:03d}.joblib"})
+    manifest = {'store': str(store.folder.resolve()),
+                'n_jobs': (forest_params or {}).get('n_jobs', DEFAULT_FOREST_PARAMS['n_jobs']),
+                'shards': entries}
+    path = folder / "manifest.json"
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    print(f"Manifest of {len(entries)} shards written to {path}")
+    return path
+
+def run_manifest_shard(manifest_path, shard):
+    '''
+    Fit one shard of a manifest and save its sub-forest next to it.
+
+    Args:
+        manifest_path: Path of manifest.json, see write_manifest
+        shard: Index of the shard
+    '''
+    manifest_path = Path(manifest_path)
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    entry = manifest['shards'][int(shard)]
+    index = np.load(manifest_path.parent / entry['rows'])
+    model, _ = _fit_shard(manifest['store'], index, entry['params'])
+    # Written under a temporary name, merge never sees a partial file
+    output = manifest_path.parent / entry['output']
+    joblib.dump(model, str(output) + ".tmp")
+    os.replace(str(output) + ".tmp", output)
+    print(f"Shard {shard} saved to {output}")
+
+def merge_manifest(manifest_path):
+    '''
+    Merge the sub-forests of all shards of a manifest.
+
+    Args:
+        manifest_path: Path of manifest.json, see write_manifest
+
+    Returns:
+        model: Merged RandomForestClassifier
+    '''
+    manifest_path = Path(manifest_path)
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    outputs = [manifest_path.parent / entry['output'] for entry in manifest['shards']]
+    missing = [k for k, output in enumerate(outputs) if not output.exists()]
+    if missing:
+        raise FileNotFoundError(f"Shards {missing} of {manifest_path} are not fitted yet")
+    model = merge_forests([joblib.load(output) for output in outputs], n_jobs=manifest['n_jobs'])
+    return name_columns(model, TrainingStore.load(manifest['store']).columns)
+
+if __name__ == '__main__':
+    run_manifest_shard(sys.argv[1], int(sys.argv[2]))
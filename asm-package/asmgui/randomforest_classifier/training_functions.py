@@ -14,18 +14,76 @@ from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestClassifier
 from sklearn import metrics
 import numpy as np
-from asmgui.randomforest_classifier.feature_space import feature_extraction
+from asmgui.randomforest_classifier.feature_space import feature_extraction, feature_extraction_sparse
+from asmgui.randomforest_classifier.feature_space import feature_extraction_stack, feature_extraction_volume
+from asmgui.randomforest_classifier.feature_space import feature_extraction_channels
+from asmgui.randomforest_classifier.feature_space import feature_extraction_labeled
+from asmgui.randomforest_classifier.sampling import sample_labeled_pixels, sample_labeled_images
 import matplotlib.pyplot as plt
 
+# Random forest settings, n_jobs=-1 trains and predicts on all cores
+DEFAULT_FOREST_PARAMS = {'n_estimators': 10, 'max_depth': None, 'min_samples_leaf': 1,
+                         'max_samples': None, 'n_jobs': -1}
+
+def build_forest(forest_params=None):
+    '''
+    Create an unfitted random forest with the given settings.
+
+    Args:
+        forest_params: Optional dict overriding DEFAULT_FOREST_PARAMS, any
+                       RandomForestClassifier argument
+
+    Returns:
+        model: RandomForestClassifier, random state kept constant
+    '''
+    params = dict(DEFAULT_FOREST_PARAMS, random_state=42)
+    params.update(forest_params or {})
+    return RandomForestClassifier(**params)
+
+def forest_summary(model_i):
+    '''
+    Size of a fitted random forest, which drives its prediction time.
+
+    Args:
+        model_i: Fitted RandomForestClassifier model
+
+    Returns:
+        dict: Number of trees, maximum and mean tree depth and total
+              number of nodes
+    '''
+    depths = [tree.tree_.max_depth for tree in model_i.estimators_]
+    return {'trees': len(depths),
+            'max depth': int(max(depths)),
+            'mean depth': float(np.mean(depths)),
+            'nodes': int(sum(tree.tree_.node_count for tree in model_i.estimators_))}
+
+def name_columns(model_i, names_i):
+    '''
+    Record the feature matrix column names on a fitted model.
+
+    The names are kept with the model when it is saved, e.g. to label the
+    feature importances. sklearn's feature_names_in_ is not used, it makes
+    every prediction on plain arrays warn.
+
+    Args:
+        model_i: Fitted RandomForestClassifier model
+        names_i: Names of the columns the model was fitted on
+
+    Returns:
+        model: model_i, with the names in feature_columns_
+    '''
+    model_i.feature_columns_ = list(names_i)
+    return model_i
+
 def print_accuracy(model_i, xtrain_i, xtest_i, ytrain_i, ytest_i):
     '''
     Print the percentage prediction between predicted, test & train.
 
     Args:
         model_i: Fitted RandomForestClassifier model
-        xtrain_i: Dataframe containing percentage of total amount of
+        xtrain_i: Array containing percentage of total amount of
                  feature data
-        xtest_i: Dataframe containing percentage of total amount of
+        xtest_i: Array containing percentage of total amount of
                 feature data
         ytrain_i: Vector containing percentage of reshaped masked image 
         ytest_i: Vector containing percentage of reshaped masked image
@@ -37,55 +95,248 @@ def print_accuracy(model_i, xtrain_i, xtest_i, ytrain_i, ytest_i):
     print ("Accuracy on training data = ", metrics.accuracy_score(ytrain_i, prediction_test_train))    
     print ("Accuracy on test data = ", metrics.accuracy_score(ytest_i, prediction_test))
 
-def train_random_forest(img_mi, img_fi, features_i, nest=10):
+def oob_confusion(model_i, ytrain_i):
     '''
-    Train a random forest model between the mask and image using features
-    from feature_extraction.
+    Confusion matrix of the out-of-bag votes of a forest fitted with
+    oob_score=True.
 
     Args:
-        img_mi: Masked image
-        img_fi: Original image
-        nest: Number of decision trees (default=10)
+        model_i: RandomForestClassifier fitted with oob_score=True
+        ytrain_i: Labels the model was fitted on
 
     Returns:
-        model: The fitted model
+        np.ndarray: Confusion matrix, rows are true labels and columns
+                    predicted labels, in the order of model_i.classes_
+    '''
+    votes = model_i.oob_decision_function_
+    # Pixels drawn into the bootstrap sample of every tree have no vote
+    voted = np.isfinite(votes).all(axis=1) & (votes.sum(axis=1) > 0)
+    prediction = model_i.classes_[np.argmax(votes[voted], axis=1)]
+    truth = np.asarray(ytrain_i)[voted]
+    return metrics.confusion_matrix(truth, prediction, labels=model_i.classes_)
+
+def print_oob_accuracy(model_i, ytrain_i, confusion=None):
     '''
-    x = feature_extraction(img_fi,features_i) 
+    Print the out-of-bag accuracy and confusion matrix of a forest fitted
+    with oob_score=True.
+
+    Every pixel is classified by the trees that did not see it while
+    training, which estimates the accuracy on new pixels without holding
+    any labels back and without predicting the training set again.
+
+    Args:
+        model_i: RandomForestClassifier fitted with oob_score=True
+        ytrain_i: Labels the model was fitted on
+        confusion: Optional confusion matrix to report instead of the one
+                   of model_i, e.g. summed over sub-forests, see oob_confusion
+
+    Returns:
+        dict: OOB accuracy, class labels and confusion matrix (rows are
+              true labels, columns predicted labels)
+    '''
+    if confusion is None:
+        confusion = oob_confusion(model_i, ytrain_i)
+    accuracy = np.trace(confusion) / max(confusion.sum(), 1)
+    print("Out-of-bag accuracy = ", accuracy)
+    print("Confusion matrix (rows: label, columns: predicted), labels",
+          model_i.classes_.tolist())
+    print(confusion)
+    return {'accuracy': float(accuracy),
+            'labels': model_i.classes_.tolist(),
+            'confusion matrix': confusion.tolist()}
+
+def _training_rows(img_mi, img_fi, features_i, cache, n_jobs, tile_size, sparse,
+                   slices, max_per_class, spacing, groups, seed):
+    # Feature rows of the sampled labeled pixels, see train_random_forest
+    if isinstance(img_fi, (list, tuple)):
+        # Image by image, only the labeled rows are gathered
+        keeps = sample_labeled_images(img_mi, max_per_class=max_per_class,
+                                      spacing=spacing, seed=seed)
+        x, y = feature_extraction_labeled(img_fi, img_mi, features_i, keeps_i=keeps,
+                                          sparse=sparse, cache=cache, n_jobs=n_jobs,
+                                          tile_size=tile_size)
+        return x.values, y, x.names
+    # Labeled pixels the forest is trained on
+    keep = sample_labeled_pixels(img_mi, max_per_class=max_per_class, spacing=spacing,
+                                 groups=groups, seed=seed)
+    if sparse and slices is None:
+        # Only the labeled regions are filtered, the work scales with the
+        # annotated area
+        x, y = feature_extraction_sparse(img_fi, img_mi, features_i, n_jobs=n_jobs,
+                                         keep=keep, cache=cache)
+        return x.values, y, x.names
+    if slices is not None:
+        # Features of the annotated slices, using their neighbours
+        x = feature_extraction_volume(img_fi, features_i, slices=slices, n_jobs=n_jobs)
+    elif img_fi.ndim == 3:
+        # Every feature of every channel
+        x = feature_extraction_channels(img_fi, features_i, n_jobs=n_jobs)
+    else:
+        # The float32 feature matrix is used as is, sklearn does not convert it
+        x = feature_extraction(img_fi,features_i,cache=cache,n_jobs=n_jobs,
+                               tile_size=tile_size)
     # Define the dependent variable that needs to be predicted (labels)
     # we reshape it into a single vector. This has to be done, otherwise
     # the sklearn functions will not work.
     y = img_mi.reshape(-1)
-    # Get all position to where the vector is non-zero meaning we are ignoring
-    # values which have labels that are zero and vice-versa
-    nonzero_ind = np.argwhere(y).reshape(-1).tolist()
-    # Set new y and x
-    x,y = x.iloc[nonzero_ind], y[nonzero_ind]
-    # Create test and training data, with a 40% split - random state is kept constant
-    x_train, x_test, y_train, y_test = train_test_split(x, y, test_size=0.4, random_state=20)
-    # Build model - Random forrest with 10 desecision trees, random state is kept constant
-    model = RandomForestClassifier(n_estimators = nest, random_state = 42)
-    # Fit the model to the data
-    model.fit(x_train, y_train)
-    # Print accuracy
-    print_accuracy(model,x_train,x_test,y_train,y_test)
+    # Keep the sampled labeled pixels, unlabeled pixels (zero) are ignored
+    return x.values[keep], y[keep], x.names
+
+def train_random_forest(img_mi, img_fi, features_i, nest=10, cache=None, n_jobs=-1,
+                        tile_size=None, sparse=True, slices=None, max_per_class=None,
+                        spacing=1, groups=None, seed=0, forest_params=None,
+                        evaluation='oob'):
+    '''
+    Train a random forest model between the mask and image using features
+    from feature_extraction.
+
+    Args:
+        img_mi: Masked image, or list of the masks of several images
+        img_fi: Original image, or (C, H, W) channels of a multi-channel
+                image with img_mi of shape (H, W), or list of images that
+                can differ in size, see feature_extraction_labeled
+        features_i: List of selected feature names
+        nest: Number of decision trees (default=10)
+        cache: Optional FeatureCache to reuse previously computed features
+        n_jobs: Number of threads used for the feature extraction (default=-1)
+        tile_size: Tile edge length for tiled feature extraction (default=None)
+        sparse: Compute the features only around the labeled pixels, see
+                feature_extraction_sparse, which only reads the cache.
+                cache and tile_size are used for single-channel images,
+                tile_size only by the dense extraction (default=True)
+        slices: Volume mode, img_fi is a (Z, H, W) volume and img_mi holds
+                the masks of these slices (default=None)
+        max_per_class: Maximum number of training pixels per class, see
+                       sample_labeled_pixels (default=None, all pixels)
+        spacing: Keep one pixel per class in every spacing x spacing cell
+                 (default=1, all pixels)
+        groups: Source image of every pixel of img_mi, the per-class cap is
+                spread evenly over the sources (default=None). Lists of
+                images are always sampled per image
+        seed: Seed of the pixel sampling (default=0)
+        forest_params: Optional dict of random forest settings, see
+                       build_forest. nest is used unless it sets n_estimators
+        evaluation: 'oob' fits on all pixels and reports the out-of-bag
+                    accuracy, 'holdout' fits on 60% and tests on the other
+                    40%, None skips the evaluation (default='oob')
+
+    Returns:
+        model: The fitted model
+    '''
+    # Feature rows and labels of the sampled labeled pixels
+    x, y, names = _training_rows(img_mi, img_fi, features_i, cache, n_jobs, tile_size,
+                                 sparse, slices, max_per_class, spacing, groups, seed)
+    return fit_forest(x, y, nest=nest, forest_params=forest_params, evaluation=evaluation,
+                      names_i=names)
+
+def fit_forest(x_i, y_i, nest=10, forest_params=None, evaluation='oob', names_i=None):
+    '''
+    Fit a random forest on feature rows and report its accuracy.
+
+    Args:
+        x_i: Feature rows, (n_rows, n_features)
+        y_i: Labels of the rows
+        nest: Number of decision trees (default=10)
+        forest_params: Optional dict of random forest settings, see
+                       build_forest. nest is used unless it sets n_estimators
+        evaluation: 'oob', 'holdout' or None, see train_random_forest
+                    (default='oob')
+        names_i: Optional column names of x_i, see name_columns
+
+    Returns:
+        model: The fitted model
+    '''
+    x, y = x_i, y_i
+    # Build model - Random forrest with nest desecision trees, random state is kept constant
+    params = dict({'n_estimators': nest}, **(forest_params or {}))
+    if evaluation == 'holdout':
+        # Create test and training data, with a 40% split - random state is kept constant
+        x_train, x_test, y_train, y_test = train_test_split(x, y, test_size=0.4, random_state=20)
+        model = build_forest(params)
+        # Fit the model to the data
+        model.fit(x_train, y_train)
+        # Print accuracy
+        print_accuracy(model,x_train,x_test,y_train,y_test)
+    elif evaluation == 'oob':
+        # Learn from every labeled pixel, the trees vote on the pixels
+        # left out of their bootstrap sample
+        model = build_forest(dict(params, oob_score=True))
+        model.fit(x, y)
+        print_oob_accuracy(model, y)
+    elif evaluation is None:
+        model = build_forest(params)
+        model.fit(x, y)
+    else:
+        raise ValueError(f"Unknown evaluation {evaluation!r}, use 'oob', 'holdout' or None")
+    print("Forest size:", forest_summary(model))
+    if names_i is not None:
+        name_columns(model, names_i)
     # Return the model
     return model
 
-def predict_features(model_i, img_fi, features_i):
+def predict_features(model_i, img_fi, features_i, cache=None, n_jobs=-1, tile_size=None,
+                     slices=None):
     '''
     Predict features using a fitted RandomForestClassifier model.
 
     Args:
         model_i: Fitted RandomForestClassifier model.
-        img_fi: Original image
+        img_fi: Original image, or (C, H, W) channels of a multi-channel image
+        features_i: List of selected feature names
+        cache: Optional FeatureCache to reuse previously computed features
+        n_jobs: Number of threads used for the feature extraction (default=-1)
+        tile_size: Tile edge length for tiled feature extraction (default=None)
+        slices: Volume mode, img_fi is a (Z, H, W) volume and these slices
+                are segmented (default=None)
 
     Returns:
-        segmented: Segmented image
+        segmented: Segmented image, or segmented slices in volume mode
     '''
+    if slices is not None:
+        # A few slices at a time, the volume is never loaded as a whole
+        slices = np.asarray(slices)
+        segmented = np.empty((len(slices),) + img_fi.shape[1:], dtype=model_i.classes_.dtype)
+        for start in range(0, len(slices), 16):
+            chunk = slices[start:start + 16]
+            x = feature_extraction_volume(img_fi, features_i, slices=chunk,
+                                          n_jobs=n_jobs).values
+            segmented[start:start + len(chunk)] = model_i.predict(x).reshape(
+                (len(chunk),) + img_fi.shape[1:])
+        return segmented
+    if img_fi.ndim == 3:
+        # Every feature of every channel, segmented is H x W
+        x = feature_extraction_channels(img_fi, features_i, n_jobs=n_jobs).values
+        return model_i.predict(x).reshape(img_fi.shape[1:])
     # Get features to which the random forest shall be trained
-    x = feature_extraction(img_fi, features_i)
+    x = feature_extraction(img_fi, features_i, cache=cache, n_jobs=n_jobs,
+                           tile_size=tile_size).values
     # Get resulting output
     result = model_i.predict(x)
     # Segment image
     segmented = result.reshape((img_fi.shape))
     return segmented
+
+def predict_features_stack(model_i, stack_fi, features_i, cache=None, n_jobs=-1,
+                           batch_size=16):
+    '''
+    Predict features on a stack of equally sized images at once.
+
+    Args:
+        model_i: Fitted RandomForestClassifier model.
+        stack_fi: Original images (3D NumPy array N x H x W)
+        features_i: List of selected feature names
+        cache: Optional FeatureCache to reuse previously computed features
+        n_jobs: Number of threads used for the feature extraction (default=-1)
+        batch_size: Number of images filtered at once (default=16)
+
+    Returns:
+        segmented: Segmented images, N x H x W
+    '''
+    # Get features of all images as one matrix
+    x = feature_extraction_stack(stack_fi, features_i, cache=cache, n_jobs=n_jobs,
+                                 batch_size=batch_size).values
+    # Get resulting output
+    result = model_i.predict(x)
+    # Segment images
+    segmented = result.reshape((stack_fi.shape))
+    return segmented
@@ -0,0 +1,325 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: On-disk store of the labeled feature rows a forest is trained
+#              on, kept under output/training_rows. Rows are appended image
+#              by image to raw memory-mapped files: the feature matrix
+#              (optionally in float16) and a record per row with label,
+#              source image and pixel coordinates. Rows of edited or removed
+#              masks are retired and dropped by the next compaction, rows
+#              of unchanged images are never computed again. The folder can
+#              be copied elsewhere to train offline.
+##############################################################################
+"""Append-only memory-mapped store of labeled training rows"""
+# Import packages
+import json
+import os
+import shutil
+from pathlib import Path
+import numpy as np
+from asmgui.randomforest_classifier.feature_planner import FeaturePlan
+from asmgui.randomforest_classifier.feature_space import feature_extraction_sparse, select_features
+from asmgui.randomforest_classifier.incremental_training import mask_fingerprint
+from asmgui.randomforest_classifier.sampling import sample_labeled_pixels
+
+# Record stored for every row next to its features
+ROW_DTYPE = np.dtype([('label', '<i4'), ('source', '<i4'), ('y', '<i4'), ('x', '<i4')])
+
+# Bump when the file layout changes, older stores are rebuilt
+STORE_VERSION = 1
+
+class TrainingStore:
+    """
+    Labeled feature rows of the training images in append-only files.
+
+    Files in the store folder:
+        features.bin: (n_rows, n_columns) feature values, C order
+        rows.bin: n_rows records of ROW_DTYPE
+        index.json: Columns, settings and the row range of every image
+
+    Attributes:
+        folder (Path): Store folder, e.g. output/training_rows
+        features (list): Selected feature names
+        dtype (np.dtype): Data type of the stored feature values
+        n_rows (int): Number of stored rows, including retired ones
+    """
+
+    def __init__(self, folder, features, dtype=np.float32, max_per_class=None,
+                 spacing=1, seed=0, settings=None, keep_existing=False):
+        """
+        Open the store in folder, emptying it if it was built differently.
+
+        Args:
+            folder: Store folder, created if needed
+            features: List of selected feature names
+            dtype: Data type of the stored feature values, np.float16
+                   halves the size on disk (default=np.float32)
+            max_per_class: Maximum number of rows per class and image, see
+                           sample_labeled_pixels (default=None)
+            spacing: Sampling grid spacing, see sample_labeled_pixels (default=1)
+            seed: Seed of the sampling (default=0)
+            settings: Optional dict of further settings the rows depend on,
+                      e.g. the channel mode (JSON serializable)
+            keep_existing: Open existing rows as they are, even if they were
+                           built differently, see load (default=False)
+        """
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.features = select_features(features)
+        self.dtype = np.dtype(dtype)
+        self.max_per_class = max_per_class
+        self.spacing = spacing
+        self.seed = seed
+        # Everything the stored rows depend on
+        plan = FeaturePlan(self.features)
+        self._build = {'version': STORE_VERSION,
+                       'names': self.features,
+                       'features': repr([plan.signature(f) for f in self.features]),
+                       'dtype': self.dtype.str,
+                       'sampling': [max_per_class, spacing, seed],
+                       'settings': settings or {}}
+        self._index = self._read_index()
+        if self._index.get('build') != json.loads(json.dumps(self._build)):
+            if keep_existing and self._index:
+                self._build = self._index['build']
+            else:
+                self.clear()
+
+    # --- Files ---
+
+    def _path(self, name):
+        return self.folder / name
+
+    def _read_index(self):
+        try:
+            with open(self._path('index.json'), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self):
+        # Written after the rows, a crash leaves unindexed trailing bytes
+        # that are cut off on the next append
+        tmp = self._path('index.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self._index, f, indent=4)
+        os.replace(tmp, self._path('index.json'))
+
+    def clear(self):
+        '''Remove all rows.'''
+        for name in ('features.bin', 'rows.bin'):
+            self._path(name).unlink(missing_ok=True)
+        self._index = {'build': json.loads(json.dumps(self._build)), 'columns': None,
+                       'n rows': 0, 'next id': 0, 'images': {}, 'retired': 0}
+        self._write_index()
+
+    @property
+    def n_rows(self):
+        """Number of stored rows, including retired ones."""
+        return self._index['n rows']
+
+    @property
+    def columns(self):
+        """Names of the feature columns, None before the first rows."""
+        return self._index['columns']
+
+    def _append(self, x_i, rows_i):
+        # Cut off bytes of an interrupted append, then add the new rows
+        n_columns = x_i.shape[1]
+        for name, data, row_bytes in (('features.bin', x_i.astype(self.dtype),
+                                       n_columns * self.dtype.itemsize),
+                                      ('rows.bin', rows_i, ROW_DTYPE.itemsize)):
+            path = self._path(name)
+            with open(path, 'ab') as f:
+                f.truncate(self.n_rows * row_bytes)
+                f.write(np.ascontiguousarray(data).tobytes())
+
+    def arrays(self):
+        '''
+        Memory-mapped views of all stored rows, including retired ones.
+
+        Returns:
+            tuple: (n_rows, n_columns) feature values and n_rows records of
+                   ROW_DTYPE, both read-only
+        '''
+        if self.n_rows == 0:
+            return (np.empty((0, len(self.columns or self.features)), self.dtype),
+                    np.empty(0, ROW_DTYPE))
+        x = np.memmap(self._path('features.bin'), dtype=self.dtype, mode='r',
+                      shape=(self.n_rows, len(self.columns)))
+        rows = np.memmap(self._path('rows.bin'), dtype=ROW_DTYPE, mode='r',
+                         shape=(self.n_rows,))
+        return x, rows
+
+    # --- Updates ---
+
+    def update(self, masks, load_image, n_jobs=-1, cache=None):
+        '''
+        Bring the rows up to date with the current training masks.
+
+        Rows of removed or edited masks are retired, rows of new or edited
+        masks are extracted and appended one image at a time.
+
+        Args:
+            masks: Dict of label image per image key, all training images
+            load_image: Function returning the classifier input of an image key
+            n_jobs: Number of threads of the feature extraction (default=-1)
+            cache: Optional FeatureCache read by the extraction, see
+                   feature_extraction_sparse
+
+        Returns:
+            int: Number of appended rows
+        '''
+        images = self._index['images']
+        fingerprints = {str(key): mask_fingerprint(mask) for key, mask in masks.items()}
+        for key in list(images):
+            if fingerprints.get(key) != images[key]['fingerprint']:
+                self.remove(key)
+        appended = 0
+        for key, mask in masks.items():
+            if str(key) in images:
+                continue
+            keep = sample_labeled_pixels(mask, max_per_class=self.max_per_class,
+                                         spacing=self.spacing, seed=self.seed)
+            x, y = feature_extraction_sparse(load_image(key), mask, self.features,
+                                             n_jobs=n_jobs, keep=keep, cache=cache)
+            if self.columns is None:
+                self._index['columns'] = list(x.names)
+            rows = np.empty(len(keep), ROW_DTYPE)
+            rows['label'] = y
+            rows['source'] = self._index['next id']
+            rows['y'], rows['x'] = np.divmod(keep, mask.shape[-1])
+            self._append(x.values, rows)
+            images[str(key)] = {'id': self._index['next id'],
+                                'fingerprint': fingerprints[str(key)],
+                                'start': self.n_rows, 'stop': self.n_rows + len(keep)}
+            self._index['next id'] += 1
+            self._index['n rows'] += len(keep)
+            self._write_index()
+            appended += len(keep)
+        print(f"Training store: {appended} rows appended, {self.n_rows} rows of "
+              f"{len(images)} images in {self.folder}")
+        return appended
+
+    def remove(self, key):
+        '''
+        Retire the rows of an image, they are dropped by compact.
+
+        Args:
+            key: Image key, e.g. the path of the training image
+        '''
+        entry = self._index['images'].pop(str(key), None)
+        if entry is not None:
+            self._index['retired'] += entry['stop'] - entry['start']
+            self._write_index()
+
+    def compact(self, chunk_rows=1 << 18):
+        '''
+        Rewrite the files without retired rows, chunk by chunk.
+
+        Args:
+            chunk_rows: Number of rows copied at a time (default=262144)
+        '''
+        if self._index['retired'] == 0:
+            return
+        x, rows = self.arrays()
+        entries = sorted(self._index['images'].values(), key=lambda e: e['start'])
+        start = 0
+        with open(self._path('features.tmp'), 'wb') as fx, \
+                open(self._path('rows.tmp'), 'wb') as fr:
+            for entry in entries:
+                n = entry['stop'] - entry['start']
+                for offset in range(entry['start'], entry['stop'], chunk_rows):
+                    stop = min(offset + chunk_rows, entry['stop'])
+                    fx.write(np.ascontiguousarray(x[offset:stop]).tobytes())
+                    fr.write(np.ascontiguousarray(rows[offset:stop]).tobytes())
+                entry['start'], entry['stop'] = start, start + n
+                start += n
+        del x, rows
+        os.replace(self._path('features.tmp'), self._path('features.bin'))
+        os.replace(self._path('rows.tmp'), self._path('rows.bin'))
+        self._index['n rows'] = start
+        self._index['retired'] = 0
+        self._write_index()
+
+    # --- Training ---
+
+    def training_index(self, max_per_class=None, seed=0):
+        '''
+        Rows to fit a forest on, after compacting away retired rows.
+
+        Args:
+            max_per_class: Maximum number of rows per class over all images,
+                           spread evenly over the images (default=None)
+            seed: Seed of the selection (default=0)
+
+        Returns:
+            np.ndarray: Sorted row indices, None for all rows
+        '''
+        self.compact()
+        if max_per_class is None:
+            return None
+        _, rows = self.arrays()
+        return sample_labeled_pixels(np.asarray(rows['label']), max_per_class=max_per_class,
+                                     groups=np.asarray(rows['source']), seed=seed)
+
+    def training_data(self, max_per_class=None, seed=0):
+        '''
+        Feature rows and labels to fit a forest on.
+
+        Retired rows are compacted away first. Without a cap the feature
+        values are returned memory-mapped, sklearn reads float32 stores
+        without a copy.
+
+        Args:
+            max_per_class: Maximum number of rows per class over all images,
+                           spread evenly over the images (default=None)
+            seed: Seed of the selection (default=0)
+
+        Returns:
+            tuple: Feature rows and their labels
+        '''
+        keep = self.training_index(max_per_class=max_per_class, seed=seed)
+        x, rows = self.arrays()
+        if keep is None:
+            return x, np.asarray(rows['label'])
+        return x[keep], np.asarray(rows['label'][keep])
+
+    def export(self, destination):
+        '''
+        Copy the compacted store, to train offline without any filtering.
+
+        The copy is opened with TrainingStore.load.
+
+        Args:
+            destination: Folder receiving the store files
+
+        Returns:
+            Path: destination
+        '''
+        self.compact()
+        destination = Path(destination)
+        destination.mkdir(parents=True, exist_ok=True)
+        for name in ('features.bin', 'rows.bin', 'index.json'):
+            if self._path(name).exists():
+                shutil.copy2(self._path(name), destination / name)
+        print(f"Training store exported to {destination}")
+        return destination
+
+    @classmethod
+    def load(cls, folder):
+        '''
+        Open an existing store with the settings it was built with.
+
+        Args:
+            folder: Store folder, e.g. an export
+
+        Returns:
+            TrainingStore: The store
+        '''
+        with open(Path(folder) / 'index.json', 'r') as f:
+            build = json.load(f)['build']
+        max_per_class, spacing, seed = build['sampling']
+        # Never emptied, e.g. when the filters of this installation differ
+        return cls(folder, build['names'], dtype=build['dtype'], max_per_class=max_per_class,
+                   spacing=spacing, seed=seed, settings=build['settings'], keep_existing=True)
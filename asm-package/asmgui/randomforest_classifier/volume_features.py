@@ -0,0 +1,49 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Volumetric features for serial-section and tomography
+#              stacks. The filters smooth and differentiate along z as well,
+#              so that a slice is classified using its neighbours. They are
+#              computed by feature_extraction_volume on blocks of slices
+#              padded with halo slices, the volume is never loaded as a
+#              whole.
+#
+# References:  https://docs.scipy.org/doc/scipy/reference/ndimage.html
+##############################################################################
+"""Volumetric (3D) feature family"""
+# Import packages
+import numpy as np
+from scipy import ndimage as nd
+from asmgui.randomforest_classifier.feature_registry import register_feature
+
+# Scales (σ in voxels, isotropic) of the volumetric filters
+VOLUME_SCALES = (1.0, 3.0)
+
+def _radius(sigma, order=0):
+    # Kernel radius of the scipy Gaussian filters, truncated at 4σ
+    return int(4.0 * sigma + 0.5) + order
+
+def _gaussian_3d(vol_f, sigma):
+    return nd.gaussian_filter(vol_f, sigma=sigma)
+
+def _gradient_magnitude_3d(vol_f, sigma):
+    return nd.gaussian_gradient_magnitude(vol_f, sigma=sigma)
+
+def _laplacian_3d(vol_f, sigma):
+    return nd.gaussian_laplace(vol_f, sigma=sigma)
+
+def _median_3d(vol_i, size):
+    return nd.median_filter(vol_i, size=size)
+
+for sigma in VOLUME_SCALES:
+    register_feature(f'3D Gaussian σ={sigma:g}', inputs=('float32 image',),
+                     params={'sigma': sigma}, radius=_radius(sigma),
+                     cost=1.5 * sigma, default=False, volume=True)(_gaussian_3d)
+    register_feature(f'3D gradient magnitude σ={sigma:g}', inputs=('float32 image',),
+                     params={'sigma': sigma}, radius=_radius(sigma),
+                     cost=4.5 * sigma, default=False, volume=True)(_gradient_magnitude_3d)
+    register_feature(f'3D Laplacian σ={sigma:g}', inputs=('float32 image',),
+                     params={'sigma': sigma}, radius=_radius(sigma),
+                     cost=4.5 * sigma, default=False, volume=True)(_laplacian_3d)
+register_feature('3D median size=3', params={'size': 3}, radius=1, dtype=np.uint8,
+                 cost=2.0, default=False, volume=True)(_median_3d)
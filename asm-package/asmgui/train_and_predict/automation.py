@@ -2,7 +2,9 @@
 from tkinter import ttk
 import tkinter as tk
 import numpy as np
-from ..randomforest_classifier.training_functions import predict_features
+from ..randomforest_classifier.training_functions import predict_features, predict_features_stack
+from ..randomforest_classifier.feature_cache import feature_cache_for
+from .prediction import volume_for, classifier_input
 import PIL.Image
 from pathlib import Path
 from ..image_analysis.image_analysis_tools import ensure_rgba
@@ -213,51 +215,85 @@ class AutomationManager(ttk.Frame):
         total_images = len(selected_filenames)
         print(f"📂 Predictions will be saved in: {prediction_folder}")
 
-        # Run through the selected images
-        for idx, img_path in enumerate(selected_filenames):
-            
-            # Get image names
-            img_name = Path(img_path).stem
-            
-            # Create numpy and png extension for saving
-            pred_npy = prediction_folder / f"{img_name}_pred.npy"
-            pred_png = prediction_folder / f"{img_name}_pred.png"
-            
-            # Print progression
-            print(f"🔄 Processing {img_name} ({idx + 1}/{total_images})")
+        # Feature planes are cached in output/features and reused across runs
+        cache = feature_cache_for(parent.filedirectory)
 
-            # Load image and convert to RGBA if necessary
-            img_rgb = ensure_rgba(img_path)
-            img_gra = img_rgb.convert("L")
-            
-            # preprocess for random-forest -> grayscale -> numpy array 
-            img_array = np.array(img_rgb.convert("L"))
+        # Get features
+        features = parent.feature_selector.get_selected_features()
 
-            # Get features
-            features = parent.feature_selector.get_selected_features()
+        # Run through the selected images, a batch of images at a time
+        batch_size = parent.feature_stack_size
+        for start in range(0, total_images, batch_size):
+            batch_paths = selected_filenames[start:start + batch_size]
 
-            # Predict features onto image
-            img_prediction = predict_features(parent.RFmodel, img_array, features)
+            # Load images and convert to RGBA if necessary
+            batch_rgb = [ensure_rgba(img_path) for img_path in batch_paths]
+            
+            # preprocess for random-forest -> grayscale or channels -> numpy array 
+            batch_arrays = [classifier_input(parent, img_rgb) for img_rgb in batch_rgb]
+
+            # Volume slices are filtered with their neighbours, equally
+            # sized images that fit in one tile as one stack, others one by one
+            shape = batch_arrays[0].shape
+            if parent.feature_volume_mode:
+                batch_predictions = predict_features(
+                    parent.RFmodel, volume_for(parent), features,
+                    n_jobs=parent.feature_n_jobs,
+                    slices=[parent.img_filenames.index(p) for p in batch_paths])
+            elif len(batch_arrays) > 1 and len(shape) == 2 and \
+                    all(a.shape == shape for a in batch_arrays) and \
+                    (parent.feature_tile_size is None or
+                     batch_arrays[0].size <= parent.feature_tile_size**2):
+                batch_predictions = predict_features_stack(
+                    parent.RFmodel, np.stack(batch_arrays), features, cache=cache,
+                    n_jobs=parent.feature_n_jobs, batch_size=batch_size)
+            else:
+                batch_predictions = [
+                    predict_features(parent.RFmodel, img_array, features, cache=cache,
+                                     n_jobs=parent.feature_n_jobs,
+                                     tile_size=parent.feature_tile_size)
+                    for img_array in batch_arrays]
+
+            for offset, (img_path, img_rgb, img_array, img_prediction) in enumerate(
+                    zip(batch_paths, batch_rgb, batch_arrays, batch_predictions)):
+                self.save_prediction(parent, prediction_folder, img_path, img_rgb,
+                                     img_array, img_prediction,
+                                     start + offset, total_images)
+
+        print("🎉 Automation completed successfully!")
+        self.progress_bar['value'] = 100  # Complete
 
-            # Predict
-            prediction_mask = img_prediction.reshape(img_array.shape)
+    def save_prediction(self, parent, prediction_folder, img_path, img_rgb,
+                        img_array, img_prediction, idx, total_images):
+        """
+        Save the prediction of one image as .npy and as colored .png overlay.
+        """
+        # Get image names
+        img_name = Path(img_path).stem
+        
+        # Create numpy and png extension for saving
+        pred_npy = prediction_folder / f"{img_name}_pred.npy"
+        pred_png = prediction_folder / f"{img_name}_pred.png"
+        
+        # Print progression
+        print(f"🔄 Processing {img_name} ({idx + 1}/{total_images})")
 
-            # Save .npy
-            np.save(pred_npy, prediction_mask)
+        # Prediction mask in the shape of the image
+        prediction_mask = img_prediction.reshape(img_array.shape[-2:])
 
-            # Save color overlay as PNG
-            img_rgb = np.array(img_rgb)
-            for label_idx, rgb in enumerate(parent.lab_color_rgb, start=1):
-                img_rgb[prediction_mask == label_idx, :3] = rgb
-            overlay_pil = PIL.Image.fromarray(img_rgb, mode="RGBA")
-            overlay_pil.save(pred_png)
+        # Save .npy
+        np.save(pred_npy, prediction_mask)
 
-            print(f"✅ Saved: {pred_npy.name}, {pred_png.name}")
+        # Save color overlay as PNG
+        img_rgb = np.array(img_rgb)
+        for label_idx, rgb in enumerate(parent.lab_color_rgb, start=1):
+            img_rgb[prediction_mask == label_idx, :3] = rgb
+        overlay_pil = PIL.Image.fromarray(img_rgb, mode="RGBA")
+        overlay_pil.save(pred_png)
 
-            # Update progress bar
-            progress = ((idx + 1) / total_images) * 100
-            self.progress_bar['value'] = progress
-            parent.update_idletasks()
+        print(f"✅ Saved: {pred_npy.name}, {pred_png.name}")
 
-        print("🎉 Automation completed successfully!")
-        self.progress_bar['value'] = 100  # Complete
+        # Update progress bar
+        progress = ((idx + 1) / total_images) * 100
+        self.progress_bar['value'] = progress
+        parent.update_idletasks()
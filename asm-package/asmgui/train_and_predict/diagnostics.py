@@ -93,11 +93,13 @@ class PiechartClassifier(ttk.Frame):
     
         
     def update_from_model(self, parent):
-        # Selected feature names (same order as the model’s features)
-        feature_names = parent.feature_selector.get_selected_features()
-    
         # Mean importances across trees
         importances = parent.RFmodel.feature_importances_
+
+        # Names of the columns the model was trained on, see name_columns
+        feature_names = getattr(parent.RFmodel, 'feature_columns_', None)
+        if feature_names is None or len(feature_names) != len(importances):
+            feature_names = [f"Column {i + 1}" for i in range(len(importances))]
     
         # Std across trees
         std = np.std([t.feature_importances_ for t in parent.RFmodel.estimators_], axis=0)
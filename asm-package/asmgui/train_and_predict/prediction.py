@@ -6,12 +6,87 @@ import matplotlib.pyplot as plt
 import numpy as np
 from ..randomforest_classifier.training_functions import predict_features
 from ..randomforest_classifier.training_functions import train_random_forest
+from ..randomforest_classifier.training_functions import forest_summary, fit_forest
+from ..randomforest_classifier.training_store import TrainingStore
+from ..randomforest_classifier.sharded_training import train_sharded
+from ..randomforest_classifier.feature_cache import feature_cache_for
+from ..randomforest_classifier.feature_space import default_features, feature_extraction_labeled
+from ..randomforest_classifier.feature_space import volume_from_images
+from ..randomforest_classifier.feature_planner import FeaturePlan
+from ..randomforest_classifier.feature_registry import FEATURE_REGISTRY
+from ..randomforest_classifier.feature_selection import prune_features
+from ..randomforest_classifier.feature_prefetch import FeaturePrefetcher
+from ..randomforest_classifier.sampling import sample_labeled_images
+from ..randomforest_classifier.incremental_training import IncrementalForest
+from ..randomforest_classifier.model_store import training_fingerprint, save_model, load_model
+from ..randomforest_classifier.hyperparameter_search import search_forest_params
+from ..randomforest_classifier.hyperparameter_search import pareto_front, choose_configuration
+from ..randomforest_classifier.feature_space import feature_extraction, feature_extraction_channels
+from ..load_images.json_loader import JsonSaver
 from ..image_analysis.image_analysis_tools import ensure_rgba
 import PIL.Image
 import json
+import hashlib
 from pathlib import Path
 from tkinter import filedialog
 
+def classifier_input(parent, image):
+    """Array the classifier works on for a loaded PIL image.
+
+    Args:
+        parent: The parent widget holding feature_channels_mode.
+        image: PIL image
+
+    Returns:
+        np.ndarray: (H, W) grayscale image, or (3, H, W) RGB channels in
+        channel mode
+    """
+    if parent.feature_channels_mode:
+        return np.array(image.convert("RGB")).transpose(2, 0, 1)
+    return np.array(image.convert("L"))
+
+def volume_for(parent):
+    """Memory-mapped volume of all loaded images, in slice order.
+
+    The volume is written to output/volume once per list of images and
+    reused afterwards, until one of the images changes.
+
+    Args:
+        parent: The parent widget containing the image paths.
+
+    Returns:
+        np.memmap: (Z, H, W) grayscale volume
+    """
+    # One file per ordered list of images, their size and modification
+    # time tell edited or replaced images apart
+    h = hashlib.sha1()
+    for path in parent.img_filenames:
+        stat = Path(path).stat()
+        h.update(f"{path}\n{stat.st_size}\n{stat.st_mtime_ns}\n".encode())
+    key = h.hexdigest()[:16]
+    volume_folder = Path(parent.filedirectory) / "output" / "volume"
+    filename = volume_folder / f"volume_{key}.npy"
+    if filename.exists():
+        return np.load(filename, mmap_mode='r')
+    volume_folder.mkdir(parents=True, exist_ok=True)
+    print(f"Writing volume of {len(parent.img_filenames)} slices to {filename}")
+    return volume_from_images(parent.img_filenames,
+                              lambda p: np.array(ensure_rgba(p).convert("L")),
+                              filename)
+
+def column_features(names, features):
+    """Selected feature of every feature matrix column.
+
+    Args:
+        names: Column names, e.g. 'Sobel' or 'Sobel (G)' in channel mode.
+        features: Selected feature names.
+
+    Returns:
+        dict: Feature name per column name
+    """
+    return {name: next(f for f in features if name == f or name.startswith(f + ' ('))
+            for name in names}
+
 class ClassifierText(ttk.Frame):
     """A frame widget that displays a label for the RF classifier.
 
@@ -72,18 +147,35 @@ class FeatureSelector(tk.Frame):
         # Section label
         l = ttk.Label(self, text="Select Features:", 
                       font=('Times', 10, 'bold'), anchor="w", justify="left")
-        l.grid(row=0, column=0, sticky='w', padx=2, pady=(2, 5))
+        l.pack(side="top", anchor='w', padx=2, pady=(2, 5))
 
-        # Features list
-        self.features = parent.features
+        # Scrollable frame, the registry holds more features than fit
+        canvas = tk.Canvas(self, borderwidth=0, highlightthickness=0)
+        scrollbar = ttk.Scrollbar(self, orient="vertical", command=canvas.yview)
+        scroll_frame = tk.Frame(canvas)
+        scroll_frame.bind(
+            "<Configure>",
+            lambda e: canvas.configure(scrollregion=canvas.bbox("all"))
+        )
+        canvas.create_window((0, 0), window=scroll_frame, anchor="nw")
+        canvas.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side="right", fill="y")
+        canvas.pack(side="left", fill="both", expand=True)
+
+        # Features list, volumetric features need the images as one volume
+        self.features = [f for f in parent.features
+                         if parent.feature_volume_mode or not FEATURE_REGISTRY[f].volume]
         self.feature_vars = {}  # Holds BooleanVars for each feature
+        selected = default_features()
 
         # Create checkboxes for each feature
-        for i, feature in enumerate(self.features, start=1):
-            var = tk.BooleanVar(value=True)  # Default: selected
-            cb = ttk.Checkbutton(self, text=feature, variable=var)
+        for i, feature in enumerate(self.features):
+            var = tk.BooleanVar(value=feature in selected)  # Registry default
+            cb = ttk.Checkbutton(scroll_frame, text=feature, variable=var)
             cb.grid(row=i, column=0, sticky='w', padx=5, pady=1)
+            var.trace_add("write", lambda *args: self.selection_changed(parent))
             self.feature_vars[feature] = var
+        self._prefetch_after = None
 
     def get_selected_features(self):
         """
@@ -91,6 +183,43 @@ class FeatureSelector(tk.Frame):
         """
         return [f for f, v in self.feature_vars.items() if v.get()]
 
+    def prefetch(self, parent):
+        """
+        Compute the selected features of the loaded images in the background,
+        the current image and its neighbours first, if enabled.
+
+        Args:
+            parent: The parent widget holding the loaded images.
+        """
+        if not parent.feature_prefetch or not parent.img_filenames:
+            return
+        # Multi-channel and volume extraction do not use the feature cache
+        if parent.feature_channels_mode or parent.feature_volume_mode:
+            return
+        if parent.feature_prefetcher is None:
+            parent.feature_prefetcher = FeaturePrefetcher(
+                lambda p: classifier_input(parent, ensure_rgba(p)),
+                tile_size=parent.feature_tile_size)
+        parent.feature_prefetcher.schedule(parent.img_filenames,
+                                           self.get_selected_features(),
+                                           feature_cache_for(parent.filedirectory),
+                                           current=parent.img_numb)
+
+    def selection_changed(self, parent):
+        """
+        Pause the background computation while the selection is edited and
+        restart it with the new selection once no box changed for a second.
+
+        Args:
+            parent: The parent widget.
+        """
+        if parent.feature_prefetcher is None:
+            return
+        parent.feature_prefetcher.pause()
+        if self._prefetch_after is not None:
+            self.after_cancel(self._prefetch_after)
+        self._prefetch_after = self.after(1000, lambda: self.prefetch(parent))
+
 class ClassifierButtons(ttk.Frame):
     """A frame widget that provides buttons for training and predicting with a classifier.
 
@@ -130,19 +259,28 @@ class ClassifierButtons(ttk.Frame):
                         padx=20, pady=0,       # Reduce vertical padding
                         height=1,
                         command=lambda: self.predict(parent))
+        bs = tk.Button(self, text='prune',
+                        font=("Segoe UI", 10),
+                        relief="solid", bd=1,  # Solid border
+                        highlightthickness=1,
+                        padx=20, pady=0,       # Reduce vertical padding
+                        height=1,
+                        command=lambda: self.prune(parent))
         # Position buttons
         bt.pack(side='left', anchor='e', expand=True, fill='both')
         bp.pack(side='right', anchor='w', expand=True, fill='both')
+        bs.pack(side='right', anchor='w', expand=True, fill='both')
 
     @staticmethod
-    def train(parent):
-        """Train a random forest decision tree on the image data.
+    def load_training_set(parent):
+        """Load the training images and their masks.
 
         Args:
-            parent: The parent widget containing the image data and model list.
+            parent: The parent widget containing the training image paths.
+
+        Returns:
+            tuple: Lists of images, see classifier_input, and of masks
         """
-        print('Training random forest decision tree on image')
-        
         ## Initiate lists
         image_list = []
         masks_list = []
@@ -150,8 +288,7 @@ class ClassifierButtons(ttk.Frame):
         ## run through image paths
         for img_path in parent.training_image_paths:
             ## Get original image
-            orig_image = ensure_rgba(img_path).convert("L")
-            orig_array = np.array(orig_image)
+            orig_array = classifier_input(parent, ensure_rgba(img_path))
             ## Filename and path
             mask_filename = Path(img_path).stem + "_mask.npy"
             mask_path = Path(parent.filedirectory) / "output" / "masks" / mask_filename
@@ -160,17 +297,254 @@ class ClassifierButtons(ttk.Frame):
             ## Append to list's 
             image_list.append(orig_array)
             masks_list.append(mask_array)
+        return image_list, masks_list
+
+    @staticmethod
+    def sampling_options(parent, masks_list=None, axis=-1):
+        """Training pixel sampling settings of the GUI.
+
+        Args:
+            parent: The parent widget holding the sampling settings.
+            masks_list: Masks of the training images in merge order, when
+                they are merged into one (default=None, image by image).
+            axis: Axis along which the masks are merged (default=-1).
+
+        Returns:
+            dict: Keyword arguments of sample_labeled_pixels, or of
+            sample_labeled_images without masks_list
+        """
+        options = {'max_per_class': parent.train_max_per_class,
+                   'spacing': parent.train_spacing,
+                   'seed': parent.train_seed}
+        if masks_list is not None:
+            # Source image of every pixel of the merged masks
+            options['groups'] = np.concatenate([np.full(m.shape, i, dtype=np.int32)
+                                                for i, m in enumerate(masks_list)], axis=axis)
+        return options
+
+    @staticmethod
+    def update_incremental(parent, features):
+        """Refit only the trees affected by added, edited or removed masks.
+
+        Args:
+            parent: The parent widget containing the training image paths.
+            features: List of selected feature names.
+
+        Returns:
+            model: Combined random forest, None without two labeled classes
+        """
+        forest = parent.incremental_forest
+        # Everything the rows and trees depend on
+        settings = {'forest_params': parent.forest_params,
+                    'max_per_class': parent.train_max_per_class,
+                    'spacing': parent.train_spacing, 'seed': parent.train_seed,
+                    'settings': {"channels": parent.feature_channels_mode}}
+        if forest is None or not forest.settings_match(features, **settings):
+            # New features or settings, start from scratch
+            forest = IncrementalForest(
+                lambda p: classifier_input(parent, ensure_rgba(p)), features,
+                n_jobs=parent.feature_n_jobs, cache=feature_cache_for(parent.filedirectory),
+                **settings)
+            parent.incremental_forest = forest
+        # Masks only, images are loaded for added or edited masks
+        return forest.update(ClassifierButtons.load_masks(parent))
+
+    @staticmethod
+    def load_masks(parent):
+        """Load the masks of the training images.
+
+        Args:
+            parent: The parent widget containing the training image paths.
+
+        Returns:
+            dict: Mask per training image path
+        """
+        masks = {}
+        for img_path in parent.training_image_paths:
+            mask_path = Path(parent.filedirectory) / "output" / "masks" / (Path(img_path).stem + "_mask.npy")
+            masks[img_path] = np.load(mask_path)
+        return masks
+
+    @staticmethod
+    def update_store(parent, features):
+        """Train from the on-disk store of labeled rows, extracting only
+        the rows of added or edited masks.
+
+        Args:
+            parent: The parent widget containing the training image paths.
+            features: List of selected feature names.
+
+        Returns:
+            model: Fitted random forest
+        """
+        store = TrainingStore(Path(parent.filedirectory) / "output" / "training_rows", features,
+                              dtype=parent.train_store_dtype,
+                              max_per_class=parent.train_max_per_class,
+                              spacing=parent.train_spacing, seed=parent.train_seed,
+                              settings={"channels": parent.feature_channels_mode})
+        store.update(ClassifierButtons.load_masks(parent),
+                     lambda p: classifier_input(parent, ensure_rgba(p)),
+                     n_jobs=parent.feature_n_jobs,
+                     cache=feature_cache_for(parent.filedirectory))
+        if parent.train_shards > 1:
+            # Sub-forests fitted in separate processes, merged into one
+            return train_sharded(store, parent.train_shards, forest_params=parent.forest_params,
+                                 max_per_class=parent.train_max_per_class,
+                                 seed=parent.train_seed,
+                                 n_jobs=parent.forest_params.get('n_jobs', -1),
+                                 evaluation=parent.train_evaluation)
+        x, y = store.training_data(max_per_class=parent.train_max_per_class,
+                                   seed=parent.train_seed)
+        return fit_forest(x, y, forest_params=parent.forest_params,
+                          evaluation=parent.train_evaluation, names_i=store.columns)
+
+    @staticmethod
+    def training_fingerprint(parent, features):
+        """Fingerprint of the masks and settings a model is trained on.
+
+        Args:
+            parent: The parent widget containing the training set and settings.
+            features: List of selected feature names.
+
+        Returns:
+            str: Hex digest, see training_fingerprint
+        """
+        mask_paths = [Path(parent.filedirectory) / "output" / "masks" / (Path(p).stem + "_mask.npy")
+                      for p in parent.training_image_paths]
+        # Everything but the number of cores changes the model
+        settings = {"images": [str(p) for p in parent.training_image_paths],
+                    "forest": {k: v for k, v in parent.forest_params.items() if k != "n_jobs"},
+                    "sampling": [parent.train_max_per_class, parent.train_spacing,
+                                 parent.train_seed],
+                    "evaluation": parent.train_evaluation,
+                    "incremental": parent.train_incremental,
+                    "store": [parent.train_store, parent.train_store_dtype],
+                    "shards": parent.train_shards,
+                    "channels": parent.feature_channels_mode,
+                    "volume": parent.feature_volume_mode}
+        return training_fingerprint(mask_paths, features, settings)
+
+    @staticmethod
+    def restore_model(parent):
+        """Use the saved model if it was trained on the current training set.
+
+        Args:
+            parent: The parent widget containing the training set and settings.
+
+        Returns:
+            bool: True if a model was restored
+        """
+        features = parent.feature_selector.get_selected_features()
+        try:
+            fingerprint = ClassifierButtons.training_fingerprint(parent, features)
+        except OSError as error:
+            print(f"No saved model restored: {error}")
+            return False
+        model = load_model(Path(parent.filedirectory) / "output", fingerprint)
+        if model is None:
+            return False
+        ClassifierButtons.finish_training(parent, model, fingerprint)
+        return True
+
+    @staticmethod
+    def train(parent):
+        """Train a random forest decision tree on the image data.
+
+        Args:
+            parent: The parent widget containing the image data and model list.
+        """
+        print('Training random forest decision tree on image')
         
-        # Merge images and train the model
-        img_fj = np.concatenate(image_list,axis=1)
-        img_mj = np.concatenate(masks_list,axis=1)     
         # Get selected features
         features = parent.feature_selector.get_selected_features()
-        print("Selected Features:", features) ## WE NEED TO GET THE FEATURES HERE
-        # Train model
-        model = train_random_forest(img_mj,img_fj,features)
+        if not parent.feature_volume_mode and \
+                any(FEATURE_REGISTRY[f].volume for f in features if f in FEATURE_REGISTRY):
+            print('3D features are only available in volume mode, untick them to train')
+            return
+
+        # Nothing to do when the model was trained on the same masks and settings
+        fingerprint = ClassifierButtons.training_fingerprint(parent, features)
+        if getattr(parent, 'RFmodel', None) is not None and parent.model_fingerprint == fingerprint:
+            print('Training set unchanged, keeping the trained model')
+            return
+        output_folder = Path(parent.filedirectory) / "output"
+        model = load_model(output_folder, fingerprint)
+        if model is None:
+            model = ClassifierButtons.fit_model(parent, features)
+            if model is None:
+                return
+            save_model(model, output_folder, features, fingerprint)
+        ClassifierButtons.finish_training(parent, model, fingerprint)
+
+    @staticmethod
+    def fit_model(parent, features):
+        """Fit a random forest on the training set.
+
+        Args:
+            parent: The parent widget containing the image data and settings.
+            features: List of selected feature names.
+
+        Returns:
+            model: Fitted random forest, None without two labeled classes
+            in incremental mode or without any loaded slice in volume mode
+        """
+        if parent.train_incremental and not parent.feature_volume_mode:
+            # Grow the previous forest instead of training a new one
+            return ClassifierButtons.update_incremental(parent, features)
+        if (parent.train_store or parent.train_shards > 1) and not parent.feature_volume_mode:
+            # Rows of unchanged masks are read back from output/training_rows
+            return ClassifierButtons.update_store(parent, features)
+
+        if parent.feature_volume_mode:
+            # Annotated slices of the volume, classified with their neighbours.
+            # The features come from the volume, only the masks are loaded
+            slice_of = {str(p): z for z, p in enumerate(parent.img_filenames)}
+            masks = ClassifierButtons.load_masks(parent)
+            missing = [p for p in masks if str(p) not in slice_of]
+            if missing:
+                print(f"Training images not among the loaded images, skipped: {missing}")
+            slices = [slice_of[str(p)] for p in masks if str(p) in slice_of]
+            if not slices:
+                print("No training image is a slice of the loaded volume")
+                return None
+            order = np.argsort(slices)
+            masks_list = [m for p, m in masks.items() if str(p) in slice_of]
+            masks_list = [masks_list[i] for i in order]
+            model = train_random_forest(np.stack(masks_list),
+                                        volume_for(parent), features,
+                                        n_jobs=parent.feature_n_jobs,
+                                        slices=np.array(slices)[order],
+                                        forest_params=parent.forest_params,
+                                        evaluation=parent.train_evaluation,
+                                        **ClassifierButtons.sampling_options(
+                                            parent, [m[None] for m in masks_list], axis=0))
+        else:
+            # Load training images and masks
+            image_list, masks_list = ClassifierButtons.load_training_set(parent)
+            # Train model image by image, the images may differ in size.
+            # Planes cached in output/features by prediction or prefetching
+            # are read instead of filtered
+            cache = feature_cache_for(parent.filedirectory)
+            model = train_random_forest(masks_list,image_list,features,cache=cache,
+                                        n_jobs=parent.feature_n_jobs,
+                                        tile_size=parent.feature_tile_size,
+                                        forest_params=parent.forest_params,
+                                        evaluation=parent.train_evaluation,
+                                        **ClassifierButtons.sampling_options(parent))
+        return model
+
+    @staticmethod
+    def finish_training(parent, model, fingerprint=None):
+        """Store a trained model and refresh the widgets showing it.
+
+        Args:
+            parent: The parent widget containing the model.
+            model: Trained random forest.
+            fingerprint: Training fingerprint of the model (default=None).
+        """
         # Append model to parent main
         parent.RFmodel = model
+        parent.model_fingerprint = fingerprint
         print('training finished')
         # Refresh Training Set Manager to show new image
         if hasattr(parent, 'training_set_manager'):
@@ -179,6 +553,45 @@ class ClassifierButtons(ttk.Frame):
         # Refresh pie-chart after training
         parent.piechart_classifier.update_from_model(parent)            
 
+        # Show the size of the new forest
+        if hasattr(parent, 'training_settings'):
+            parent.training_settings.refresh(parent)
+
+    @staticmethod
+    def prune(parent):
+        """Keep the cheapest features that are about as accurate as all
+        selected ones, and tick only those.
+
+        Args:
+            parent: The parent widget containing the image data and feature selector.
+        """
+        print('Pruning selected features')
+        
+        # Load training images and masks
+        image_list, masks_list = ClassifierButtons.load_training_set(parent)
+        features = parent.feature_selector.get_selected_features()
+        # Extract the sampled labeled rows image by image like for training,
+        # measuring time and memory per feature
+        keeps = sample_labeled_images(masks_list, **ClassifierButtons.sampling_options(parent))
+        profile = {}
+        x, y = feature_extraction_labeled(image_list, masks_list, features, keeps_i=keeps,
+                                          n_jobs=parent.feature_n_jobs, profile=profile)
+        costs = FeaturePlan(features).feature_costs(profile)
+        # Search the subset of features, channel columns go with their
+        # feature, validated on other images than the ones trained on
+        groups = np.concatenate([np.full(len(k), i) for i, k in enumerate(keeps)])
+        selected, report = prune_features(x.values, y, x.names, costs,
+                                          owners_i=column_features(x.names, features),
+                                          groups_i=groups,
+                                          tolerance=parent.prune_tolerance,
+                                          forest_params=parent.forest_params)
+        for feature, var in parent.feature_selector.feature_vars.items():
+            var.set(feature in selected)
+        # Keep the result with the training set
+        parent.feature_pruning = report
+        JsonSaver.save_training_set(parent)
+        print('pruning finished')
+
     @staticmethod
     def predict(parent):
         """Predict features onto the image using the trained model.
@@ -195,21 +608,213 @@ class ClassifierButtons(ttk.Frame):
         
         #parent.image_c = ensure_rgba(img_filename)
         
-        ## Convert the unomodified pil-image into graysacel 2D numpy array
-        img_i = np.array(parent.image_c.convert("L"))       
+        ## Convert the unomodified pil-image into a numpy array
+        img_i = classifier_input(parent, parent.image_c)
         # Get selected features
         features = parent.feature_selector.get_selected_features()     
-        # Predict features onto image
-        img_j = predict_features(parent.RFmodel,img_i,features)
+        if parent.feature_volume_mode:
+            # Predict the current slice of the volume
+            img_j = predict_features(parent.RFmodel, volume_for(parent), features,
+                                     n_jobs=parent.feature_n_jobs,
+                                     slices=[parent.img_numb])[0]
+        else:
+            # Predict features onto image, reusing cached feature planes
+            cache = feature_cache_for(parent.filedirectory)
+            img_j = predict_features(parent.RFmodel,img_i,features,cache=cache,
+                                     n_jobs=parent.feature_n_jobs,
+                                     tile_size=parent.feature_tile_size)
         # Show images
         f, (ax1, ax2) = plt.subplots(1,2,sharey=True)
-        ax1.imshow(img_i)
+        ax1.imshow(np.moveaxis(img_i, 0, -1) if img_i.ndim == 3 else img_i)
         ax2.imshow(img_j)
         plt.tight_layout()
         plt.show()
         print('prediction finished')
 
 
+class TrainingSettings(ttk.Frame):
+    """A frame widget next to the classifier buttons that opens the random
+    forest and pixel sampling settings and shows the size of the trained forest.
+
+    Attributes:
+        parent: The parent widget in which this frame is placed.
+    """
+
+    # Label, parent attribute, forest_params key, type and whether the
+    # setting may be left empty (None) of every setting
+    SETTINGS = [("Trees", "forest_params", "n_estimators", int, False),
+                ("Max depth", "forest_params", "max_depth", int, True),
+                ("Min samples per leaf", "forest_params", "min_samples_leaf", int, False),
+                ("Samples per tree (fraction)", "forest_params", "max_samples", float, True),
+                ("Cores (-1 = all)", "forest_params", "n_jobs", int, False),
+                ("Max pixels per class", "train_max_per_class", None, int, True),
+                ("Pixel spacing", "train_spacing", None, int, False),
+                ("Seed", "train_seed", None, int, False)]
+
+    def __init__(self, parent):
+        """Initialize the frame and place it within the parent widget.
+
+        Args:
+            parent: The parent widget in which this frame is placed.
+        """
+        super().__init__(parent)
+        self.place(relx=0.165, rely=0.095 + 0.04+2.0*0.08+0.03+0.0115+0.04+0.2,
+                   relwidth=0.15,relheight=0.03)
+        self.create_widget(parent)
+
+    def create_widget(self, parent):
+        """Create the settings button and the forest size label.
+
+        Args:
+            parent: The parent widget.
+        """
+        bs = tk.Button(self, text='forest settings',
+                        font=("Segoe UI", 10),
+                        relief="solid", bd=1,  # Solid border
+                        highlightthickness=1,
+                        padx=20, pady=0,       # Reduce vertical padding
+                        height=1,
+                        command=lambda: self.open_settings(parent))
+        bt = tk.Button(self, text='tune',
+                        font=("Segoe UI", 10),
+                        relief="solid", bd=1,  # Solid border
+                        highlightthickness=1,
+                        padx=10, pady=0,       # Reduce vertical padding
+                        height=1,
+                        command=lambda: self.tune(parent))
+        self.summary_var = tk.StringVar(value="no forest trained")
+        l = ttk.Label(self, textvariable=self.summary_var, font=("Segoe UI", 9))
+        bs.pack(side='left', anchor='e', fill='both')
+        bt.pack(side='left', anchor='e', fill='both')
+        l.pack(side='right', anchor='w', expand=True, fill='both', padx=5)
+
+    def refresh(self, parent):
+        """Show depth and node count of the trained forest.
+
+        Args:
+            parent: The parent widget holding RFmodel.
+        """
+        summary = forest_summary(parent.RFmodel)
+        self.summary_var.set(f"{summary['trees']} trees, depth {summary['max depth']}, "
+                             f"{summary['nodes']:,} nodes")
+
+    @staticmethod
+    def _get(parent, attribute, key):
+        value = getattr(parent, attribute)
+        return value[key] if key is not None else value
+
+    def open_settings(self, parent):
+        """Open a window to edit the training settings.
+
+        Args:
+            parent: The parent widget holding the settings.
+        """
+        window = tk.Toplevel(self)
+        window.title("Training settings")
+        entries = []
+        for row, (label, attribute, key, kind, optional) in enumerate(self.SETTINGS):
+            ttk.Label(window, text=label).grid(row=row, column=0, sticky='w', padx=5, pady=2)
+            entry = ttk.Entry(window, width=10)
+            value = self._get(parent, attribute, key)
+            entry.insert(0, "" if value is None else str(value))
+            entry.grid(row=row, column=1, sticky='ew', padx=5, pady=2)
+            entries.append(entry)
+        tk.Button(window, text='apply', font=("Segoe UI", 10),
+                  relief="solid", bd=1,
+                  command=lambda: self.apply_settings(parent, window, entries)
+                  ).grid(row=len(entries), column=0, columnspan=2, sticky='ew',
+                         padx=5, pady=5)
+
+    def apply_settings(self, parent, window, entries):
+        """Store the edited settings in parent and close the window.
+
+        Args:
+            parent: The parent widget holding the settings.
+            window: The settings window.
+            entries: Entry widgets, in the order of SETTINGS.
+        """
+        values = []
+        for (label, attribute, key, kind, optional), entry in zip(self.SETTINGS, entries):
+            text = entry.get().strip()
+            try:
+                value = None if optional and text in ("", "None") else kind(text)
+            except ValueError:
+                print(f"Invalid value for {label}: {text!r}")
+                return
+            values.append(value)
+        for (label, attribute, key, kind, optional), value in zip(self.SETTINGS, values):
+            if key is None:
+                setattr(parent, attribute, value)
+            else:
+                getattr(parent, attribute)[key] = value
+        print("Training settings:", parent.forest_params)
+        window.destroy()
+
+    @staticmethod
+    def tune(parent):
+        """Search forest settings and feature subsets by grouped
+        cross-validation, report the accuracy/speed Pareto front and apply
+        the fastest configuration within the tolerance.
+
+        Args:
+            parent: The parent widget holding the training set and settings.
+        """
+        if parent.feature_volume_mode:
+            print("Tuning is not available in volume mode")
+            return
+        print('Tuning random forest settings')
+        image_list, masks_list = ClassifierButtons.load_training_set(parent)
+        features = parent.feature_selector.get_selected_features()
+        # Sampled labeled rows, image by image, with their source image
+        keeps = sample_labeled_images(masks_list, **ClassifierButtons.sampling_options(parent))
+        x, y = feature_extraction_labeled(image_list, masks_list, features, keeps_i=keeps,
+                                          n_jobs=parent.feature_n_jobs)
+        groups = np.concatenate([np.full(len(k), i) for i, k in enumerate(keeps)])
+        # All pixels of the first training image to time the prediction on,
+        # extracted like for prediction
+        if image_list[0].ndim == 3:
+            reference = feature_extraction_channels(image_list[0], features,
+                                                    n_jobs=parent.feature_n_jobs)
+        else:
+            reference = feature_extraction(image_list[0], features,
+                                           n_jobs=parent.feature_n_jobs,
+                                           tile_size=parent.feature_tile_size)
+        # The selected features and, if smaller, the pruned ones
+        owner = column_features(x.names, features)
+        subsets = [features]
+        pruned = parent.feature_pruning.get('selected', [])
+        pruned = [f for f in features if f in pruned]
+        if pruned and len(pruned) < len(features):
+            subsets.append(pruned)
+        try:
+            results = search_forest_params(
+                x.values, y, groups, x.names, reference.values, grid=parent.tuning_grid,
+                feature_subsets=[[n for n in x.names if owner[n] in s] for s in subsets],
+                n_jobs=parent.forest_params.get('n_jobs', -1))
+        except ValueError as error:
+            print(f"Tuning failed: {error}")
+            return
+        front = pareto_front(results)
+        chosen = choose_configuration(results, tolerance=parent.tuning_tolerance)
+        print("Pareto front (accuracy, seconds per megapixel, settings):")
+        for result in front:
+            mark = '*' if result is chosen else ' '
+            print(f" {mark} {result['accuracy']:.3f} ± {result['accuracy std']:.3f}  "
+                  f"{result['seconds per megapixel']:.3f} s/MP  {result['params']}  "
+                  f"{len(result['features'])} feature columns")
+        # Apply the chosen configuration to the training panel
+        parent.forest_params.update(chosen['params'])
+        chosen_features = {owner[n] for n in chosen['features']}
+        for feature, var in parent.feature_selector.feature_vars.items():
+            var.set(feature in chosen_features)
+        # Keep the result with the training set
+        parent.forest_tuning = {'tolerance': float(parent.tuning_tolerance),
+                                'chosen': chosen,
+                                'pareto front': front}
+        JsonSaver.save_training_set(parent)
+        print("Training settings:", parent.forest_params)
+
+
 class TrainingSetManagerText(ttk.Frame):
     """A frame widget that displays a label for the RF classifier.
 
@@ -356,6 +961,13 @@ class TrainingSetManager(tk.Frame):
             self.parent.training_image_paths.remove(img_path)
         if mask_path in self.parent.training_mask_paths:
             self.parent.training_mask_paths.remove(mask_path)
+
+        # Retire the trees of an incremental forest that saw the image
+        forest = getattr(self.parent, "incremental_forest", None)
+        if forest is not None:
+            forest.remove(img_path)
+            self.parent.RFmodel = forest.model
+            self.parent.model_fingerprint = None
     
         # Delete mask file from disk
         mask_file = Path(mask_path)
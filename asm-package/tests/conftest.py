@@ -0,0 +1,46 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Shared fixtures of the tests. Small synthetic images and
+#              label masks keep the whole suite at a few seconds.
+##############################################################################
+"""Fixtures of the random forest classifier tests"""
+# Import packages
+import sys
+from pathlib import Path
+import numpy as np
+import pytest
+
+# The tests import asmgui from the package folder
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# Features of the tests, all built-in filters apart from 'Canny Edge',
+# whose hysteresis may differ across tiles
+FEATURES = ['Original image', 'r_ctr', 'denoise', 'Laplacian', 'Sobel', 'Scharr',
+            'Prewitt', 'Gaussian σ=3', 'Gaussian σ=7', 'Median size=3']
+
+@pytest.fixture
+def images():
+    # Three textured images with two bright discs of varying position
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[:96, :128]
+    result = []
+    for i in range(3):
+        img = rng.normal(0.3, 0.05, (96, 128))
+        img[(yy - 30 - 5 * i)**2 + (xx - 40)**2 < 15**2] += 0.5
+        img[(yy - 70)**2 + (xx - 90 + 4 * i)**2 < 12**2] += 0.3
+        result.append(np.clip(img, 0, 1).astype(np.float32))
+    return result
+
+@pytest.fixture
+def masks(images):
+    # Scattered strokes of labels 1 (background) and 2 (disc) per image
+    result = []
+    for i, img in enumerate(images):
+        mask = np.zeros(img.shape, np.uint8)
+        mask[5:12, 5:60] = 1
+        mask[80:90, 10:40] = 1
+        mask[28 - 5 * i:34 - 5 * i, 35:46] = 2
+        mask[68:73, 85 - 4 * i:95 - 4 * i] = 2
+        result.append(mask)
+    return result
@@ -0,0 +1,65 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: The faster extraction paths must give the same feature
+#              values as plain feature_extraction on the whole image.
+##############################################################################
+"""Equivalence tests of the feature extraction paths"""
+# Import packages
+import numpy as np
+from conftest import FEATURES
+from asmgui.randomforest_classifier.feature_cache import FeatureCache
+from asmgui.randomforest_classifier.feature_space import (
+    feature_extraction, feature_extraction_channels, feature_extraction_sparse,
+    feature_extraction_stack, feature_extraction_tiled, fill_feature_cache)
+
+def test_tiled_equals_dense(images):
+    dense = feature_extraction(images[0], FEATURES)
+    tiled = feature_extraction_tiled(images[0], FEATURES, tile_size=40)
+    assert tiled.names == dense.names
+    np.testing.assert_array_equal(tiled.values, dense.values)
+
+def test_sparse_equals_dense_at_labeled_pixels(images, masks):
+    dense = feature_extraction(images[0], FEATURES)
+    x, y = feature_extraction_sparse(images[0], masks[0], FEATURES)
+    labeled = np.flatnonzero(masks[0])
+    assert x.names == dense.names
+    np.testing.assert_array_equal(x.values, dense.values[labeled])
+    np.testing.assert_array_equal(y, masks[0].reshape(-1)[labeled])
+
+def test_stack_equals_per_image(images):
+    stacked = feature_extraction_stack(np.stack(images), FEATURES, batch_size=2)
+    per_image = np.concatenate([feature_extraction(img, FEATURES).values for img in images])
+    np.testing.assert_allclose(stacked.values, per_image, rtol=1e-6, atol=1e-6)
+
+def test_channels_equal_per_channel(images):
+    channels = np.stack(images)
+    x = feature_extraction_channels(channels, FEATURES, channel_names=['a', 'b', 'c'])
+    for c, name in enumerate(['a', 'b', 'c']):
+        single = feature_extraction(images[c], FEATURES)
+        for j, feature in enumerate(single.names):
+            if feature == 'r_ctr':
+                # Position features are computed once for all channels
+                column = x.names.index(feature)
+            else:
+                column = x.names.index(f"{feature} ({name})")
+            np.testing.assert_allclose(x.values[:, column], single.values[:, j],
+                                       rtol=1e-6, atol=1e-6)
+
+def test_cache_hit_equals_miss(images, masks, tmp_path):
+    cache = FeatureCache(tmp_path / 'features')
+    uncached = feature_extraction(images[0], FEATURES).values
+    miss = feature_extraction(images[0], FEATURES, cache=cache).values
+    hit = feature_extraction(images[0], FEATURES, cache=cache).values
+    np.testing.assert_array_equal(miss, uncached)
+    np.testing.assert_array_equal(hit, uncached)
+    # Sparse extraction reads the cached planes at the labeled pixels
+    x, _ = feature_extraction_sparse(images[0], masks[0], FEATURES, cache=cache)
+    np.testing.assert_array_equal(x.values, uncached[np.flatnonzero(masks[0])])
+
+def test_prefetched_cache_equals_miss(images, tmp_path):
+    cache = FeatureCache(tmp_path / 'features')
+    assert fill_feature_cache(images[1], FEATURES, cache, n_jobs=1) > 0
+    assert fill_feature_cache(images[1], FEATURES, cache, n_jobs=1) == 0
+    np.testing.assert_array_equal(feature_extraction(images[1], FEATURES, cache=cache).values,
+                                  feature_extraction(images[1], FEATURES).values)
@@ -0,0 +1,109 @@
+##############################################################################
+# Author:      Jamie, Germano & Nikhil
+#
+# Description: Round trips of the training paths. Stored rows, sharded and
+#              incremental forests and saved models must give back what
+#              went in, also after rows or trees were retired.
+##############################################################################
+"""Round-trip tests of the training store, shards and incremental forests"""
+# Import packages
+import numpy as np
+from conftest import FEATURES
+from asmgui.randomforest_classifier.feature_space import feature_extraction_sparse
+from asmgui.randomforest_classifier.incremental_training import IncrementalForest
+from asmgui.randomforest_classifier.model_store import load_model, save_model
+from asmgui.randomforest_classifier.sharded_training import (
+    merge_manifest, run_manifest_shard, train_sharded, write_manifest)
+from asmgui.randomforest_classifier.training_store import TrainingStore
+
+def labeled_rows(images, masks, keys):
+    # Rows of the images in the order the store appends them
+    rows = [feature_extraction_sparse(images[k], masks[k], FEATURES) for k in keys]
+    return np.concatenate([x.values for x, _ in rows]), np.concatenate([y for _, y in rows])
+
+def filled_store(folder, images, masks):
+    store = TrainingStore(folder, FEATURES)
+    store.update(dict(enumerate(masks)), lambda k: images[k], n_jobs=1)
+    return store
+
+def test_store_round_trip(images, masks, tmp_path):
+    store = filled_store(tmp_path / 'rows', images, masks)
+    x, y = store.training_data()
+    x_ref, y_ref = labeled_rows(images, masks, [0, 1, 2])
+    np.testing.assert_array_equal(x, x_ref)
+    np.testing.assert_array_equal(y, y_ref)
+    # Reopened and exported stores hold the same rows
+    for folder in (tmp_path / 'rows', store.export(tmp_path / 'export')):
+        x_loaded, y_loaded = TrainingStore.load(folder).training_data()
+        np.testing.assert_array_equal(x_loaded, x_ref)
+        np.testing.assert_array_equal(y_loaded, y_ref)
+    # Unchanged masks append nothing
+    assert store.update(dict(enumerate(masks)), lambda k: images[k], n_jobs=1) == 0
+
+def test_store_compaction(images, masks, tmp_path):
+    store = filled_store(tmp_path / 'rows', images, masks)
+    # An edited mask retires its old rows and appends new ones, a removed
+    # one only retires them
+    edited = masks[1].copy()
+    edited[40:44, 60:70] = 1
+    store.update({1: edited, 2: masks[2]}, lambda k: images[k], n_jobs=1)
+    x, y = store.training_data()
+    x_ref, y_ref = labeled_rows(images, [masks[0], edited, masks[2]], [2, 1])
+    np.testing.assert_array_equal(x, x_ref)
+    np.testing.assert_array_equal(y, y_ref)
+    assert store.n_rows == len(y_ref)
+    # Compacted rows survive reopening
+    np.testing.assert_array_equal(TrainingStore.load(store.folder).training_data()[0], x_ref)
+
+def test_sharded_forest_averages_its_trees(images, masks, tmp_path):
+    store = filled_store(tmp_path / 'rows', images, masks)
+    params = {'n_estimators': 6, 'n_jobs': 1}
+    model = train_sharded(store, 3, forest_params=params, n_jobs=1)
+    assert model.n_estimators == 6
+    assert model.feature_columns_ == store.columns
+    x, _ = store.training_data()
+    x = np.asarray(x)
+    mean = np.mean([tree.predict_proba(x) for tree in model.estimators_], axis=0)
+    np.testing.assert_allclose(model.predict_proba(x), mean)
+    # Shards fitted through a manifest merge to the same forest
+    manifest = write_manifest(store, tmp_path / 'shards', 3, forest_params=params)
+    for shard in range(3):
+        run_manifest_shard(manifest, shard)
+    merged = merge_manifest(manifest)
+    np.testing.assert_array_equal(merged.predict_proba(x), model.predict_proba(x))
+
+def test_saved_model_round_trip(images, masks, tmp_path):
+    store = filled_store(tmp_path / 'rows', images, masks)
+    model = train_sharded(store, 1, forest_params={'n_estimators': 3, 'n_jobs': 1},
+                          n_jobs=1, evaluation=None)
+    save_model(model, tmp_path / 'output', FEATURES, 'abc')
+    loaded = load_model(tmp_path / 'output', fingerprint='abc')
+    x = np.asarray(store.training_data()[0])
+    np.testing.assert_array_equal(loaded.predict_proba(x), model.predict_proba(x))
+    assert load_model(tmp_path / 'output', fingerprint='other') is None
+
+def test_incremental_forest_retires_trees(images, masks):
+    forest = IncrementalForest(lambda k: images[k], FEATURES, images_per_group=1,
+                               forest_params={'n_estimators': 6, 'n_jobs': 1}, n_jobs=1)
+    model = forest.update(dict(enumerate(masks)))
+    assert model.n_estimators == 6
+    assert forest.image_trees() == {0: 2, 1: 2, 2: 2}
+    trees = {k: [t for g in forest._groups if k in g['images'] for t in g['trees']]
+             for k in range(3)}
+    # Unchanged masks keep every tree
+    forest.update(dict(enumerate(masks)))
+    assert forest.model.estimators_ == trees[0] + trees[1] + trees[2]
+    # A removed image retires only the trees that saw it
+    forest.remove(1)
+    assert forest.image_trees() == {0: 2, 1: 0, 2: 2}
+    assert forest.model.estimators_ == trees[0] + trees[2]
+    # An edited mask refits its group, the other trees stay
+    edited = masks[2].copy()
+    edited[40:44, 60:70] = 1
+    model = forest.update({0: masks[0], 2: edited})
+    assert model.estimators_[:2] == trees[0]
+    assert not set(map(id, model.estimators_[2:])) & set(map(id, trees[2]))
+    # The refitted group gets its share of the 6 trees over 2 groups
+    assert model.n_estimators == 2 + 3
+    x, _ = labeled_rows(images, masks, [0])
+    assert model.predict(x).shape == (len(x),)